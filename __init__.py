@@ -1 +1,41 @@
-# Nothing to see here, move along
+# Modules are imported on first access, so short-lived tools only pay for what
+# they use, e.g.:
+#
+#   import plio
+#   t = plio.tmp101(1, 0x49)        # imports i2c_tmp101 and i2c
+#   s = plio.spi.spi(0, 0)          # imports spi
+#
+# Device drivers are available by part name. This needs Python 3.7 or later,
+# otherwise import the modules explicitly.
+
+import importlib
+
+# modules which can be accessed as attributes
+modules = ("i2c", "spi", "gpio", "gpio_auto", "gpio_sysfs", "deadline", "iobackend", "iotrace", "iostats", "broker",
+           "executor", "regmap", "sampler", "scan", "series", "telemetry", "ttlcache",
+           "i2c_24cxx", "i2c_ad2420", "i2c_ltc2945", "i2c_ltc2991", "i2c_max6639", "i2c_n24c02",
+           "i2c_tca6408", "i2c_tmp101")
+
+# driver classes, by module
+drivers = {
+    "eeprom":       "i2c_24cxx",
+    "ad2420":       "i2c_ad2420",
+    "ad2420_events":"i2c_ad2420",
+    "ltc2945":      "i2c_ltc2945",
+    "ltc2991":      "i2c_ltc2991",
+    "max6639":      "i2c_max6639",
+    "n24c02":       "i2c_n24c02",
+    "tca6408":      "i2c_tca6408",
+    "tmp101":       "i2c_tmp101",
+}
+
+def __getattr__(name):
+    if name in modules: return importlib.import_module("." + name, __name__)
+    if name in drivers:
+        attr = getattr(importlib.import_module("." + drivers[name], __name__), name)
+        globals()[name] = attr
+        return attr
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(modules) | set(drivers))
@@ -0,0 +1,354 @@
+""" Bus broker daemon, shares i2c and spi adapters between processes """
+
+# The broker owns the adapters and serves transactions from any number of
+# client processes over a Unix socket. Each bus is serviced by its own thread.
+# Optionally (coalesce=True, or -c), concurrent i2c transfers from different
+# clients are coalesced into combined I2C_RDWR ioctls, which saves bus time
+# but couples the clients: if a combined ioctl fails, every transfer in it
+# gets the error, since the kernel doesn't say which failed and retrying
+# could repeat side effects of those which succeeded. So one client's NACK
+# fails unrelated clients' transfers. Run it with:
+#
+#   python broker.py [-c] [socket]
+#
+# and make the drivers in a client process use it with:
+#
+#   c = broker.client()
+#   iobackend.use(c)
+#
+# Each transaction is atomic, coalesced or not, but a driver sequence
+# spanning several can be interleaved with other clients' transactions unless
+# the client holds the bus:
+#
+#   with c.hold(1): t.get_temperature()
+#
+# Drivers which need this when the bus is shared:
+#   tmp101          : every read sets the pointer register, then reads
+#   ltc2945, ltc2991: start a conversion, poll busy, then read the result
+#   24cxx           : writes each page, then polls for the write to finish
+#   ad2420          : caches the master's NODEADR and slaves' CHIP, so also
+#                     call invalidate() after taking the hold, in case
+#                     another client has changed them
+# Drivers built on regmap.py which read and write registers in single
+# transactions (e.g. tca6408, max6639) don't, but their caches only see
+# their own writes.
+#
+# The broker passes transactions to any iobackend, by default the local
+# devices. A loopback test without hardware can serve an iotrace replay:
+#
+#   b = broker("/tmp/plio.sock", iotrace.replay("trace.bin"))
+#   b.start()
+#
+# loopback() does this, sends every transaction of a trace through a client
+# and checks the results match, also from the command line:
+#
+#   python broker.py -l trace.bin
+#
+# Requests are a REQUEST header of body length, type, bus (NOBUS if None),
+# address (chip select for spi) and item count, followed by a body encoded as
+# for iotrace but without the responses. Types are those of iotrace, plus
+# LOCK and UNLOCK. Responses are a RESPONSE header of body length and errno
+# (0 if successful), followed by the concatenated bytes read, or for ioctls
+# the IOCTL request and value.
+
+from __future__ import print_function
+import os, sys, socket, struct, errno, shutil, tempfile, threading, contextlib
+
+try:
+    import iobackend, iotrace
+    from i2c import I2C_RDWR_IOCTL_MAX_MSGS, I2C_M_RD
+    from iotrace import I2C_TRANSFER, I2C_IOCTL, SPI_TRANSFER, SPI_IOCTL, IOCTL, NOBUS
+except:
+    from . import iobackend, iotrace
+    from .i2c import I2C_RDWR_IOCTL_MAX_MSGS, I2C_M_RD
+    from .iotrace import I2C_TRANSFER, I2C_IOCTL, SPI_TRANSFER, SPI_IOCTL, IOCTL, NOBUS
+
+SOCKET = "/run/plio.sock"
+REQUEST = struct.Struct("<IBHHH")
+RESPONSE = struct.Struct("<Ii")
+
+# extra request types, address is 1 for an spi bus else 0
+LOCK   = 5      # wait until no other client holds the bus, then hold it
+UNLOCK = 6      # release the bus
+
+# read exactly size bytes from socket, or return None at EOF
+def _recv(sock, size):
+    parts = []
+    while size:
+        data = sock.recv(size)
+        if not data: return None
+        parts.append(data)
+        size -= len(data)
+    return b"".join(parts)
+
+# A request from a client, waiting for its bus thread
+class _request:
+    def __init__(self, conn, type, bus, addr, request):
+        self.conn = conn
+        self.type = type
+        self.bus = bus
+        self.addr = addr
+        self.request = request
+
+# Transactions waiting for one bus, and the client holding it, if any
+class _bus:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = []
+        self.owner = None
+
+class broker:
+    # If coalesce is true, concurrent i2c transfers share ioctls, and fail
+    # together. Otherwise each gets its own ioctl, so one client's failure
+    # can't fail another's.
+    def __init__(self, path=SOCKET, backend=None, coalesce=False):
+        self.path = path
+        self.coalesce = coalesce
+        self.backend = backend or iobackend.local()
+        self.buses = {}         # by ("i2c", bus) or ("spi", bus)
+        self.lock = threading.Lock()
+        self.running = False
+        self.sock = None
+        self.combined = 0       # number of i2c ioctls that served more than one request
+
+    # return _bus for request type, bus and address, starting its thread if new
+    def _bus(self, type, bus, addr):
+        spi = type in (SPI_TRANSFER, SPI_IOCTL) or (type in (LOCK, UNLOCK) and addr)
+        key = ("spi" if spi else "i2c", bus)
+        with self.lock:
+            b = self.buses.get(key)
+            if b is None:
+                b = self.buses[key] = _bus()
+                t = threading.Thread(target=self._service, args=(b,))
+                t.daemon = True
+                t.start()
+            return b
+
+    # send response to client
+    def _reply(self, conn, error, body=b""):
+        try: conn.sendall(RESPONSE.pack(len(body), error) + body)
+        except (IOError, OSError): pass     # client has gone, its reader will clean up
+
+    # perform one request, return the response body
+    def _perform(self, r):
+        if r.type == I2C_TRANSFER: return b"".join(self.backend.i2c_transfer(r.bus, r.request))
+        if r.type == SPI_TRANSFER: return b"".join(self.backend.spi_transfer(r.bus, r.addr, r.request))
+        if r.type == I2C_IOCTL:
+            self.backend.i2c_ioctl(r.bus, *r.request)
+            return IOCTL.pack(*r.request)
+        value = self.backend.spi_ioctl(r.bus, r.addr, *r.request)
+        return IOCTL.pack(r.request[0], value if value is not None else r.request[1])
+
+    # Perform requests, coalescing i2c transfers into one ioctl if there are
+    # several. The kernel stops a combined transfer at the first failed
+    # message without saying which, and earlier messages may already have had
+    # side effects, so they are not retried: the error goes to every request
+    # in the batch. Any other exception, e.g. from a replay backend, is
+    # replied to as EIO.
+    def _perform_all(self, requests):
+        if len(requests) > 1:
+            try:
+                reads = iter(self.backend.i2c_transfer(requests[0].bus, [m for r in requests for m in r.request]))
+                self.combined += 1
+            except Exception as e:
+                for r in requests: self._reply(r.conn, getattr(e, "errno", None) or errno.EIO)
+                return
+            for r in requests:
+                self._reply(r.conn, 0, b"".join(next(reads) for m in r.request if m[1] & I2C_M_RD))
+            return
+        for r in requests:
+            try: body = self._perform(r)
+            except Exception as e: self._reply(r.conn, getattr(e, "errno", None) or errno.EIO)
+            else: self._reply(r.conn, 0, body)
+
+    # service one bus
+    def _service(self, b):
+        while True:
+            with b.cond:
+                # wait for requests from clients which may use the bus
+                while True:
+                    runnable = [r for r in b.pending if b.owner is None or r.conn is b.owner]
+                    if runnable: break
+                    b.cond.wait()
+                r = runnable[0]
+                if r.type == LOCK:
+                    b.owner = r.conn
+                    b.pending.remove(r)
+                    self._reply(r.conn, 0)
+                    continue
+                # take leading i2c transfers that fit in one ioctl, else just one request
+                batch = [r]
+                if r.type == I2C_TRANSFER and self.coalesce:
+                    n = len(r.request)
+                    for r in runnable[1:]:
+                        if r.type != I2C_TRANSFER or n + len(r.request) > I2C_RDWR_IOCTL_MAX_MSGS: break
+                        batch.append(r)
+                        n += len(r.request)
+                for r in batch: b.pending.remove(r)
+            self._perform_all(batch)
+
+    # read requests from one client until it disconnects
+    def _client(self, conn):
+        held = set()
+        try:
+            while True:
+                header = _recv(conn, REQUEST.size)
+                if header is None: break
+                length, type, bus, addr, count = REQUEST.unpack(header)
+                body = _recv(conn, length) if length else b""
+                if body is None: break
+                if bus == NOBUS: bus = None
+                b = self._bus(type, bus, addr)
+                if type == UNLOCK:
+                    # the client waits for each response, so all its earlier requests are done
+                    with b.cond:
+                        if b.owner is conn: b.owner = None
+                        b.cond.notify()
+                    self._reply(conn, 0)
+                    continue
+                if type == LOCK: held.add(b)
+                request = iotrace.decode(type, count, body, False)[0] if type != LOCK else None
+                with b.cond:
+                    b.pending.append(_request(conn, type, bus, addr, request))
+                    b.cond.notify()
+        except (IOError, OSError, struct.error, ValueError):
+            pass
+        finally:
+            # release anything the client held
+            for b in held:
+                with b.cond:
+                    if b.owner is conn: b.owner = None
+                    b.pending = [r for r in b.pending if r.conn is not conn]
+                    b.cond.notify()
+            conn.close()
+
+    # accept clients until stopped
+    def _accept(self):
+        while self.running:
+            try: conn, addr = self.sock.accept()
+            except (IOError, OSError): break
+            t = threading.Thread(target=self._client, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    # listen on the socket, in a thread
+    def start(self):
+        if os.path.exists(self.path): os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(16)
+        self.running = True
+        self.thread = threading.Thread(target=self._accept)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # stop listening
+    def stop(self):
+        self.running = False
+        self.sock.shutdown(socket.SHUT_RDWR)
+        self.sock.close()
+        self.thread.join()
+        os.unlink(self.path)
+
+# An iobackend which sends transactions to the broker. One connection is
+# shared by all threads in the process.
+class client:
+    def __init__(self, path=SOCKET):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.lock = threading.Lock()
+
+    def close(self): self.sock.close()
+
+    # send request and return response body, or raise IOError
+    def _call(self, type, bus, addr, request=None):
+        body = iotrace.encode(type, request) if request is not None else b""
+        count = len(request) if request is not None else 0
+        with self.lock:
+            self.sock.sendall(REQUEST.pack(len(body), type, NOBUS if bus is None else bus, addr, count) + body)
+            header = _recv(self.sock, RESPONSE.size)
+            if header is None: raise IOError(errno.EPIPE, "broker disconnected")
+            length, error = RESPONSE.unpack(header)
+            body = _recv(self.sock, length) if length else b""
+        if error: raise IOError(error, os.strerror(error))
+        return body
+
+    # Context manager which holds the i2c bus (or spi bus if spi is true), so
+    # other clients can't interleave transactions with ours
+    @contextlib.contextmanager
+    def hold(self, bus, spi=False):
+        self._call(LOCK, bus, int(spi))
+        try: yield
+        finally: self._call(UNLOCK, bus, int(spi))
+
+    def i2c_transfer(self, bus, msgs):
+        msgs = [(addr, flags, data if flags & I2C_M_RD else bytes(bytearray(data))) for addr, flags, data in msgs]
+        body = self._call(I2C_TRANSFER, bus, 0, msgs)
+        reads, n = [], 0
+        for addr, flags, data in msgs:
+            if flags & I2C_M_RD:
+                reads.append(body[n:n+data])
+                n += data
+        return reads
+
+    def spi_transfer(self, bus, chipselect, transfers):
+        transfers = [(bytes(bytearray(t[0])),) + tuple(t[1:]) for t in transfers]
+        body = self._call(SPI_TRANSFER, bus, chipselect, transfers)
+        rx, n = [], 0
+        for t in transfers:
+            rx.append(body[n:n+len(t[0])])
+            n += len(t[0])
+        return rx
+
+    def i2c_ioctl(self, bus, request, value):
+        self._call(I2C_IOCTL, bus, 0, (request, value))
+
+    def spi_ioctl(self, bus, chipselect, request, value):
+        body = self._call(SPI_IOCTL, bus, chipselect, (request, value))
+        if request & 0x80000000: return IOCTL.unpack(body)[1]
+
+# Loopback check without hardware: serve a replay of the trace at path, send
+# every recorded transaction to it through a client, and check the results
+# and errors are those recorded. Returns the number of transactions checked,
+# raises iotrace.mismatch at the first difference.
+def loopback(path):
+    tmp = tempfile.mkdtemp()
+    b = broker(os.path.join(tmp, "plio.sock"), iotrace.replay(path))
+    b.start()
+    c = client(b.path)
+    try:
+        records = iotrace.load(path)
+        for n, r in enumerate(records):
+            expected = r.response
+            try:
+                if r.type == I2C_TRANSFER: result = c.i2c_transfer(r.bus, r.request)
+                elif r.type == SPI_TRANSFER: result = c.spi_transfer(r.bus, r.addr, r.request)
+                elif r.type == I2C_IOCTL: result = c.i2c_ioctl(r.bus, *r.request)
+                else:
+                    read = bool(r.request[0] & 0x80000000)
+                    result = c.spi_ioctl(r.bus, r.addr, r.request[0], None if read else r.request[1])
+                    expected = r.request[1] if read else None
+                error = 0
+            except (IOError, OSError) as e:
+                result, error = None, e.errno
+            if error != r.errno or (not error and result != expected):
+                raise iotrace.mismatch("record %d is %r, got errno %d %r" % (n, r, error, result))
+        return len(records)
+    finally:
+        c.close()
+        b.stop()
+        shutil.rmtree(tmp, True)
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["-l"] and len(sys.argv) == 3:
+        print("%d transactions match" % loopback(sys.argv[2]))
+        sys.exit(0)
+    import time
+    args = [a for a in sys.argv[1:] if a != "-c"]
+    b = broker(args[0] if args else SOCKET, coalesce="-c" in sys.argv[1:])
+    b.start()
+    print("Serving on", b.path)
+    try:
+        while True: time.sleep(60)
+    except KeyboardInterrupt:
+        b.stop()
@@ -0,0 +1,221 @@
+""" Deadlines, classified retries and circuit breakers for i2c and spi I/O """
+
+# By default a failed ioctl raises immediately and there is no time limit
+# other than the adapter's. Inside a within() context, every i2c and spi
+# transaction made by the calling thread, including those made by driver
+# methods, is retried on transient errors with exponential backoff, and fails
+# fast with expired once the deadline has passed:
+#
+#   with deadline.within(0.010):
+#       t = sensor.get_temperature()
+#
+# Errors are classified by classify() as NACK (EREMOTEIO or ENXIO), TIMEOUT
+# (ETIMEDOUT, e.g. clock stretched too long), ARBITRATION (EAGAIN, another
+# master won the bus) or OTHER. Only the first three are retried, and only
+# for transactions which are safe to repeat: the kernel doesn't say how far a
+# combined transfer got before it failed, so by default only single-message
+# i2c transfers and pure i2c reads are retried. spi transactions are never
+# known to be safe, e.g. repeating one chunk of a streamed flash read returns
+# the next bytes. Pass combined=True to within() or enable() if the devices
+# don't mind e.g. a register write being repeated.
+#
+# Code which expects NACKs, e.g. bus scans and EEPROM write polling, makes
+# its transactions in a probing() context, where they are not retried and
+# NACKs don't count against breakers.
+#
+# enable() also turns on retries outside within() contexts, and a circuit
+# breaker per device: after threshold consecutive failed transactions (each
+# counted once, however many times it was retried) the device is not
+# accessed at all, and transactions raise tripped, for cooldown seconds.
+# Then one trial transaction is allowed through, and success closes the
+# breaker again. So a dead sensor costs its callers nothing and doesn't eat
+# the bus time of healthy ones.
+#
+# An ioctl in progress can't be interrupted, so a deadline bounds when the
+# last attempt starts. For local i2c adapters, the adapter's timeout
+# (I2C_TIMEOUT) is also set to the time remaining before each attempt, and
+# restored after, which bounds clock stretching and the like. Times are from
+# a monotonic clock.
+
+from __future__ import print_function
+import time, errno, threading
+from contextlib import contextmanager
+
+# seconds from a monotonic clock, for deadlines and breakers
+_now = getattr(time, "monotonic", time.time)
+
+NACK = "nack"
+TIMEOUT = "timeout"
+ARBITRATION = "arbitration"
+OTHER = "other"
+
+CLASSES = {errno.EREMOTEIO: NACK, errno.ENXIO: NACK, errno.ETIMEDOUT: TIMEOUT, errno.EAGAIN: ARBITRATION}
+RETRY = (NACK, TIMEOUT, ARBITRATION)
+
+enabled = False         # true if call() should be used, i.e. enable()d or any within() active
+policy = False          # true if enable()d
+retries = 2             # retries per transaction outside within() contexts, if enable()d
+combined = False        # true if combined transactions may be retried outside within() contexts
+backoff = 0.0005        # initial retry delay in seconds, doubled for each retry
+threshold = None        # consecutive failures which open a breaker, None if disabled
+cooldown = 1.0          # seconds a breaker stays open
+
+lock = threading.Lock()
+breakers = {}           # by (kind, bus, address)
+_local = threading.local()
+_active = 0             # number of within() contexts in all threads
+
+# raised when a transaction is attempted after the deadline
+class expired(IOError):
+    def __init__(self):
+        IOError.__init__(self, errno.ETIMEDOUT, "Deadline expired")
+
+# raised when a transaction is attempted with a device whose breaker is open
+class tripped(IOError):
+    def __init__(self, key):
+        IOError.__init__(self, errno.EHOSTDOWN, "Circuit breaker open for %s %s address 0x%02X" % key)
+
+# return the class of an IOError or OSError
+def classify(e):
+    return CLASSES.get(getattr(e, "errno", None), OTHER)
+
+class breaker:
+    def __init__(self):
+        self.failures = 0       # consecutive failures
+        self.opened = None      # when opened, or None if closed
+        self.trips = 0          # number of times opened
+        self.rejected = 0       # transactions not attempted
+
+    # return true if a transaction may be attempted
+    def allow(self):
+        if self.opened is None: return True
+        if _now() - self.opened >= cooldown:
+            self.opened = _now()        # allow one trial, and wait again if it fails
+            return True
+        self.rejected += 1
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened = None
+
+    def failure(self):
+        self.failures += 1
+        if threshold is not None and self.failures >= threshold and self.opened is None:
+            self.opened = _now()
+            self.trips += 1
+
+# Turn on retries for all transactions and, if threshold is not None, circuit
+# breakers. If combined, transactions which aren't safe to repeat are retried
+# too.
+def enable(retries=2, backoff=0.0005, threshold=5, cooldown=1.0, combined=False):
+    global enabled, policy
+    g = globals()
+    g["retries"], g["backoff"], g["threshold"], g["cooldown"], g["combined"] = retries, backoff, threshold, cooldown, combined
+    policy = True
+    enabled = True
+
+# turn off retries and breakers outside within() contexts
+def disable():
+    global enabled, policy, threshold
+    threshold = None
+    policy = False
+    with lock:
+        breakers.clear()
+        enabled = _active > 0
+
+# Context in which this thread's transactions must start within seconds, or
+# raise expired. Nested contexts can only shorten the deadline. retries
+# overrides the number of retries per transaction, default is unlimited
+# within the deadline. If combined, transactions which aren't safe to repeat
+# are retried too.
+@contextmanager
+def within(seconds, retries=None, combined=False):
+    global enabled, _active
+    outer = getattr(_local, "deadline", None)
+    end = _now() + seconds
+    if outer is not None: end = min(end, outer[0])
+    _local.deadline = (end, retries, combined)
+    with lock:
+        _active += 1
+        enabled = True
+    try:
+        yield
+    finally:
+        _local.deadline = outer
+        with lock:
+            _active -= 1
+            enabled = policy or _active > 0
+
+# Context in which this thread's transactions are expected to NACK, e.g.
+# probes. They are not retried, and NACKs don't count as breaker failures.
+@contextmanager
+def probing():
+    outer = getattr(_local, "probing", False)
+    _local.probing = True
+    try:
+        yield
+    finally:
+        _local.probing = outer
+
+# return seconds until this thread's deadline, or None if there is none
+def remaining():
+    d = getattr(_local, "deadline", None)
+    return None if d is None else d[0] - _now()
+
+# Return the breaker for key, or None if breakers are disabled
+def _breaker(key):
+    if threshold is None: return None
+    with lock:
+        b = breakers.get(key)
+        if b is None: b = breakers[key] = breaker()
+        return b
+
+# Perform transaction function() for device key, (kind, bus, address), with
+# retries, deadline and breaker as configured. repeatable is false if the
+# transaction may have had effects before failing part way, so it's only
+# retried if combined. If there is a deadline and bound is given, it's called
+# with the seconds remaining before each attempt, to limit how long the
+# attempt can take, and with None after the last. Called by i2c.py and spi.py
+# when enabled is true.
+def call(key, function, repeatable=False, bound=None):
+    d = getattr(_local, "deadline", None)
+    end, limit, many = d if d is not None else (None, retries if policy else 0, combined)
+    probe = getattr(_local, "probing", False)
+    if probe or not (repeatable or many): limit = 0
+    if end is None: bound = None
+    try:
+        return _attempts(key, function, end, limit, probe, bound)
+    finally:
+        if bound is not None: bound(None)
+
+# the attempts of call(), until one succeeds or it gives up
+def _attempts(key, function, end, limit, probe, bound):
+    b = _breaker(key)
+    delay = backoff
+    attempt = 0
+    while True:
+        if end is not None and _now() >= end: raise expired()
+        if b is not None and not b.allow(): raise tripped(key)
+        try:
+            if bound is not None: bound(end - _now())
+            result = function()
+        except (IOError, OSError) as e:
+            kind = classify(e)
+            if kind not in RETRY or (limit is not None and attempt >= limit) or \
+               (end is not None and _now() + delay >= end):         # no time to retry
+                if b is not None and not (probe and kind == NACK): b.failure()
+                raise
+            attempt += 1
+            time.sleep(delay)
+            delay *= 2
+            continue
+        if b is not None: b.success()
+        return result
+
+# Return dict of breaker states by key, each a dict of failures, trips,
+# rejected and open (true if open)
+def status():
+    with lock:
+        return dict((k, {"failures": b.failures, "trips": b.trips, "rejected": b.rejected, "open": b.opened is not None})
+                    for k, b in breakers.items())
@@ -0,0 +1,129 @@
+""" Run driver reads in parallel across independent adapters """
+
+# Separate /dev/i2c-X adapters and spi controllers can transfer at the same
+# time, and their ioctls release the GIL. The executor runs one worker thread
+# per adapter: work for the same adapter is performed in order, work for
+# different adapters in parallel. So a sweep over several buses takes as long
+# as the slowest bus, rather than the sum of all of them:
+#
+#   e = executor()
+#   results = e.run([("ambient", t.get_temperature), ("12V", p.get_vin), ...])
+#   for r in results: print(r.name, r.value)
+#
+# The adapter is found from the driver the method belongs to, or can be given
+# explicitly as ("name", adapter, function). Single calls can also be submitted
+# for a future:
+#
+#   f = e.submit(("i2c", 1), t.get_temperature)
+#   print(f.result())
+
+from __future__ import print_function
+import time, threading, collections
+
+try: import queue
+except: import Queue as queue
+
+# A result from run(). timestamp is time.time() when the call completed, and
+# error is the exception it raised (in which case value is None).
+result = collections.namedtuple("result", "name adapter timestamp value error")
+
+# Return the adapter used by dev, which can be an i2c or spi object, a driver
+# or a bound method of a driver. Adapters are ("i2c", bus) or ("spi", bus),
+# note all chip selects of a bus share it.
+def adapter(dev):
+    dev = getattr(dev, "__self__", dev)
+    for name in ("i2c", "i2cbase"):
+        if hasattr(dev, name):
+            dev = getattr(dev, name)
+            break
+    return ("spi" if hasattr(dev, "chipselect") else "i2c", dev.bus)
+
+# The result of a submitted call, when it completes
+class future:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        self.timestamp = None
+
+    def done(self): return self.event.is_set()
+
+    # wait for the call, return its value or raise its exception
+    def result(self, timeout=None):
+        if not self.event.wait(timeout): raise RuntimeError("timed out")
+        if self.error is not None: raise self.error
+        return self.value
+
+    # wait for the call, return the exception it raised, or None
+    def exception(self, timeout=None):
+        if not self.event.wait(timeout): raise RuntimeError("timed out")
+        return self.error
+
+class executor:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = {}        # by adapter
+        self.threads = []
+
+    # perform calls from q until given None
+    def _worker(self, q):
+        while True:
+            work = q.get()
+            if work is None: break
+            f, function, args = work
+            try:
+                f.value = function(*args)
+            except Exception as e:
+                f.error = e
+            f.timestamp = time.time()
+            f.event.set()
+
+    # Call function(*args) in the worker for adapter, return a future
+    def submit(self, adapter, function, *args):
+        with self.lock:
+            q = self.queues.get(adapter)
+            if q is None:
+                q = self.queues[adapter] = queue.Queue()
+                t = threading.Thread(target=self._worker, args=(q,))
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+        f = future()
+        q.put((f, function, args))
+        return f
+
+    # Given a list of (name, function) or (name, adapter, function), perform
+    # all the calls and return a list of results ordered by timestamp. If
+    # timeout, calls not completed in time are not included.
+    def run(self, reads, timeout=None):
+        futures = []
+        for r in reads:
+            name, a, function = (r[0], adapter(r[1]), r[1]) if len(r) == 2 else r
+            futures.append((name, a, self.submit(a, function)))
+        end = None if timeout is None else time.time() + timeout
+        results = []
+        for name, a, f in futures:
+            if not f.event.wait(None if end is None else max(0, end - time.time())): continue
+            results.append(result(name, a, f.timestamp, f.value, f.error))
+        return sorted(results, key=lambda r: r.timestamp)
+
+    # stop the workers after they finish queued calls
+    def shutdown(self):
+        with self.lock:
+            for q in self.queues.values(): q.put(None)
+            self.queues = {}
+        for t in self.threads: t.join()
+        self.threads = []
+
+if __name__ == "__main__":
+
+    try: from i2c_tmp101 import tmp101
+    except: from .i2c_tmp101 import tmp101
+
+    e = executor()
+    sensors = [("bus%d" % bus, tmp101(bus, 0x49).get_temperature) for bus in (0, 1)]
+    start = time.time()
+    for r in e.run(sensors):
+        print(r.name, r.adapter, r.error or "%gC" % r.value)
+    print("%.3f seconds" % (time.time() - start))
+    e.shutdown()
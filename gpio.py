@@ -4,9 +4,12 @@
 # if you need that.
 
 from __future__ import print_function
-import os, fcntl, glob
+import os, re, fcntl, glob, select, time, threading
 from ctypes import *
 
+try: import iostats
+except: from . import iostats
+
 # For debug, dump ctypes.Structure
 # def dump(struct):
 #     bytes=map(ord,memoryview(struct).tobytes())
@@ -42,6 +45,29 @@ GPIOHANDLE_SET_LINE_VALUES_IOCTL = 0xC040B409
 class gpiohandle_data(Structure):
     _fields_ = [("values", c_ubyte * GPIOHANDLES_MAX)]      # desired output or current input state (we only use the first one)
 
+# configure gpio input and get handle for edge events
+GPIO_GET_LINEEVENT_IOCTL = 0xC030B404
+GPIOEVENT_REQUEST_RISING_EDGE = 1
+GPIOEVENT_REQUEST_FALLING_EDGE = 2
+GPIOEVENT_REQUEST_BOTH_EDGES = 3
+class gpioevent_request(Structure):
+    _fields_ = [
+        ("lineoffset", c_uint),                             # line number
+        ("handleflags", c_uint),                            # GPIOHANDLE_REQUEST_* flags
+        ("eventflags", c_uint),                             # GPIOEVENT_REQUEST_* flags
+        ("consumer_label", c_char * 32),                    # arbitrary label for handle
+        ("fd", c_int),                                      # return descriptor
+    ]
+
+# read from event handle
+GPIOEVENT_EVENT_RISING_EDGE = 1
+GPIOEVENT_EVENT_FALLING_EDGE = 2
+class gpioevent_data(Structure):
+    _fields_ = [
+        ("timestamp", c_ulonglong),                         # nanoseconds
+        ("id", c_uint),                                     # GPIOEVENT_EVENT_*
+    ]
+
 class gpio:
 
     # Initialize gpio "line" on gpiochip "chip".
@@ -49,8 +75,9 @@ class gpio:
     #   output     : 0=configure as input, 1=configure as normal output, 2=as open drain output, 3=as open source output. Default is 0.
     #   invert     : if true the the state is inverted relative to gpio input or output signal (i.e. negative logic). Default is False.
     #   state      : if true then output is set, if false output is cleared. Or just reports current status if input (subject to "invert"). Default is False.
+    #   edge       : for inputs, 0=no edge detection, 1=rising, 2=falling, 3=both, see wait(). Edges are relative to "invert". Default is 0.
     # Unspecified options are 0/False.
-    def __init__(self, line, chip=0, invert=False, output=0, state=False):
+    def __init__(self, line, chip=0, invert=False, output=0, state=False, edge=0):
         self.chip = chip
         self.line = line
 
@@ -60,10 +87,12 @@ class gpio:
         # pre-allocate data structures for speed
         self.gpiohandle_reqest = gpiohandle_request()
         self.gpiohandle_data = gpiohandle_data()
+        self.gpioevent_request = gpioevent_request()
+        self.gpioevent_data = gpioevent_data()
 
         # set initial configuration
         self.linefd=None
-        self.configure(invert=bool(invert), output=int(output), state=bool(state))
+        self.configure(invert=bool(invert), output=int(output), state=bool(state), edge=int(edge))
 
     def __del__(self):
         # close file handles
@@ -76,8 +105,8 @@ class gpio:
         except:
             pass
 
-    # Alter gpio output, invert, and state as above, but default None means do not change.
-    def configure(self, invert=None, output=None, state=None):
+    # Alter gpio output, invert, state and edge as above, but default None means do not change.
+    def configure(self, invert=None, output=None, state=None, edge=None):
         # update specified configs
         if invert is not None:
             self.invert=bool(invert)
@@ -85,6 +114,8 @@ class gpio:
             self.output=int(output)
         if state is not None:
             self.state=bool(state)
+        if edge is not None:
+            self.edge=int(edge) & 3
 
         # update gpio and get new request handle
         self.gpiohandle_reqest.lineoffsets[0] = self.line
@@ -103,12 +134,33 @@ class gpio:
         # close old handle
         if self.linefd is not None:
             os.close(self.linefd)
-        # config and get new handle
-        fcntl.ioctl(self.chipfd, GPIO_GET_LINEHANDLE_IOCTL, self.gpiohandle_reqest, True)
-        self.linefd = self.gpiohandle_reqest.fd
+            self.linefd = None
+        if self.edge and not self.output:
+            # config input with edge detection, the event handle also supports reading the state
+            self.gpioevent_request.lineoffset = self.line
+            self.gpioevent_request.handleflags = self.gpiohandle_reqest.flags
+            self.gpioevent_request.eventflags = self.edge
+            self.gpioevent_request.consumer_label = b"gpio.py"
+            fcntl.ioctl(self.chipfd, GPIO_GET_LINEEVENT_IOCTL, self.gpioevent_request, True)
+            self.linefd = self.gpioevent_request.fd
+        else:
+            # config and get new handle
+            self.gpiohandle_reqest.default_values[0] = self.state
+            fcntl.ioctl(self.chipfd, GPIO_GET_LINEHANDLE_IOCTL, self.gpiohandle_reqest, True)
+            self.linefd = self.gpiohandle_reqest.fd
         # update if input
         if not self.output: self.get_input()
 
+    # Wait for an edge on an input configured with edge detection, for up to
+    # timeout seconds or forever if None. Return tuple (timestamp in
+    # nanoseconds, True if rising) or None if timeout.
+    def wait(self, timeout=None):
+        assert self.edge and not self.output
+        if not select.select([self.linefd], [], [], timeout)[0]: return None
+        memmove(addressof(self.gpioevent_data), os.read(self.linefd, sizeof(self.gpioevent_data)), sizeof(self.gpioevent_data))
+        self.state = self.gpioevent_data.id == GPIOEVENT_EVENT_RISING_EDGE
+        return self.gpioevent_data.timestamp, self.state
+
     # change gpio to an normal output and then set high or low
     # type can be 1, 2 or 3 to set the output type
     def set_output(self, state):
@@ -119,7 +171,8 @@ class gpio:
             # already an output, just update the state
             self.state = bool(state)
             self.gpiohandle_data.values[0] = int(state)
-            fcntl.ioctl(self.linefd, GPIOHANDLE_SET_LINE_VALUES_IOCTL, self.gpiohandle_data, True)
+            if iostats.enabled: iostats.ioctl("gpio", self.chip, {self.line: [1, 1, 0]}, self.linefd, GPIOHANDLE_SET_LINE_VALUES_IOCTL, self.gpiohandle_data, True)
+            else: fcntl.ioctl(self.linefd, GPIOHANDLE_SET_LINE_VALUES_IOCTL, self.gpiohandle_data, True)
 
     # change gpio to an input and return current state
     def get_input(self):
@@ -128,13 +181,208 @@ class gpio:
             self.configure(output=0)
         else:
             # already an input, just read current state
-            fcntl.ioctl(self.linefd, GPIOHANDLE_GET_LINE_VALUES_IOCTL, self.gpiohandle_data, True)
+            if iostats.enabled: iostats.ioctl("gpio", self.chip, {self.line: [1, 0, 1]}, self.linefd, GPIOHANDLE_GET_LINE_VALUES_IOCTL, self.gpiohandle_data, True)
+            else: fcntl.ioctl(self.linefd, GPIOHANDLE_GET_LINE_VALUES_IOCTL, self.gpiohandle_data, True)
             self.state = bool(self.gpiohandle_data.values[0])
         return self.state
 
     # show gpio configuration
     def show(self, label=None):
-        print("gpio %d.%d: output=%s state=%s invert=%s" % (self.chip, self.line, self.output, self.state, self.invert))
+        print("gpio %d.%d: output=%s state=%s invert=%s edge=%s" % (self.chip, self.line, self.output, self.state, self.invert, self.edge))
+
+# Return nanoseconds from a monotonic clock, for capture timestamps
+if hasattr(time, "monotonic_ns"): _ns = time.monotonic_ns
+else: _ns = lambda: int(time.time() * 1000000000)
+
+# Return a function returning nanoseconds from the clock of the kernel's line
+# event timestamps, which is CLOCK_MONOTONIC since Linux 5.7 and
+# CLOCK_REALTIME before
+def _event_clock():
+    monotonic = tuple(int(n) for n in re.findall(r"\d+", os.uname()[2])[:2]) >= (5, 7)
+    if hasattr(time, "clock_gettime_ns"):
+        clock = time.CLOCK_MONOTONIC if monotonic else time.CLOCK_REALTIME
+        return lambda: time.clock_gettime_ns(clock)
+    return _ns if monotonic else lambda: int(time.time() * 1000000000)
+
+class capture:
+
+    # Capture the states of input lines of chip into preallocated numpy
+    # arrays, like a logic analyzer, in a dedicated thread:
+    #
+    #   c = capture([4, 5, 6], samples=100000)
+    #   c.start(duration=1.0)
+    #   c.wait()
+    #   timestamps, states = c.result()
+    #   c.vcd("capture.vcd")
+    #
+    # mode is one of:
+    #   "poll"   : one GPIOHANDLE_GET_LINE_VALUES_IOCTL for all lines per
+    #              sample, at rate Hz or as fast as possible if None.
+    #              Timestamps are from the monotonic clock.
+    #   "events" : request both edge events on each line and drain the kernel
+    #              event buffers, recording a sample per edge. Timestamps are
+    #              the kernel's, which are monotonic since Linux 5.7 and
+    #              realtime before, and the initial state is timestamped from
+    #              the same clock. Edges can be lost if the kernel buffer (16
+    #              per line) overflows.
+    # Up to samples samples are captured. timestamps is an int64 array of
+    # nanoseconds, states is a uint8 array with a row per sample and a column
+    # per line. Requires numpy.
+    def __init__(self, lines, chip=0, mode="poll", samples=100000, rate=None, invert=False):
+        import numpy
+        assert mode in ("poll", "events")
+        assert 0 < len(lines) <= GPIOHANDLES_MAX
+        self.lines = list(lines)
+        self.chip = chip
+        self.mode = mode
+        self.rate = rate
+        self.invert = invert
+        self.timestamps = numpy.zeros(samples, dtype=numpy.int64)
+        self.states = numpy.zeros((samples, len(lines)), dtype=numpy.uint8)
+        self.count = 0
+        self.thread = None
+        self.running = False
+        self.triggered = None       # timestamp of the trigger sample
+        self.previous = None        # row before the trigger sample
+
+    # Start capturing, until samples are full, duration seconds have elapsed,
+    # or stop() is called. If trigger is given, it's a function which is
+    # passed the previous row of states (None for the first) and the current
+    # row, and capture starts when it returns true, e.g. to start while the
+    # first line is high, or on a rising edge of it:
+    #   c.start(trigger=lambda p, s: s[0])
+    #   c.start(trigger=lambda p, s: p is not None and not p[0] and s[0])
+    # The duration starts from the trigger.
+    def start(self, duration=None, trigger=None):
+        assert not self.running
+        self.count = 0
+        self.triggered = None
+        self.previous = None
+        self.running = True
+        self.thread = threading.Thread(target=self._run, args=(duration, trigger))
+        self.thread.daemon = True
+        self.thread.start()
+
+    # stop capturing
+    def stop(self):
+        self.running = False
+        self.wait()
+
+    # wait for capture to finish, return true if it has
+    def wait(self, timeout=None):
+        if self.thread is not None: self.thread.join(timeout)
+        return not (self.thread and self.thread.is_alive())
+
+    # return views (timestamps, states) of the captured samples
+    def result(self):
+        return self.timestamps[:self.count], self.states[:self.count]
+
+    # record a sample, return false when capture should stop
+    def _record(self, timestamp, row, duration, trigger):
+        if self.triggered is None:
+            if trigger is not None:
+                fired = trigger(self.previous, row)
+                self.previous = row.copy()
+                if not fired: return True
+            self.triggered = timestamp
+        if duration is not None and timestamp - self.triggered > duration * 1000000000: return False
+        self.timestamps[self.count] = timestamp
+        self.states[self.count] = row
+        self.count += 1
+        return self.count < len(self.timestamps)
+
+    def _run(self, duration, trigger):
+        chipfd = os.open("/dev/gpiochip%d" % self.chip, os.O_RDWR)
+        try:
+            if self.mode == "poll": self._poll(chipfd, duration, trigger)
+            else: self._events(chipfd, duration, trigger)
+        finally:
+            os.close(chipfd)
+            self.running = False
+
+    def _poll(self, chipfd, duration, trigger):
+        import numpy
+        request = gpiohandle_request()
+        for n, line in enumerate(self.lines): request.lineoffsets[n] = line
+        request.flags = GPIOHANDLE_REQUEST_INPUT | (GPIOHANDLE_REQUEST_ACTIVE_LOW if self.invert else 0)
+        request.lines = len(self.lines)
+        request.consumer_label = b"gpio.py capture"
+        fcntl.ioctl(chipfd, GPIO_GET_LINEHANDLE_IOCTL, request, True)
+        data = gpiohandle_data()
+        row = numpy.frombuffer(data, dtype=numpy.uint8, count=len(self.lines))   # view of data.values
+        period = 1000000000 // self.rate if self.rate else 0
+        due = _ns()
+        try:
+            while self.running:
+                fcntl.ioctl(request.fd, GPIOHANDLE_GET_LINE_VALUES_IOCTL, data, True)
+                if not self._record(_ns(), row, duration, trigger): break
+                if period:
+                    due += period
+                    delay = due - _ns()
+                    if delay > 1000000: time.sleep(delay / 1000000000.0)    # else spin
+                    while _ns() < due: pass
+        finally:
+            os.close(request.fd)
+
+    def _events(self, chipfd, duration, trigger):
+        import numpy
+        event = numpy.dtype([("timestamp", "<u8"), ("id", "<u4"), ("pad", "<u4")])
+        assert event.itemsize == sizeof(gpioevent_data)
+        fds = []
+        try:
+            # request events on each line, and read its current state
+            row = numpy.zeros(len(self.lines), dtype=numpy.uint8)
+            data = gpiohandle_data()
+            for n, line in enumerate(self.lines):
+                request = gpioevent_request()
+                request.lineoffset = line
+                request.handleflags = GPIOHANDLE_REQUEST_INPUT | (GPIOHANDLE_REQUEST_ACTIVE_LOW if self.invert else 0)
+                request.eventflags = GPIOEVENT_REQUEST_BOTH_EDGES
+                request.consumer_label = b"gpio.py capture"
+                fcntl.ioctl(chipfd, GPIO_GET_LINEEVENT_IOCTL, request, True)
+                fds.append(request.fd)
+                fcntl.ioctl(request.fd, GPIOHANDLE_GET_LINE_VALUES_IOCTL, data, True)
+                row[n] = data.values[0]
+            if not self._record(_event_clock()(), row, duration, trigger): return
+            index = dict((fd, n) for n, fd in enumerate(fds))
+            poller = select.poll()
+            for fd in fds: poller.register(fd, select.POLLIN)
+            while self.running:
+                ready = poller.poll(100)
+                if not ready: continue
+                # drain every ready line, then record edges in time order
+                edges = []
+                for fd, flags in ready:
+                    events = numpy.frombuffer(os.read(fd, 16 * event.itemsize), dtype=event)
+                    edges += [(e["timestamp"], index[fd], e["id"] == GPIOEVENT_EVENT_RISING_EDGE) for e in events]
+                for timestamp, n, rising in sorted(edges):
+                    row[n] = rising
+                    if not self._record(int(timestamp), row, duration, trigger): return
+        finally:
+            for fd in fds: os.close(fd)
+
+    # Write the captured samples to path as a Value Change Dump, for waveform
+    # viewers. names is a list of signal names, default "gpio<chip>_<line>".
+    def vcd(self, path, names=None):
+        timestamps, states = self.result()
+        names = names or ["gpio%d_%d" % (self.chip, line) for line in self.lines]
+        ids = [chr(33 + n) for n in range(len(self.lines))]
+        with open(path, "w") as f:
+            f.write("$timescale 1ns $end\n$scope module gpio $end\n")
+            for i, name in zip(ids, names): f.write("$var wire 1 %s %s $end\n" % (i, name))
+            f.write("$upscope $end\n$enddefinitions $end\n")
+            if not len(timestamps): return
+            start = timestamps[0]
+            previous = None
+            for t, row in zip(timestamps, states):
+                changes = [i for n, i in enumerate(ids) if previous is None or row[n] != previous[n]]
+                if not changes: continue
+                f.write("#%d\n" % (t - start))
+                if previous is None: f.write("$dumpvars\n")
+                for n, i in enumerate(ids):
+                    if i in changes: f.write("%d%s\n" % (row[n], i))
+                if previous is None: f.write("$end\n")
+                previous = row
 
 if __name__ == "__main__":
 
@@ -0,0 +1,169 @@
+# Choose the fastest available gpio implementation for each line.
+
+# gpio() returns a gpio.py object, using the /dev/gpiochipX character device,
+# if the kernel provides it, else a gpio_sysfs.py object. Both have the same
+# ABI, e.g.:
+#
+#   g = gpio_auto.gpio(5, output=True)
+#   g.set_output(1)
+#
+# The character device releases a line when its file is closed, i.e. at
+# program exit, while sysfs gpios can persist. So for persistent=True lines on
+# the character device, a holder process is forked at exit which inherits the
+# line's file and keeps it open, retaining its state without a glitch, and
+# records its pid and the line's configuration in a pidfile in HOLDERS. The
+# next gpio() for that line stops the holder and takes the line back, and any
+# option given as None takes the held value. Holders are listed by holders()
+# and stopped by release(). Without a character device, persistent lines use
+# sysfs.
+#
+# Lines are handed to holders by an atexit handler, so only when Python exits
+# normally, including on SIGINT. If SIGTERM or SIGHUP has its default action
+# when the first persistent line is created from the main thread, a handler
+# which exits normally is installed for it. A program killed by SIGKILL or
+# another signal, crashing, or calling os._exit() leaves no holder, and the
+# kernel releases its lines.
+#
+# chip is the /dev/gpiochipX number, which is assumed to be the sysfs chip
+# index if falling back to sysfs.
+
+from __future__ import print_function
+import os, sys, time, errno, signal, atexit, tempfile
+
+try:
+    import gpio as chardev
+    import gpio_sysfs as sysfs
+except:
+    from . import gpio as chardev
+    from . import gpio_sysfs as sysfs
+
+HOLDERS = "/run/plio-gpio" if os.access("/run", os.W_OK) else os.path.join(tempfile.gettempdir(), "plio-gpio")
+
+# persistent chardev gpios, handed to holders at exit by handoff(), which is
+# registered with atexit when the first one is created
+handoffs=[]
+registered=False
+
+# return true if chip has a character device
+def available(chip):
+    try: return os.path.exists("/dev/gpiochip%d" % int(chip))
+    except ValueError: return False
+
+def _pidfile(chip, line):
+    return os.path.join(HOLDERS, "gpiochip%d-%d.pid" % (int(chip), line))
+
+# return true if process pid exists
+def _alive(pid):
+    try: os.kill(pid, 0)
+    except OSError as e: return e.errno == errno.EPERM
+    return True
+
+# Return (pid, output, invert, state) from the holder's pidfile, or None if
+# the line isn't held. Stale pidfiles are removed.
+def _held(path):
+    try:
+        with open(path) as f: pid, output, invert, state = map(int, f.readline().split())
+    except (IOError, OSError, ValueError):
+        return None
+    if _alive(pid): return pid, output, bool(invert), bool(state)
+    try: os.unlink(path)
+    except OSError: pass
+    return None
+
+# Return list of (chip, line, pid, output, invert, state) of held lines
+def holders():
+    found = []
+    try: names = sorted(os.listdir(HOLDERS))
+    except OSError: return found
+    for name in names:
+        if not name.startswith("gpiochip") or not name.endswith(".pid"): continue
+        chip, line = map(int, name[8:-4].split("-"))
+        h = _held(os.path.join(HOLDERS, name))
+        if h: found.append((chip, line) + h)
+    return found
+
+# Stop the holder of line on chip, if any, waiting up to timeout seconds for
+# it to release the line. Return the held (output, invert, state), or None.
+def release(line, chip=0, timeout=1.0):
+    path = _pidfile(chip, line)
+    h = _held(path)
+    if h is None: return None
+    pid = h[0]
+    os.kill(pid, signal.SIGTERM)
+    start = time.time()
+    while _alive(pid):
+        try: os.waitpid(pid, os.WNOHANG)       # reap it, if it's our child
+        except OSError: pass
+        if time.time() - start > timeout: raise Exception("Timeout stopping gpio holder %d" % pid)
+        time.sleep(.001)
+    try: os.unlink(path)
+    except OSError: pass
+    return h[1:]
+
+# Fork a process which holds chardev gpio g's line until killed
+def _hold(g):
+    if g.linefd is None: return
+    if not os.path.isdir(HOLDERS): os.makedirs(HOLDERS)
+    path = _pidfile(g.chip, g.line)
+    pid = os.fork()
+    if pid:
+        tmp = "%s.%d" % (path, os.getpid())
+        with open(tmp, "w") as f: f.write("%d %d %d %d\n" % (pid, g.output, g.invert, g.state))
+        os.rename(tmp, path)
+        return
+    # the holder, detached from the terminal with only the line open, exits on
+    # SIGTERM without running the parent's atexit handlers
+    try:
+        os.setsid()
+        for s in (signal.SIGINT, signal.SIGHUP): signal.signal(s, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.closerange(0, g.linefd)
+        os.closerange(g.linefd+1, os.sysconf("SC_OPEN_MAX"))
+        while True: signal.pause()
+    finally:
+        os._exit(0)
+
+# exit normally on a signal, so atexit handlers run
+def _terminate(signum, frame):
+    sys.exit(128 + signum)
+
+# hand persistent lines to holders, called at exit
+def handoff():
+    while handoffs:
+        g = handoffs.pop()
+        try: _hold(g)
+        except Exception as e: print("Can't hold gpio %d.%d: %s" % (g.chip, g.line, e))
+
+# Return a gpio object for line of chip. Options are as for gpio.py, plus:
+#   persistent : True=retain line state after exit, False=release it, None=the
+#                backend's default, i.e. False on the character device and
+#                True on sysfs (default None)
+# output, invert and state of None (the default) take the values of a held
+# line, or else their defaults on the character device, or else are unchanged
+# on sysfs.
+def gpio(line, chip=0, invert=None, output=None, state=None, edge=0, persistent=None):
+    global registered
+    if available(chip):
+        held = release(line, chip)
+        if held is not None:
+            if output is None: output = held[0]
+            if invert is None: invert = held[1]
+            if state is None: state = held[2]
+        g = chardev.gpio(line, int(chip), invert=bool(invert), output=int(output or 0), state=bool(state), edge=edge)
+        if persistent:
+            if not registered:
+                atexit.register(handoff)
+                for s in (signal.SIGTERM, signal.SIGHUP):
+                    try:
+                        if signal.getsignal(s) == signal.SIG_DFL: signal.signal(s, _terminate)
+                    except ValueError: pass     # not the main thread
+                registered=True
+            handoffs.append(g)
+        return g
+    if edge: raise Exception("No /dev/gpiochip%s, edge detection is not supported" % chip)
+    if persistent is None: return sysfs.gpio(line, chip, invert=invert, output=output, state=state)
+    return sysfs.gpio(line, chip, invert=invert, output=output, state=state, persistent=persistent)
+
+if __name__ == "__main__":
+    for chip, line, pid, output, invert, state in holders():
+        print("gpio %d.%d: held by %d output=%d invert=%s state=%s" % (chip, line, pid, output, invert, state))
@@ -6,39 +6,102 @@ from __future__ import print_function
 import os, re, time, atexit
 
 base="/sys/class/gpio"
-assert os.path.isdir(base)
 
-# delete unpersistent gpios on exit
+# delete unpersistent gpios on exit, registered with atexit when the first one
+# is created
 unpersistent=set()
 def unpersist():
     for g in unpersistent:
         with open(base+"/unexport","w") as f:
             try: f.write("%d" % g)
             except: pass
-atexit.register(unpersist)
-
-# given a gpiochip index, name, or label, return the appropriate "gpiochipXXX" from the base directory.
-def gpiochip(chip):
-
-    gpiochips=[p for p in os.listdir(base) if os.path.isfile(base+"/%s/base" % p)]
-    assert gpiochips
-    # if 'chip' is listed, then use as is
-    if chip in gpiochips: return chip
-    try:
-        # if 'chip' is an int, then ise as a list index
-        chip=int(chip)
-        if len(gpiochips) <= chip: raise Exception("No gpiochip index '%d'" % chip)
+registered=False
+
+# Cached index of gpiochips, a list of (name, base, ngpio, label) tuples
+# sorted numerically by name, i.e. gpiochip11 is before gpiochip101. It's built
+# on first use and rebuilt when the set of gpiochips changes or a lookup
+# misses. Exporting a gpio changes the base directory but not the chips.
+chips=None
+chips_names=None
+def chipindex(refresh=False):
+    global chips, chips_names
+    if not os.path.isdir(base): raise Exception("No %s, kernel does not support sysfs gpio" % base)
+    names=frozenset(p for p in os.listdir(base) if p.startswith("gpiochip"))
+    if chips is None or refresh or names != chips_names:
         def _int(s):
             try: return int(s)
             except: return s
-        # sort numerically, i.e. gpiochip11 is before chipchip101
-        return sorted(gpiochips, key=lambda p:list(map(_int,re.split('(\d)+',p))))[chip]
-    except ValueError:
-        # here, maybe 'chip' is a label
-        for g in gpiochips:
-            with open(base+"/%s/label" % g) as f:
-                if f.readline().strip() == chip: return g
-        raise Exception("No gpiochip label '%s'" % chip);
+        def _read(p):
+            with open(p) as f: return f.readline().strip()
+        index=[]
+        for p in names:
+            if not os.path.isfile(base+"/%s/base" % p): continue
+            index.append((p, int(_read(base+"/%s/base" % p)), int(_read(base+"/%s/ngpio" % p)), _read(base+"/%s/label" % p)))
+        assert index
+        chips=sorted(index, key=lambda c:list(map(_int,re.split('(\d)+',c[0]))))
+        chips_names=names
+    return chips
+
+# given a gpiochip index, name, or label, return the (name, base, ngpio, label) tuple from the chip index
+def chipinfo(chip):
+    for refresh in (False, True):
+        index=chipindex(refresh)
+        # if 'chip' is listed, then use as is
+        for c in index:
+            if c[0] == chip: return c
+        try:
+            # if 'chip' is an int, then use as a list index
+            n=int(chip)
+            if n < len(index): return index[n]
+        except ValueError:
+            # here, maybe 'chip' is a label
+            for c in index:
+                if c[3] == chip: return c
+    try: raise Exception("No gpiochip index '%d'" % int(chip))
+    except ValueError: raise Exception("No gpiochip label '%s'" % chip)
+
+# given a gpiochip index, name, or label, return the appropriate "gpiochipXXX" from the base directory.
+def gpiochip(chip):
+    return chipinfo(chip)[0]
+
+# Seconds taken by the most recent export to become ready, i.e. from writing
+# the export file until every gpioN/value is accessible.
+ready_latency=None
+
+# Export the given absolute gpio numbers if not already exported and wait for
+# sysfs to create their value files, polling for at most timeout seconds. If
+# output, also wait for the value files to be writable.
+def _export(lines, timeout=1.0, output=False):
+    global ready_latency
+    pending=[n for n in lines if not os.path.isdir(base+"/gpio%d" % n)]
+    if not pending: return
+    start=time.time()
+    with open(base+"/export","w") as f:
+        for n in pending:
+            f.write("%d\n" % n)
+            f.flush()
+    # udev may still be adjusting permissions after the directory appears, so
+    # wait until value is actually readable, and writable for outputs. Users
+    # who may only read an input would otherwise always time out.
+    mode=os.R_OK | (os.W_OK if output else 0)
+    while True:
+        pending=[n for n in pending if not os.access(base+"/gpio%d/value" % n, mode)]
+        if not pending: break
+        if time.time()-start > timeout: raise Exception("Timeout exporting gpio %s" % ",".join(map(str, pending)))
+        time.sleep(.001)
+    ready_latency=time.time()-start
+
+# Export multiple 0-based lines of chip "chip" at once, so the wait for sysfs is
+# paid once rather than per line. If output, the lines will be driven, so
+# wait until they are writable. Returns the list of absolute gpio numbers.
+def export_many(lines, chip=0, timeout=1.0, output=False):
+    name, first, ngpio, label = chipinfo(chip)
+    lines=[int(l) for l in lines]
+    for l in lines:
+        if not 0 <= l < ngpio: raise Exception("No line %d on %s" % (l, name))
+    lines=[first+l for l in lines]
+    _export(lines, timeout, output)
+    return lines
 
 class gpio:
     # Open and manipulate gpio "line" of chip "chip". Options are:
@@ -51,18 +114,19 @@ class gpio:
     def __init__(self, line, chip=0, invert=False, output=False, state=False, persistent=True):
         # find the specified gpiochip
         self.gpiochip=gpiochip(chip)
-        # offset the specified line by the gpiochip base
-        with open(base+"/%s/base" % self.gpiochip) as f: self.line=int(line)+int(f.readline())
+        # offset the specified line by the gpiochip base, and export it if needed
+        self.line=export_many([line], self.gpiochip, output=bool(output))[0]
         self.base = base+"/gpio%d" % self.line
-        if not os.path.isdir(self.base):
-            with open(base+"/export","w") as f: f.write("%d\n" % self.line)
-            # Sysfs needs some time to respond? This short delay seems to work but YMMV.
-            time.sleep(.05)
         with open(self.base+"/direction") as f: self.output = f.readline().strip() == 'out'
         with open(self.base+"/active_low") as f: self.invert = bool(int(f.readline()))
         with open(self.base+"/value") as f: self.state=bool(int(f.readline()))
         if persistent: unpersistent.discard(self.line)
-        else: unpersistent.add(self.line)
+        else:
+            global registered
+            if not registered:
+                atexit.register(unpersist)
+                registered=True
+            unpersistent.add(self.line)
         self.configure(invert = invert, output = output, state = state)
 
     # Configure gpio, config options as above but if not specified then are not changed
@@ -1,10 +1,13 @@
 """ Provide access to /dev/i2c-* devices """
 
 from __future__ import print_function
-import os, fcntl
+import os, math, fcntl, collections
 from ctypes import *
 from itertools import count
 
+try: import iostats, deadline
+except: from . import iostats, deadline
+
 # This information from linux/i2c-dev.h and linux/i2c.h
 
 class i2c_msg(Structure):
@@ -28,6 +31,17 @@ I2C_RDWR_IOCTL_MAX_MSGS = 42    # max value of nmsgs
 I2C_RDWR    = 0x0707            # perform combined R/W transfer (one STOP only)
 I2C_RETRIES = 0x0701            # number of times a device address should be polled when not acknowledging
 I2C_TIMEOUT = 0x0702            # set timeout in units of 10 ms
+DEFAULT_TIMEOUT = 100           # the kernel's default adapter timeout, 1 second
+
+# given i2c_msgs, return ordered dict of [messages, bytes written, bytes
+# read] by address, in order of first message, for iostats
+def usage(msgs):
+    u = collections.OrderedDict()
+    for m in msgs:
+        c = u.setdefault(m.addr, [0, 0, 0])
+        c[0] += 1
+        c[2 if m.flags & I2C_M_RD else 1] += m.len
+    return u
 
 # cast given object to a list of ints, works with python 2 or 3, supports int,
 # bytes, str, bytearray, memoryview, tuple (and list of course)
@@ -38,14 +52,22 @@ def blist(data):
     if type(data) is not list: data=list(data)
     return data
 
+# Optional transport backend, see iobackend.py. If set when an i2c object is
+# created, the object does not open /dev/i2c-X itself but passes all transfers
+# to backend.i2c_transfer() and ioctls to backend.i2c_ioctl().
+backend = None
+
 class i2c:
 
     # init i2c controller, note bus == None enables stub operation
     def __init__(self, bus, addr, retries=None, timeout=None):
         assert 0x07 < addr < 0x78 # disallow address ranges 0000xxx and 1111xxx
-        if bus is not None: self.fd=os.open("/dev/i2c-%d" % bus, os.O_RDWR)
+        self.backend = backend
+        if bus is not None and backend is None: self.fd=os.open("/dev/i2c-%d" % bus, os.O_RDWR)
         else: self.fd = None
+        self.bus=bus
         self.addr=addr
+        self.timeout = timeout
         if retries is not None: self.set_retries(retries)
         if timeout is not None: self.set_timeout(timeout)
 
@@ -63,24 +85,53 @@ class i2c:
     # Returns a list of lists of read bytes, or [] if no reads requested.
     def io(self, *specs):
         assert 0 < len(specs) <= I2C_RDWR_IOCTL_MAX_MSGS
+        return self.multi_io((self.addr,)+specs)
+
+    # Perform atomic I2C operations with one or more slave addresses on the
+    # same bus, with a single STOP.
+    #
+    # Each argument is a tuple or list containing a slave address followed by
+    # alternating write and read specifications as for io().
+    #
+    # Returns a list of lists of read bytes from all groups, in order.
+    def multi_io(self, *groups):
         wbufs=[]    # persistent write buffers
         rbufs=[]    # persistent read buffers
         messages=[] # messages to be sent
-        for n in range(0,len(specs)):
-            if specs[n] is None: continue
-            if not n & 1:
-                data = blist(specs[n])
-                size = len(data)
-                wbufs.append(create_string_buffer(bytes(bytearray(data)),size))
-                messages.append(i2c_msg(addr=self.addr, flags=0, len=size, buf=addressof(wbufs[-1])))
-            else:
-                size = int(specs[n])
-                rbufs.append(create_string_buffer(size))
-                messages.append(i2c_msg(addr=self.addr, flags=I2C_M_RD, len=size, buf=addressof(rbufs[-1])))
+        for group in groups:
+            addr=group[0]
+            specs=group[1:]
+            for n in range(0,len(specs)):
+                if specs[n] is None: continue
+                if not n & 1:
+                    data = blist(specs[n])
+                    size = len(data)
+                    wbufs.append(create_string_buffer(bytes(bytearray(data)),size))
+                    messages.append(i2c_msg(addr=addr, flags=0, len=size, buf=addressof(wbufs[-1])))
+                else:
+                    size = int(specs[n])
+                    rbufs.append(create_string_buffer(size))
+                    messages.append(i2c_msg(addr=addr, flags=I2C_M_RD, len=size, buf=addressof(rbufs[-1])))
+        assert 0 < len(messages) <= I2C_RDWR_IOCTL_MAX_MSGS
 
         t = (i2c_msg*len(messages))(*messages)
-        if self.fd is not None:
-            fcntl.ioctl(self.fd, I2C_RDWR, i2c_rdwr_ioctl_data(msgs=addressof(t), nmsgs=len(t)), False)
+        if deadline.enabled:
+            repeatable = len(t) == 1 or all(m.flags & I2C_M_RD for m in t)
+            bound = self._bound if self.backend is None and self.fd is not None else None
+            deadline.call(("i2c", self.bus, t[0].addr), lambda: self._transfer(t, rbufs), repeatable, bound)
+        else: self._transfer(t, rbufs)
+        return [list(bytearray(m.raw)) for m in rbufs]
+
+    # Perform I2C_RDWR with message array t, or pass it to the backend, or
+    # print it if bus == None. rbufs are the read messages' buffers.
+    def _transfer(self, t, rbufs):
+        if self.backend is not None:
+            reads = self.backend.i2c_transfer(self.bus, [(m.addr, m.flags, m.len if m.flags & I2C_M_RD else string_at(m.buf, m.len)) for m in t])
+            for b, r in zip(rbufs, reads): memmove(b, bytes(bytearray(r)), min(len(b), len(r)))
+        elif self.fd is not None:
+            data = i2c_rdwr_ioctl_data(msgs=addressof(t), nmsgs=len(t))
+            if iostats.enabled: iostats.ioctl("i2c", self.bus, usage(t), self.fd, I2C_RDWR, data, False)
+            else: fcntl.ioctl(self.fd, I2C_RDWR, data, False)
         else:
             # bus == None, just dump to stdout
             print("%d messages:" % len(t))
@@ -90,15 +141,33 @@ class i2c:
                 else:
                     print("  %X: write %d from %X" % (m.addr, m.len, m.buf),[hex(b) for b in bytearray(string_at(m.buf, m.len))])
 
-        return [list(bytearray(m.raw)) for m in rbufs]
-
     # set number of retries on NACK
     def set_retries(self, n):
-        fcntl.ioctl(self.fd, I2C_RETRIES, c_uint(n), False)
+        if self.backend is not None: self.backend.i2c_ioctl(self.bus, I2C_RETRIES, n)
+        else: fcntl.ioctl(self.fd, I2C_RETRIES, c_uint(n), False)
+
+    # Set the adapter's timeout to seconds remaining before a deadline, at
+    # least 10 mS, or restore it if None. Called by deadline.call().
+    def _bound(self, seconds):
+        if seconds is not None: self.set_timeout(max(int(math.ceil(seconds * 100)), 1))
+        else:
+            try: self.set_timeout(DEFAULT_TIMEOUT if self.timeout is None else self.timeout)
+            except (IOError, OSError): pass
 
-    # set NACK timeout in tenths of a second
+    # set the adapter's timeout in units of 10 mS
     def set_timeout(self, n):
-        fcntl.ioctl(self.fd, I2C_TIMEOUT, c_uint(n), False)
+        if self.backend is not None: self.backend.i2c_ioctl(self.bus, I2C_TIMEOUT, n)
+        else: fcntl.ioctl(self.fd, I2C_TIMEOUT, c_uint(n), False)
+
+    # close the device, the object can't be used after
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __del__(self):
+        try: self.close()
+        except: pass
 
 
 if __name__ == "__main__":
@@ -0,0 +1,245 @@
+# Driver for 24Cxx-style I2C serial EEPROMs, from 24C01 to 24C512 and similar.
+#
+# Parts up to 2K bytes use a single address byte, with the 24C04/08/16 taking
+# the high address bits as the low bits of the I2C address (i.e. they respond
+# to 2, 4 or 8 consecutive addresses). Larger parts use two address bytes.
+#
+# The mirror class wraps an eeprom as a file-like and bytearray-like object
+# which is read on demand and written back on flush.
+
+from __future__ import print_function
+
+try:
+    import deadline
+    from i2c import i2c, blist
+except:
+    from . import deadline
+    from .i2c import i2c, blist
+
+import io, time, errno
+
+NACKS = (errno.ENXIO, errno.EREMOTEIO)
+MAX_READ = 8192                         # largest message i2c-dev accepts
+
+class eeprom:
+
+    # size is total bytes, page is bytes per write page, write_time is worst
+    # case seconds per page write
+    def __init__(self, bus, addr=0x50, size=256, page=16, write_time=0.005):
+        assert size & (size-1) == 0 and 128 <= size <= 65536
+        assert page & (page-1) == 0 and page <= size
+        self.bus = bus
+        self.addr = addr
+        self.size = size
+        self.page = page
+        self.write_time = write_time
+        self.addrbytes = 2 if size > 2048 else 1
+        self.devs = {}                  # i2c objects, keyed by address
+        self.quick = True               # false if the adapter can't do zero-length writes
+        self.i2c = self._dev(0)[0]
+
+    # return the i2c object and address bytes for given offset
+    def _dev(self, offset):
+        if self.addrbytes == 2:
+            addr, address = self.addr, [offset >> 8, offset & 255]
+        else:
+            addr, address = self.addr + (offset >> 8), [offset & 255]
+        if addr not in self.devs: self.devs[addr] = i2c(bus=self.bus, addr=addr)
+        return self.devs[addr], address
+
+    # read len bytes from offset
+    def read(self, offset, len=1):
+        assert offset >= 0 and len >= 1 and offset+len <= self.size
+        data = []
+        while len:
+            # single address byte parts can't read past a 256 byte block
+            chunk = min(len, MAX_READ) if self.addrbytes == 2 else min(len, 256 - (offset & 255))
+            dev, address = self._dev(offset)
+            data += dev.io(address, chunk)[0]
+            offset += chunk
+            len -= chunk
+        return data
+
+    # The device does not ACK its address during a write cycle, so poll until
+    # it does, or raise the last error after the worst case write time. The
+    # poll is a zero-length write, or a one byte read of the current address if
+    # the adapter can't do zero-length messages. If the adapter reports
+    # something other than a NACK, just wait for the worst case write time.
+    # The NACKs are expected, so they aren't retried by deadline.py.
+    def _wait(self, dev):
+        end = time.time() + self.write_time
+        while True:
+            try:
+                with deadline.probing():
+                    if self.quick: dev.io([])
+                    else: dev.io(None, 1)
+                return
+            except (IOError, OSError) as e:
+                if self.quick and e.errno in (errno.EOPNOTSUPP, errno.EINVAL):
+                    self.quick = False
+                    continue
+                if e.errno not in NACKS:
+                    time.sleep(max(end - time.time(), 0))
+                    return
+                if time.time() > end: raise
+
+    # write data within a single page and wait for completion
+    def _write_page(self, offset, data):
+        dev, address = self._dev(offset)
+        dev.io(address+data)
+        self._wait(dev)
+
+    # write data to offset, pages which already contain the data are skipped
+    # return tuple of number of pages (skipped, written)
+    def write(self, offset, data):
+        data = blist(data)              # convert data to list of ints
+        assert offset >= 0 and len(data) >= 1 and offset + len(data) <= self.size
+        current = self.read(offset, len(data))
+        skipped = written = 0
+        while data:
+            chunk = self.page - (offset % self.page)  # constrain to page
+            if current[0:chunk] == data[0:chunk]:
+                skipped += 1
+            else:
+                self._write_page(offset, data[0:chunk])
+                written += 1
+            del data[0:chunk]
+            del current[0:chunk]
+            offset += chunk
+        return skipped, written
+
+    # dump EEPROM contents to stdout
+    def dump(self):
+        data = self.read(0, self.size)
+        for ofs in range(0, self.size, 32):
+            print("%04X:" % ofs if self.size > 256 else "%02X:" % ofs, "%02X "*32 % tuple(data[ofs:ofs+32]))
+
+    # return a mirror of this device
+    def mirror(self): return mirror(self)
+
+# In-memory mirror of an eeprom. Pages are read on first access, in bursts, and
+# modified pages are written back by flush() or close(). Supports the usual
+# raw file operations (read, readinto, write, seek, tell), and indexing and
+# slicing like a bytearray. Does not see changes made directly to the device.
+class mirror(io.RawIOBase):
+
+    def __init__(self, eeprom):
+        io.RawIOBase.__init__(self)
+        self.eeprom = eeprom
+        self.page = eeprom.page
+        self.data = bytearray(eeprom.size)  # current contents
+        self.clean = bytearray(eeprom.size) # contents of device
+        self.loaded = set()                 # indices of pages in data
+        self.known = set()                  # indices of pages whose device contents are in clean
+        self.dirty = set()                  # indices of pages changed since flush
+        self.pos = 0
+
+    def __len__(self): return len(self.data)
+    def readable(self): return True
+    def writable(self): return True
+    def seekable(self): return True
+
+    # read any pages in the range [start, end) not yet loaded, coalescing
+    # adjacent pages into a single read
+    def _load(self, start, end):
+        first, last = start // self.page, (end - 1) // self.page
+        n = first
+        while n <= last:
+            if n in self.loaded:
+                n += 1
+                continue
+            m = n
+            while m + 1 <= last and m + 1 not in self.loaded: m += 1
+            offset, size = n * self.page, (m + 1 - n) * self.page
+            self.data[offset:offset+size] = self.clean[offset:offset+size] = bytearray(self.eeprom.read(offset, size))
+            self.loaded.update(range(n, m + 1))
+            self.known.update(range(n, m + 1))
+            n = m + 1
+
+    # return contents of [start, end)
+    def _get(self, start, end):
+        if start >= end: return bytearray()
+        self._load(start, end)
+        return self.data[start:end]
+
+    # set contents at start, load partially overwritten pages first
+    def _set(self, start, data):
+        end = start + len(data)
+        assert 0 <= start and end <= len(self.data)
+        if start >= end: return
+        if start % self.page: self._load(start, start + 1)
+        if end % self.page: self._load(end - 1, end)
+        self.data[start:end] = data
+        first, last = start // self.page, (end - 1) // self.page
+        self.loaded.update(range(first, last + 1))
+        self.dirty.update(range(first, last + 1))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self.data))
+            data = self._get(start, stop) if step == 1 else bytearray(self[i] for i in range(start, stop, step))
+            return data
+        if index < 0: index += len(self.data)
+        if not 0 <= index < len(self.data): raise IndexError("mirror index out of range")
+        return self._get(index, index + 1)[0]
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self.data))
+            value = bytearray(blist(value))
+            assert step == 1 and len(value) == stop - start
+            self._set(start, value)
+        else:
+            if index < 0: index += len(self.data)
+            if not 0 <= index < len(self.data): raise IndexError("mirror index out of range")
+            self._set(index, bytearray([value]))
+
+    def readinto(self, b):
+        data = self._get(self.pos, min(self.pos + len(b), len(self.data)))
+        b[0:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    # write as much of b as fits before the end of the device, raise if none does
+    def write(self, b):
+        data = bytearray(b)[0:max(len(self.data) - self.pos, 0)]
+        if not data:
+            if len(b): raise IOError(errno.ENOSPC, "Write past end of EEPROM")
+            return 0
+        self._set(self.pos, data)
+        self.pos += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR: offset += self.pos
+        elif whence == io.SEEK_END: offset += len(self.data)
+        assert offset >= 0
+        self.pos = offset
+        return self.pos
+
+    def tell(self): return self.pos
+
+    # write dirty pages that differ from the device, or which were overwritten
+    # without being read so the device contents aren't known
+    def flush(self):
+        for n in sorted(self.dirty):
+            offset = n * self.page
+            data = self.data[offset:offset+self.page]
+            if n not in self.known or data != self.clean[offset:offset+self.page]:
+                self.eeprom._write_page(offset, list(data))
+                self.clean[offset:offset+self.page] = data
+                self.known.add(n)
+        self.dirty = set()
+
+if __name__ == "__main__":
+
+    # 24C256 at address 0x50 on bus 1, 32K bytes with 64-byte pages
+    m = eeprom(bus=1, addr=0x50, size=32768, page=64)
+
+    # write a record via the mirror
+    with m.mirror() as f:
+        f.seek(0x100)
+        f.write(b"Hello there, Mister Bill!")
+        f[0] = 0x5A
+
+    print(bytes(m.mirror()[0x100:0x119]))
@@ -1,10 +1,32 @@
 # Driver for Analog Devices AD2420 A2B Transciever
 # At this time just provides basic linkages to master, slave, and peripheral i2c interfaces.
+# The master's NODEADR and each slave's CHIP register are cached, so repeated
+# access to the same slave or peripheral does not rewrite them. regs() returns
+# a regmap of the master's or a slave's registers, see regmap.py.
+# discover() walks the bus and returns a table of nodes, snapshot() reads a
+# node's status and error counters in a single transaction. ad2420_events
+# services the IRQ pin, dispatching interrupts to callbacks and handling
+# mailbox traffic.
 
 from __future__ import print_function
+import sys, time, threading, collections
 
-try: from i2c import i2c
-except: from .i2c import i2c
+try:
+    from i2c import i2c, blist
+    from regmap import regmap, register
+except:
+    from .i2c import i2c, blist
+    from .regmap import regmap, register
+
+# io() for the registers of a node, the master if node is None, for regmap
+class _node:
+    def __init__(self, chip, node):
+        self.chip = chip
+        self.node = node
+
+    def io(self, *specs):
+        if self.node is None: return self.chip.master_io(*specs)
+        return self.chip.slave_io(self.node, *specs)
 
 class ad2420:
 
@@ -70,7 +92,7 @@ class ad2420:
     I2STEST         = 0x53
     RAISE           = 0x54
     GENERR          = 0x55
-    I2SRATE         = 0x56
+    I2SRRATE        = 0x56
     I2SRRCTL        = 0x57
     I2SRRSOFFS      = 0x58
     CLK1CFG         = 0x59
@@ -118,31 +140,339 @@ class ad2420:
     MBOX1B2         = 0x9A
     MBOX1B3         = 0x9B
 
-    def __init__(self, bus, addr=0x68):
+    # Register map, see regmap.py, the same for master and slaves. Status,
+    # interrupt, error count, GPIO data and mailbox registers are changed by
+    # the device so are volatile, as are CHIP and NODEADR, which are cached by
+    # the driver itself, and CONTROL and DISCVRY, since writing them is an
+    # action (CONTROL has self-clearing bits, DISCVRY starts discovery).
+    REGISTERS = tuple(register(name, reg) for name, reg in (
+            ("SWCTL", SWCTL), ("BCDNSLOTS", BCDNSLOTS), ("LDNSLOTS", LDNSLOTS), ("LUPSLOTS", LUPSLOTS),
+            ("DNSLOTS", DNSLOTS), ("UPSLOTS", UPSLOTS), ("RESPCYCS", RESPCYCS), ("SLOTFMT", SLOTFMT),
+            ("DATCTL", DATCTL), ("INTMSK0", INTMSK0), ("INTMSK1", INTMSK1),
+            ("INTMSK2", INTMSK2), ("BECCTL", BECCTL), ("TESTMODE", TESTMODE), ("TXACTL", TXACTL), ("TXBCTL", TXBCTL),
+            ("LINTTYPE", LINTTYPE), ("I2CCFG", I2CCFG), ("PLLCTL", PLLCTL), ("I2SGCFG", I2SGCFG), ("I2SCFG", I2SCFG),
+            ("I2SRATE", I2SRATE), ("I2STXOFFSET", I2STXOFFSET), ("I2SRXOFFSET", I2SRXOFFSET),
+            ("SYNCOFFSET", SYNCOFFSET), ("PDMCTL", PDMCTL), ("ERRMGMT", ERRMGMT), ("GPIOOEN", GPIOOEN),
+            ("GPIOIEN", GPIOIEN), ("PINTEN", PINTEN), ("PINTINV", PINTINV), ("PINCFG", PINCFG), ("I2STEST", I2STEST),
+            ("RAISE", RAISE), ("GENERR", GENERR), ("I2SRRATE", I2SRRATE), ("I2SRRCTL", I2SRRCTL),
+            ("I2SRRSOFFS", I2SRRSOFFS), ("CLK1CFG", CLK1CFG), ("CLK2CFG", CLK2CFG), ("BMMCFG", BMMCFG),
+            ("SUSCFG", SUSCFG), ("PDMCTL2", PDMCTL2), ("UPMASK0", UPMASK0), ("UPMASK1", UPMASK1), ("UPMASK2", UPMASK2),
+            ("UPMASK3", UPMASK3), ("UPOFFSET", UPOFFSET), ("DNMASK0", DNMASK0), ("DNMASK1", DNMASK1),
+            ("DNMASK2", DNMASK2), ("DNMASK3", DNMASK3), ("DNOFFSET", DNOFFSET), ("GPIODEN", GPIODEN),
+            ("GPIOD0MSK", GPIOD0MSK), ("GPIOD1MSK", GPIOD1MSK), ("GPIOD2MSK", GPIOD2MSK), ("GPIOD3MSK", GPIOD3MSK),
+            ("GPIOD4MSK", GPIOD4MSK), ("GPIOD5MSK", GPIOD5MSK), ("GPIOD6MSK", GPIOD6MSK), ("GPIOD7MSK", GPIOD7MSK),
+            ("GPIODDAT", GPIODDAT), ("GPIODINV", GPIODINV), ("MBOX0CTL", MBOX0CTL), ("MBOX1CTL", MBOX1CTL)
+        )) + tuple(register(name, reg, access="r") for name, reg in (
+            ("VENDOR", VENDOR), ("PRODUCT", PRODUCT), ("VERSION", VERSION), ("CAPABILITY", CAPABILITY),
+            ("CHIPID0", CHIPID0), ("CHIPID1", CHIPID1), ("CHIPID2", CHIPID2), ("CHIPID3", CHIPID3),
+            ("CHIPID4", CHIPID4), ("CHIPID5", CHIPID5)
+        )) + tuple(register(name, reg, volatile=True) for name, reg in (
+            ("CHIP", CHIP), ("NODEADR", NODEADR), ("CONTROL", CONTROL), ("DISCVRY", DISCVRY), ("INTPND0", INTPND0),
+            ("INTPND1", INTPND1), ("INTPND2", INTPND2), ("BECNT", BECNT), ("ERRCNT0", ERRCNT0), ("ERRCNT1", ERRCNT1),
+            ("ERRCNT2", ERRCNT2), ("ERRCNT3", ERRCNT3), ("GPIODAT", GPIODAT), ("MBOX0STAT", MBOX0STAT),
+            ("MBOX0B0", MBOX0B0), ("MBOX0B1", MBOX0B1), ("MBOX0B2", MBOX0B2), ("MBOX0B3", MBOX0B3),
+            ("MBOX1STAT", MBOX1STAT), ("MBOX1B0", MBOX1B0), ("MBOX1B1", MBOX1B1), ("MBOX1B2", MBOX1B2),
+            ("MBOX1B3", MBOX1B3)
+        )) + tuple(register(name, reg, access="r", volatile=True) for name, reg in (
+            ("SWSTAT", SWSTAT), ("INTSTAT", INTSTAT), ("INTSRC", INTSRC), ("INTTYPE", INTTYPE), ("NODE", NODE),
+            ("DISCSTAT", DISCSTAT), ("GPIOIN", GPIOIN)
+        )) + tuple(register(name, reg, access="w", volatile=True) for name, reg in (
+            ("GPIODATSET", GPIODATSET), ("GPIODATCLR", GPIODATCLR)
+        ))
+
+    # If combine is true, addressing writes to the master are sent in the same
+    # I2C_RDWR transaction as the following bus access, otherwise separately.
+    def __init__(self, bus, addr=0x68, combine=True):
         self.i2cbase = i2c(bus=bus, addr=addr)          # The base address is for talking to master
         self.i2cbus = i2c(bus=bus, addr=addr+1)         # The bus address is for talking to selected slave, via the master
+        self.combine = combine
+        self.lock = threading.RLock()                   # serializes access by multiple threads, e.g. ad2420_events
+        self.invalidate()
+
+    # Forget the cached master NODEADR and slave CHIP registers, so they are
+    # rewritten on next use. Call this if they are changed behind our back, or
+    # the bus is reset or rediscovered.
+    def invalidate(self):
+        self.nodeadr = None                             # last value written to master NODEADR
+        self.chip = {}                                  # last value written to each slave's CHIP, by slave
+        self.maps = {}                                  # regmaps by node, None for the master
+
+    # Return the regmap of given slave node's registers, or the master's if
+    # node is None. Its cache is dropped by invalidate(). Use it with lock held
+    # if other threads may access the chip.
+    def regs(self, node=None):
+        with self.lock:
+            m = self.maps.get(node)
+            if m is None: m = self.maps[node] = regmap(_node(self, node), self.REGISTERS)
+            return m
+
+    # Return true if any write spec writes register reg
+    @staticmethod
+    def _writes(specs, reg):
+        for spec in specs[0::2]:
+            if spec is None: continue
+            data = blist(spec)
+            if data and data[0] <= reg < data[0] + len(data) - 1: return True
+        return False
+
+    # Return list of multi_io groups needed to set the master's NODEADR to value
+    def _nodeadr(self, value):
+        if self.nodeadr == value: return []
+        self.nodeadr = value
+        return [(self.i2cbase.addr, [self.NODEADR, value])]
+
+    # Send addressing groups then specs to the bus address. Cached state is
+    # discarded if anything goes wrong.
+    def _bus_io(self, groups, specs):
+        try:
+            if self.combine:
+                return self.i2cbus.multi_io(*(groups + [(self.i2cbus.addr,) + specs]))
+            for group in groups: self.i2cbus.multi_io(group)
+            return self.i2cbus.io(*specs)
+        except:
+            self.invalidate()
+            raise
 
     # Perform I2C transaction(s) with the master device
     def master_io(self, *specs):
-        return self.i2cbase.io(*specs)                  # deliver to the base address
+        with self.lock:
+            if self._writes(specs, self.NODEADR): self.nodeadr = None
+            return self.i2cbase.io(*specs)              # deliver to the base address
 
     # Perform I2C transactions with slave device
     def slave_io(self, slave, *specs):
         assert(slave <= 15)
-        self.master_io([self.NODEADR, slave])           # first set the master's node address
-        return self.i2cbus.io(*specs)                   # then deliver to the bus interface
+        with self.lock:
+            if self._writes(specs, self.CHIP): self.chip.pop(slave, None)
+            return self._bus_io(self._nodeadr(slave), specs) # set the master's node address if needed, then deliver to the bus interface
 
     # Perform I2C transactions with a slave's peripheral device
     def peripheral_io(self, slave, peripheral, *specs):
+        assert(slave <= 15)
         assert(peripheral <= 127)
-        self.slave_io(slave, [self.CHIP, peripheral])   # set the slave's chip address
-        self.master_io([self.NODEADR, slave | 0x20])    # then set the master's PERI bit
-        return self.i2cbus.io(*specs)                   # deliver to the bus interface
+        with self.lock:
+            groups = []
+            if self.chip.get(slave) != peripheral:
+                groups += self._nodeadr(slave)          # address the slave
+                groups.append((self.i2cbus.addr, [self.CHIP, peripheral])) # set the slave's chip address
+                self.chip[slave] = peripheral
+            groups += self._nodeadr(slave | 0x20)       # then set the master's PERI bit
+            return self._bus_io(groups, specs)          # deliver to the bus interface
+
+    # INTTYPE values of interest
+    DSCDONE         = 0x18                          # discovery done
+
+    # Registers read by snapshot(). INTTYPE is excluded since reading it clears the interrupt.
+    SNAPSHOT = ("SWSTAT", "INTSTAT", "INTSRC", "INTPND0", "INTPND1", "INTPND2", "BECCTL", "BECNT",
+                "ERRCNT0", "ERRCNT1", "ERRCNT2", "ERRCNT3", "NODE", "DISCSTAT")
+
+    # Return dict of SNAPSHOT register values for given slave node, or the
+    # master if node is None, all read in one transaction.
+    def snapshot(self, node=None):
+        with self.lock: return dict(zip(self.SNAPSHOT, self.regs(node).read(*self.SNAPSHOT)))
+
+    # Poll the master's INTSTAT until IRQ is set, then return (INTSRC,
+    # INTTYPE). Return None on timeout. The interval between polls starts at
+    # 100 uS and doubles up to 5 mS, so a long wait doesn't hog the bus.
+    def _poll_irq(self, timeout):
+        deadline = time.time() + timeout
+        delay = 0.0001
+        while not self.regs().read("INTSTAT")[0] & 1:
+            if time.time() > deadline: return None
+            time.sleep(min(delay, max(deadline - time.time(), 0)))
+            delay = min(delay * 2, 0.005)
+        return tuple(self.regs().read("INTSRC", "INTTYPE"))
+
+    # Return dict of identity registers for given slave node, or the master if
+    # node is None.
+    def _identify(self, node=None):
+        values = self.regs(node).read("VENDOR", "PRODUCT", "VERSION", "CAPABILITY", "CHIPID0", "CHIPID1", "CHIPID2", "CHIPID3", "CHIPID4", "CHIPID5")
+        vendor, product, version, capability = values[:4]
+        return {"node": node, "vendor": vendor, "product": product, "version": version, "capability": capability, "chipid": values[4:]}
+
+    # Discover slave nodes one at a time, starting from the master. For node n
+    # DISCVRY is set to respcycs - step*n, this depends on the cable lengths and
+    # slot configuration, see the AD242x technical reference. Discovery stops
+    # at max_nodes, or when a node does not respond within timeout seconds, or
+    # on any other interrupt. Returns a list of dicts as from _identify(), the
+    # first is the master.
+    def discover(self, respcycs=0x40, step=4, max_nodes=16, timeout=0.1):
+        with self.lock: return self._discover(respcycs, step, max_nodes, timeout)
+
+    def _discover(self, respcycs, step, max_nodes, timeout):
+        self.invalidate()
+        nodes = [self._identify()]
+        master = self.regs()
+        while master.read("INTSTAT")[0] & 1:
+            master.read("INTSRC", "INTTYPE")                # discard stale interrupts
+        for node in range(max_nodes):
+            # enable the switch of the last node found, then discover the next
+            self.regs(node - 1 if node else None).write("SWCTL", 0x01)
+            master.write("DISCVRY", respcycs - step * node)
+            irq = self._poll_irq(timeout)
+            if irq is None or irq[1] != self.DSCDONE: break
+            nodes.append(self._identify(node))
+        return nodes
+
+# An interrupt event, node is None for the master. type is the INTTYPE value and
+# name is from ad2420_events.INTTYPES, or None if unknown.
+event = collections.namedtuple("event", "timestamp node type name")
+
+# Interrupt-driven event service for an ad2420 master. irq is a gpio.py gpio
+# connected to the IRQ pin, configured as an input with edge detection on the
+# asserting edge. Each edge causes INTSTAT, INTSRC and INTTYPE to be read in a
+# single burst (reading INTTYPE clears the interrupt) and the resulting event
+# to be passed to callbacks registered with on(). Also provides buffered,
+# non-blocking mailbox transfers to and from slave nodes, MBOX0 carries
+# messages to the slave and MBOX1 messages from it, each 4 bytes. A node's
+# mailboxes are enabled, with MB0EMPTY and MB1FULL interrupts, when it's
+# passed to start() or first sent to. Should an interrupt be lost, MBOX0STAT
+# of nodes with a full MBOX0 is also polled while the IRQ pin is idle.
+class ad2420_events:
+
+    # INTTYPE values
+    INTTYPES = {
+        0x00: "HDCNTERR", 0x01: "DDERR", 0x02: "CRCERR", 0x03: "DPERR", 0x04: "BECOVF", 0x05: "SRFERR",
+        0x06: "SRFCRCERR", 0x09: "PWRERR", 0x0A: "PWRERR", 0x0B: "PWRERR", 0x0C: "PWRERR", 0x0D: "PWRERR",
+        0x0F: "PWRERR", 0x10: "IO0PND", 0x11: "IO1PND", 0x12: "IO2PND", 0x13: "IO3PND", 0x14: "IO4PND",
+        0x15: "IO5PND", 0x16: "IO6PND", 0x17: "IO7PND", 0x18: "DSCDONE", 0x19: "I2CERR", 0x1A: "ICRCERR",
+        0x29: "PWRERR", 0x2A: "PWRERR", 0x30: "MB0FULL", 0x31: "MB0EMPTY", 0x32: "MB1FULL", 0x33: "MB1EMPTY",
+        0x80: "IRQMSGERR", 0xFC: "STARTUPERR", 0xFD: "SLVINTTYPEERR", 0xFE: "STANDBYDONE", 0xFF: "MSTRRUNNING",
+    }
+    MB0EMPTY = 0x31
+    MB1FULL = 0x32
+
+    # MBOXnCTL bits
+    MBEN = 0x01                                 # mailbox enabled
+    MBTRX = 0x02                                # 1 = transmits to master, 0 = receives from master
+    MBFIEN = 0x10                               # full interrupt enable
+    MBEIEN = 0x20                               # empty interrupt enable
+    MBLEN4 = 3 << 6                             # LEN field, message length - 1
+
+    # MBOX0CTL: enabled, receives from master, 4 bytes, empty interrupt
+    # MBOX1CTL: enabled, transmits to master, 4 bytes, full interrupt
+    MBOX0CTL = MBLEN4 | MBEIEN | MBEN           # 0xE1
+    MBOX1CTL = MBLEN4 | MBFIEN | MBTRX | MBEN   # 0xD3
+    SLVIRQEN = 0x01                             # in master's INTMSK2
+
+    def __init__(self, chip, irq):
+        self.chip = chip
+        self.irq = irq
+        self.callbacks = []                     # list of (inttype, callback)
+        self.outbox = {}                        # deque of pending MBOX0 messages, by node
+        self.inbox = {}                         # deque of received MBOX1 messages, by node
+        self.busy = set()                       # nodes whose MBOX0 is full
+        self.mailboxes = set()                  # nodes whose mailboxes are enabled
+        self.thread = None
+        self.running = False
+
+    # Register callback(event) for given INTTYPE, or for all events if None.
+    # Callbacks are called from the service thread.
+    def on(self, inttype, callback):
+        self.callbacks.append((inttype, callback))
+
+    # Enable node's mailboxes and their interrupts, and slave interrupts on
+    # the master
+    def _mailbox(self, node):
+        with self.chip.lock:
+            if node in self.mailboxes: return
+            if not self.mailboxes:
+                self.chip.regs().update("INTMSK2", self.SLVIRQEN, self.SLVIRQEN)
+            with self.chip.regs(node).batch() as regs:
+                regs.write("MBOX0CTL", self.MBOX0CTL)
+                regs.write("MBOX1CTL", self.MBOX1CTL)
+            self.mailboxes.add(node)
+
+    # Read and dispatch all pending interrupts, return number of events.
+    def service(self):
+        count = 0
+        while True:
+            with self.chip.lock:
+                stat, src, inttype = self.chip.regs().read("INTSTAT", "INTSRC", "INTTYPE")
+                if not stat & 1: return count
+                node = None if src & 0x80 else src & 0x0F
+                e = event(time.time(), node, inttype, self.INTTYPES.get(inttype))
+                count += 1
+                if node is not None:
+                    if inttype == self.MB0EMPTY:
+                        self.busy.discard(node)
+                        self._send(node)
+                    elif inttype == self.MB1FULL:
+                        message = self.chip.regs(node).read("MBOX1B0", "MBOX1B1", "MBOX1B2", "MBOX1B3")
+                        self.inbox.setdefault(node, collections.deque()).append(message)
+            for t, callback in self.callbacks:
+                if t is None or t == inttype:
+                    try: callback(e)
+                    except Exception as x: print("ad2420_events: callback for %r failed: %r" % (e, x), file=sys.stderr)
+
+    # Check MBOX0STAT of nodes with a full MBOX0, send the next message to
+    # those which have emptied
+    def _poll(self):
+        for node in list(self.busy):
+            with self.chip.lock:
+                if self.chip.regs(node).read("MBOX0STAT")[0] & 0x02:
+                    self.busy.discard(node)
+                    self._send(node)
+
+    # Write next queued message to node's MBOX0, if it's not full
+    def _send(self, node):
+        with self.chip.lock:
+            queue = self.outbox.get(node)
+            if queue and node not in self.busy:
+                with self.chip.regs(node).batch() as regs:
+                    for n, b in enumerate(queue.popleft()): regs.write("MBOX0B%d" % n, b)
+                self.busy.add(node)
+
+    # Queue 4-byte message for node's MBOX0, it's sent when the mailbox is empty
+    def send(self, node, data):
+        data = blist(data)
+        assert len(data) == 4
+        self._mailbox(node)
+        self.outbox.setdefault(node, collections.deque()).append(data)
+        self._send(node)
+
+    # Return oldest message received from node's MBOX1, or None
+    def recv(self, node):
+        queue = self.inbox.get(node)
+        return queue.popleft() if queue else None
+
+    # Service interrupts until stopped. Errors are reported and the service
+    # carries on.
+    def _run(self):
+        first = True
+        while self.running:
+            try:
+                if first or self.irq.wait(0.1) is not None: self.service()  # first catch up with anything already pending
+                else: self._poll()
+                first = False
+            except Exception as x:
+                print("ad2420_events: %r" % (x,), file=sys.stderr)
+                time.sleep(0.1)
+
+    # Start servicing interrupts in a background thread, after enabling the
+    # mailboxes of given nodes
+    def start(self, nodes=()):
+        for node in nodes: self._mailbox(node)
+        if self.thread: return
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # stop the background thread
+    def stop(self):
+        self.running = False
+        if self.thread: self.thread.join()
+        self.thread = None
 
 if __name__ == "__main__":
     chip = ad2420(bus=1, addr=0x6A)
-    vendor, product, version = chip.master_io(ad2420.VENDOR,3)[0]
-    chipid = chip.master_io(ad2420.CHIPID0,6)[0]
+    regs = chip.regs()
+    vendor, product, version = regs.read("VENDOR", "PRODUCT", "VERSION")
+    chipid = regs.read("CHIPID0", "CHIPID1", "CHIPID2", "CHIPID3", "CHIPID4", "CHIPID5")
     print("AD24%02X, vendor 0x%02X, version 0x%02X, id %s" % (product, vendor, version, ''.join("%02X" % b for b in chipid)))
-    chip.master_io([ad2420.GPIOOEN,2])                  # set gpio01 low
-    chip.master_io([ad2420.GPIODATCLR, 2])
+    regs.write("GPIOOEN", 2)                            # set gpio01 low
+    regs.write("GPIODATCLR", 2)
+    for node in chip.discover():
+        print(node)
+        print(chip.snapshot(node["node"]))
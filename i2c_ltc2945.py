@@ -1,5 +1,6 @@
 # Driver for Linear LTC2945 Wide Range Power Monitor. Supports snapshot mode
-# only!
+# conversions, or continuous mode with hardware min/max thresholds which
+# assert the ALERT pin, see thresholds().
 
 # I2C address is based on ADR1 and AR0 pins:
 #   ADR1  ADR0 =  address
@@ -15,54 +16,196 @@
 
 from __future__ import print_function
 
-try: from i2c import i2c
-except: from .i2c import i2c
+try:
+    from i2c import i2c
+    from regmap import regmap, register
+except:
+    from .i2c import i2c
+    from .regmap import regmap, register
 
 class ltc2945:
 
     # Registers of interest
     CONTROL     = 0x00
     SENSE_MSB   = 0x14
-    SENSE_MSB   = 0x15
+    SENSE_LSB   = 0x15
     VIN_MSB     = 0x1E
     VIN_LSB     = 0x1F
     ADIN_MSB    = 0x28
     ADIN_LSB    = 0x29
+    ALERT       = 0x01 # enables ALERT pin for each fault bit
+    STATUS      = 0x02 # faults present now
+    FAULT       = 0x03 # faults latched since last cleared
+    FAULT_COR   = 0x04 # same as FAULT, cleared on read
+    POWER       = 0x05 # 24-bit
 
-    def __init__(self, bus, addr=0x6A):
+    # Bits of ALERT, STATUS, FAULT and FAULT_COR, by name
+    FAULTS = {"power_max": 0x80, "power_min": 0x40, "sense_max": 0x20, "sense_min": 0x10,
+              "vin_max": 0x08, "vin_min": 0x04, "adin_max": 0x02, "adin_min": 0x01}
+
+    # Threshold registers, see regmap.py. The device auto-increments, so
+    # adjacent thresholds are written in one burst.
+    REGISTERS = (
+        register("CONTROL",   CONTROL, volatile=True),    # also written directly in snapshot mode
+        register("ALERT",     ALERT, reset=0x00),
+        register("STATUS",    STATUS, access="r", volatile=True),
+        register("FAULT",     FAULT, volatile=True),
+        register("FAULT_COR", FAULT_COR, access="r", volatile=True),
+        register("POWER",     POWER, width=3, access="r", volatile=True),
+        register("POWER_MAX", 0x0E, width=3, reset=0xFFFFFF),
+        register("POWER_MIN", 0x11, width=3, reset=0x000000),
+        register("SENSE",     SENSE_MSB, width=2, access="r", volatile=True),
+        register("SENSE_MAX", 0x1A, width=2, reset=0xFFF0),
+        register("SENSE_MIN", 0x1C, width=2, reset=0x0000),
+        register("VIN",       VIN_MSB, width=2, access="r", volatile=True),
+        register("VIN_MAX",   0x24, width=2, reset=0xFFF0),
+        register("VIN_MIN",   0x26, width=2, reset=0x0000),
+        register("ADIN",      ADIN_MSB, width=2, access="r", volatile=True),
+        register("ADIN_MAX",  0x2E, width=2, reset=0xFFF0),
+        register("ADIN_MIN",  0x30, width=2, reset=0x0000),
+    )
+
+    # For each source 0=delta SENSE, 1=SENSE+, 2=VDD, 3=ADIN, the CONTROL value
+    # to start a snapshot, the result register and the conversion time in
+    # seconds. Control bits:
+    #   0x80 ; 1 = snapshot mode, always set
+    #   0x40 : 0 = input from delta SENSE or VIN, 1 input from ADIN
+    #   0x20 : 0 = input from delta SENSE or ADIN, 1 inputs from Vin
+    #   0x08 : 1 = ADC busy (read only)
+    #   0x04 : 0 = Vin from VDD, 1 = Vin from SENSE+
+    SNAPSHOT    = (0x80, 0xA4, 0xA0, 0xC0)
+    RESULT      = (SENSE_MSB, VIN_MSB, VIN_MSB, ADIN_MSB)
+    CONVERSION  = (0.0333, 0.0022, 0.0022, 0.0022)
+
+    # Volts per step for each source, delta SENSE is 25 uV per step across the
+    # sense resistor
+    SCALE       = (0.000025, 0.025, 0.025, 0.0005)
+
+    # Volts squared per step of POWER, i.e. delta SENSE times VIN, divide by
+    # ohms for watts
+    POWER_SCALE = 0.000025 * 0.025
+
+    # If alert is given, it's a gpio object (e.g. from gpio.py) connected to
+    # the ALERT pin and configured as an input with edge detection on the
+    # asserting edge, see wait_alert().
+    def __init__(self, bus, addr=0x6A, alert=None):
         self.addr = addr
         self.i2c = i2c(bus,addr)
+        self.alert = alert
+        self.regs = regmap(self.i2c, self.REGISTERS)
+
+    # Start conversion from specified source
+    def start(self, source):
+        self.i2c.io([self.CONTROL, self.SNAPSHOT[source]])
+
+    # Return true while a conversion is in progress
+    def busy(self):
+        return bool(self.i2c.io(self.CONTROL,1)[0][0] & 8)
+
+    # Convert two result register bytes to 12-bit value. msb_lsb can also be a
+    # pair of numpy integer arrays, to convert many samples at once.
+    @staticmethod
+    def _12bits(msb_lsb):
+        return msb_lsb[0] << 4 | msb_lsb[1] >> 4
 
     # Trigger conversion from specified source 0=delta SENSE, 1=SENSE+, 2=VDD,
     # 3=ADIN, wait for it to complete, then return 12-bit result
     def convert(self, source, result):
-        # Control bits:
-        #   0x80 ; 1 = snapshot mode, always set
-        #   0x40 : 0 = input from delta SENSE or VIN, 1 input from ADIN
-        #   0x20 : 0 = input from delta SENSE or ADIN, 1 inputs from Vin
-        #   0x04 : 0 = Vin from VDD, 1 = Vin from SENSE+
-        self.i2c.io([self.CONTROL, [0x80, 0xA4, 0xA0, 0xC0][source]])
-        while self.i2c.io(0,1)[0][0] & 4: pass  # spin until conversion complete
-        msb, lsb =self.i2c.io(result,2)[0]      # read result registers
-        return msb << 4 | lsb >> 4              # 12 bits
+        self.start(source)
+        while self.busy(): pass                 # spin until conversion complete
+        return self._12bits(self.i2c.io(result,2)[0]) # read result registers
+
+    # Return a dict of arguments for sampler.add() to sample the given source,
+    # scaled as by the corresponding method below
+    def sampler_spec(self, source, ohms=.02):
+        scale = self.SCALE[source] / (ohms if source == 0 else 1)
+        return {"trigger": lambda: self.start(source), "conversion": self.CONVERSION[source],
+                "dev": self.i2c, "reg": self.RESULT[source], "length": 2,
+                "decode": lambda data: self._12bits(data) * scale}
+
+    # Return dict of cache time-to-live by method name, for ttlcache
+    def ttls(self):
+        return {"i_sense": self.CONVERSION[0], "v_sense": self.CONVERSION[1], "v_vdd": self.CONVERSION[2], "v_adin": self.CONVERSION[3]}
 
     # Measure delta SENSE voltage 0 - 102.375mV aka 25 uV per step. Then derive
     # current assuming nominal 0.02 resistor for range 0 - 5.12 amps.
     def i_sense(self, ohms=.02):
-        v = self.convert(0, self.SENSE_MSB) * 0.000025
+        v = self.convert(0, self.SENSE_MSB) * self.SCALE[0]
         return v / ohms
 
     # Return SENSE+ voltage, 0 to 102.375V volts, aka 25mV per step
     def v_sense(self):
-        return self.convert(1, self.VIN_MSB) * 0.025
+        return self.convert(1, self.VIN_MSB) * self.SCALE[1]
 
     # Return VDD voltage, 0 to 102.375V aka 25mV per step
     def v_vdd(self):
-        return self.convert(2, self.VIN_MSB) * 0.025
+        return self.convert(2, self.VIN_MSB) * self.SCALE[2]
 
     # return ADIN voltage 0 to 2.0475V aka .5 mV per step
     def v_adin(self):
-        return self.convert(3, self.ADIN_MSB) * 0.0005
+        return self.convert(3, self.ADIN_MSB) * self.SCALE[3]
+
+    # Start continuous conversion of all inputs, VIN from SENSE+ or else VDD.
+    # Thresholds are only checked in continuous mode, and the snapshot methods
+    # above leave it.
+    def continuous(self, sense_plus=True):
+        self.regs.write("CONTROL", 0x04 if sense_plus else 0x00)
+
+    # Program hardware thresholds and enable ALERT for them, then start
+    # continuous conversion. Each threshold is a (min, max) pair where either
+    # can be None for no limit. power is in watts, sense in amps through ohms,
+    # vin and adin in volts. Thresholds not given are disabled. Unchanged
+    # values aren't rewritten, and the rest are written in one transaction.
+    def thresholds(self, power=None, sense=None, vin=None, adin=None, ohms=.02, sense_plus=True):
+        scales = {"POWER": self.POWER_SCALE / ohms, "SENSE": self.SCALE[0] / ohms, "VIN": self.SCALE[1], "ADIN": self.SCALE[3]}
+        enable = 0
+        with self.regs.batch():
+            for name, limits in (("POWER", power), ("SENSE", sense), ("VIN", vin), ("ADIN", adin)):
+                lo, hi = limits or (None, None)
+                bits = 24 if name == "POWER" else 12
+                for suffix, value in (("_MIN", lo), ("_MAX", hi)):
+                    if value is None: continue
+                    enable |= self.FAULTS[name.lower() + suffix.lower()]
+                    n = min(max(int(round(value / scales[name])), 0), (1 << bits) - 1)
+                    self.regs.write(name + suffix, n if bits == 24 else n << 4)
+            self.regs.write("ALERT", enable)
+        self.continuous(sense_plus)
+        self.clear()
+
+    # Return dict of the latest continuous mode results, power in watts,
+    # sense in amps through ohms, vin and adin in volts, read in one burst
+    def measure(self, ohms=.02):
+        power, sense, vin, adin = self.regs.read("POWER", "SENSE", "VIN", "ADIN")
+        return {"power": power * self.POWER_SCALE / ohms, "sense": (sense >> 4) * self.SCALE[0] / ohms,
+                "vin": (vin >> 4) * self.SCALE[1], "adin": (adin >> 4) * self.SCALE[3]}
+
+    # Return (status, faults) read in one burst, where status has the FAULTS
+    # bits present now and faults those latched since last cleared. Reading
+    # clears the latched faults, which releases the ALERT pin.
+    def faults(self):
+        status, faults, cor = self.regs.read("STATUS", "FAULT", "FAULT_COR")
+        return status, faults | cor
+
+    # clear latched faults, releasing the ALERT pin
+    def clear(self):
+        self.faults()
+
+    # Return list of FAULTS names set in bits
+    @classmethod
+    def names(cls, bits):
+        return sorted(name for name, bit in cls.FAULTS.items() if bits & bit)
+
+    # Wait up to timeout seconds, or forever if None, for the ALERT pin, then
+    # return (status, faults) as by faults(), which clears it. Returns None on
+    # timeout. The bus is idle while waiting. Since ALERT is level triggered, a
+    # latched fault is returned without waiting.
+    def wait_alert(self, timeout=None):
+        assert self.alert is not None, "No ALERT gpio"
+        status, faults = self.faults()
+        while not faults:
+            if self.alert.wait(timeout) is None: return None
+            status, faults = self.faults()
+        return status, faults
 
 if __name__ == "__main__":
     chip = ltc2945(1, 0x69)
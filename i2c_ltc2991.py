@@ -1,10 +1,17 @@
 # Driver for Linear LTC2991 E/I/T monitor
-# Supports single-ended, differential and temperature reads from all inputs
+# Supports single-ended, differential and temperature reads from all inputs.
+# The chip has no threshold registers or ALERT pin, so limits() are checked in
+# software, against all inputs read in one transaction while converting
+# repeatedly.
 
 from __future__ import print_function
 
-try: from i2c import i2c
-except: from .i2c import i2c
+try:
+    from i2c import i2c
+    from regmap import regmap, register
+except:
+    from .i2c import i2c
+    from .regmap import regmap, register
 
 class ltc2991:
 
@@ -24,34 +31,54 @@ class ltc2991:
     TEMP        = 0x1A # internal temp (aka temp 0)
     VCC         = 0x1C # VCC (aka single-ended V0)
 
+    # Register map, see regmap.py. Only the control registers are cached, the
+    # device auto-increments so they are written in one burst.
+    REGISTERS = (
+        register("TRIGGER",  TRIGGER, volatile=True),     # write channel enables, read busy status
+        register("V1234CTL", V1234CTL),
+        register("V5678CTL", V5678CTL),
+        register("CTL",      CTL),
+    ) + tuple(register(name, reg, width=2, access="r", volatile=True) for name, reg in
+              (("V1_T1", V1_T1), ("V2_D1", V2_D1), ("V3_T2", V3_T2), ("V4_D2", V4_D2), ("V5_T3", V5_T3),
+               ("V6_D3", V6_D3), ("V7_T4", V7_T4), ("V8_D4", V8_D4), ("TEMP", TEMP), ("VCC", VCC)))
+
     def __init__(self, bus, addr=0x48):
         self.addr = addr
         self.i2c = i2c(bus=bus, addr=addr)
-        self.cache = None   # cached control registers
+        self.regs = regmap(self.i2c, self.REGISTERS)
+        self.ranges = {}        # (min, max) volts by single-ended input
+        self.pending = set()    # channels triggered by sampler_spec() and not yet read
 
     # set control registers with three specified values
     # they are cached so only update if needed
     def _control(self, v1234ctl, v5678ctl, ctl):
-        # cache three control registers
-        if self.cache is None:
-            self.cache = self.i2c.io(self.V1234CTL, 3)
-        controls = [v1234ctl, v5678ctl, ctl]
-        if controls != self.cache:
-            self.cache = controls
-            self.i2c.io([self.V1234CTL]+controls)
+        with self.regs.batch():
+            self.regs.write(self.V1234CTL, v1234ctl)
+            self.regs.write(self.V5678CTL, v5678ctl)
+            self.regs.write(self.CTL, ctl)
+
+    # Approximate conversion time in seconds for temperature and voltage channels
+    T_CONVERSION = 0.055
+    V_CONVERSION = 0.0015
+
+    # Trigger channel 0-4. Channel 0 is internal.
+    def _start(self, channel):
+        assert 0 <= channel <= 4
+        self.regs.write(self.TRIGGER, 1<<(channel+3))
 
     # Trigger channel 0-4 and spin until conversion complete. Channel 0 is
     # internal.
     def _trigger(self, channel):
-        assert 0 <= channel <= 4
-        self.i2c.io([self.TRIGGER, 1<<(channel+3)])
-        while self.i2c.io(self.TRIGGER, 1)[0][0] & 4: pass
+        self._start(channel)
+        while self.regs.read(self.TRIGGER)[0] & 4: pass
 
-    # Convert 2-byte sample registers, and uV per step, return voltage.
+    # Convert 2-byte sample registers, and uV per step, return voltage. hi and
+    # lo can also be numpy arrays with at least 16-bit signed integer type, to
+    # convert many samples at once.
     @staticmethod
     def _uV(hi, lo, uV):
         n = ((hi << 8) | lo) & 0x3fff           # actual value in low 14 bits
-        if hi & 0x40: n = -1-(n ^ 0x3fff)       # but invert if signed
+        n = n - ((hi & 0x40) << 8)              # but negative if signed
         return n * (uV / 100000)                # return microvolts
 
     # Return celsius of temperature input 0 through 4, where 0 is internal temperature, 1 is T1, etc.
@@ -61,8 +88,7 @@ class ltc2991:
         self._control(0x66, 0x66, 0x04)         # set controls for kelvin
         self._trigger(input)                    # trigger requested channel
         rreg = [self.TEMP, self.V1_T1, self.V3_T2, self.V5_T3, self.V7_T4][input]
-        hi, lo = self.i2c.io(rreg, 2)[0]        # get two byte result
-        v = ((hi << 8) + lo) & 0x1fff
+        v = self.regs.read(rreg)[0] & 0x1fff    # get two byte result
         kelvin = v // 16
         if eta is not None: kelvin *= (1.004 / eta)
         return kelvin - 273.15                  # return celsius
@@ -71,10 +97,10 @@ class ltc2991:
     def voltage(self, input):
         assert 0 <= input <= 8
         self._control(0x00, 0x00, 0x00)         # set controls for single-ended
-        self._trigger(input+1//2)               # trigger 0->0, 1|2->1, 3|4->2, 5|6->3, 7|8->4
+        self._trigger((input+1)//2)             # trigger 0->0, 1|2->1, 3|4->2, 5|6->3, 7|8->4
         rreg = [self.VCC, self.V1_T1, self.V2_D1, self.V3_T2, self.V4_D2, self.V5_T3, self.V6_D3, self.V7_T4, self.V8_D4][input]
-        hi, lo = self.i2c.io(rreg, 2)[0]        # get two-byte result
-        return self._uV(hi, lo, 305.18)         # 305.18 uV per step
+        v = self.regs.read(rreg)[0]             # get two-byte result
+        return self._uV(v >> 8, v & 0xFF, 305.18)   # 305.18 uV per step
 
     # Get voltage on differential input 1 through 4
     # 1 is V2-V1, 2 is V4-V3, etc.
@@ -83,8 +109,66 @@ class ltc2991:
         self._control(0x11, 0x11, 0x00)         # set controls for differential
         self._trigger(input)                    # trigger the requested channel
         rreg = [self.V2_D1, self.V4_D2, self.V6_D3, self.V8_D4][input-1]
-        hi, lo = self.i2c.io(rreg, 2)[0]        # get two byte result
-        return self._uV(hi, lo, 19.075)         # 19.075 uV per step
+        v = self.regs.read(rreg)[0]             # get two byte result
+        return self._uV(v >> 8, v & 0xFF, 19.075)   # 19.075 uV per step
+
+    # Return dict of cache time-to-live by method name, for ttlcache
+    def ttls(self):
+        return {"temperature": self.T_CONVERSION, "voltage": self.V_CONVERSION, "differential": self.V_CONVERSION}
+
+    # Return a dict of arguments for sampler.add() to sample single-ended
+    # voltage input 0 through 8, as by voltage(). All sampled inputs of a chip
+    # must be the same kind, since the control registers are shared. Writing
+    # TRIGGER restarts conversion of only the enabled channels, so each trigger
+    # enables every channel triggered but not yet read, i.e. all inputs of the
+    # chip due in the same pass, and returns the time to convert them all.
+    def sampler_spec(self, input):
+        assert 0 <= input <= 8
+        channel = (input+1)//2
+        def trigger():
+            self._control(0x00, 0x00, 0x00)
+            self.pending.add(channel)
+            self.regs.write(self.TRIGGER, sum(1<<(c+3) for c in self.pending))
+            return self.V_CONVERSION * len(self.pending)
+        def decode(data):
+            self.pending.discard(channel)
+            return self._uV(data[0], data[1], 305.18)
+        rreg = [self.VCC, self.V1_T1, self.V2_D1, self.V3_T2, self.V4_D2, self.V5_T3, self.V6_D3, self.V7_T4, self.V8_D4][input]
+        return {"trigger": trigger, "conversion": self.V_CONVERSION, "dev": self.i2c, "reg": rreg, "length": 2,
+                "decode": decode}
+
+    # Result registers of single-ended inputs 0 through 8, in address order
+    SINGLE = ("V1_T1", "V2_D1", "V3_T2", "V4_D2", "V5_T3", "V6_D3", "V7_T4", "V8_D4", "VCC")
+
+    # Set limits for single-ended inputs 0 through 8, each a (min, max) pair of
+    # volts where either can be None, then start repeated conversion of all
+    # inputs, single-ended. Inputs not given have no limits.
+    def limits(self, **inputs):
+        ranges = {}
+        for name, limits in inputs.items():
+            input = int(name.lstrip("v"))       # e.g. v3=(1.1, 1.3)
+            assert 0 <= input <= 8
+            ranges[input] = limits
+        self.ranges = ranges
+        self._control(0x00, 0x00, 0x10)         # single-ended, repeated acquisition
+        self.regs.write(self.TRIGGER, 0xF8)     # enable all channels
+
+    # Return dict of voltage by single-ended input 0 through 8, all read in one
+    # transaction, while converting repeatedly as started by limits()
+    def voltages(self):
+        values = self.regs.read(*self.SINGLE)
+        v = dict((n + 1, self._uV(x >> 8, x & 0xFF, 305.18)) for n, x in enumerate(values[:8]))
+        v[0] = self._uV(values[8] >> 8, values[8] & 0xFF, 305.18)
+        return v
+
+    # Return dict of voltage by input for those outside their limits, from
+    # one transaction, empty if none
+    def check(self):
+        out = {}
+        for input, v in self.voltages().items():
+            lo, hi = self.ranges.get(input, (None, None))
+            if (lo is not None and v < lo) or (hi is not None and v > hi): out[input] = v
+        return out
 
 if __name__ == "__main__":
     chip = ltc2991(bus=1, addr=0x48)
@@ -7,8 +7,12 @@
 
 from __future__ import print_function
 
-try: from i2c import i2c
-except: from .i2c import i2c
+try:
+    from i2c import i2c
+    from regmap import regmap, register
+except:
+    from .i2c import i2c
+    from .regmap import regmap, register
 
 class max6639:
 
@@ -34,30 +38,61 @@ class max6639:
     MANUFACTURER            = 0x3E
     REVISION                = 0x3F
 
+    # Register map, see regmap.py. Measurements, status and duty cycle are
+    # changed by the device, as is CONFIG's self-clearing reset bit.
+    REGISTERS = (
+        register("TEMP1",        0x00, access="r", volatile=True),
+        register("TEMP2",        0x01, access="r", volatile=True),
+        register("STATUS",       0x02, access="r", volatile=True),
+        register("MASK",         0x03),
+        register("CONFIG",       0x04, volatile=True),
+        register("XTEMP1",       0x05, access="r", volatile=True),
+        register("XTEMP2",       0x06, access="r", volatile=True),
+        register("ALERT1",       0x08),
+        register("ALERT2",       0x09),
+        register("OLIMIT1",      0x0A),
+        register("OLIMIT2",      0x0B),
+        register("TLIMIT1",      0x0C),
+        register("TLIMIT2",      0x0D),
+        register("CONFIG1_1",    0x10),
+        register("CONFIG2A_1",   0x11),
+        register("CONFIG2B_1",   0x12),
+        register("CONFIG3_1",    0x13),
+        register("CONFIG1_2",    0x14),
+        register("CONFIG2A_2",   0x15),
+        register("CONFIG2B_2",   0x16),
+        register("CONFIG3_2",    0x17),
+        register("TACH1",        0x20, access="r", volatile=True),
+        register("TACH2",        0x21, access="r", volatile=True),
+        register("START_TACH1",  0x22),
+        register("START_TACH2",  0x23),
+        register("PPR1",         0x24),
+        register("PPR2",         0x25),
+        register("DUTY1",        0x26, volatile=True),
+        register("DUTY2",        0x27, volatile=True),
+        register("START_TEMP1",  0x28),
+        register("START_TEMP2",  0x29),
+        register("ID",           0x3D, access="r"),
+        register("MANUFACTURER", 0x3E, access="r"),
+        register("REVISION",     0x3F, access="r"),
+    )
+
     def __init__(self, bus, addr=0x58):
         self.addr = addr
         self.i2c = i2c(bus=bus, addr=addr)
-        self.cache = {}
-
-    # update register with mask and value, and cache it
-    def _register(self, reg, mask, value):
-        if reg not in self.cache: self.cache[reg] = self.i2c.io(reg,1)[0][0]
-        v = (self.cache[reg] & ~mask) | value
-        if v != self.cache[reg]:
-            self.cache[reg] = v
-            self.i2c.io([reg, v])
+        self.regs = regmap(self.i2c, self.REGISTERS, autoinc=False)
 
     # reset the device, possibly enable standby, smb timeout, chip temp for
     # channel 2, and hi frequency PWM
     def reset(self, standby=False, smbto=False, local=False, pwmhi=False):
-        self.i2c.io([0x04, 0x40]) # force reset bit
+        self.regs.write(self.CONFIG, 0x40) # force reset bit
         r=0
         if standby:   r |= 0x80
         if not smbto: r |= 0x20
         if local:     r |= 0x10
         if pwmhi:     r |= 0x08
-        self.i2c.io([0x04,r])
-        self.cache = {}
+        self.regs.write(self.CONFIG, r)
+        self.regs.invalidate()
 
     # Given fan index 1 or 2, set pwm frequency 0-3 (table 9), polarity, rate
     # of change 0-7 (table 5), spinup if fan should start at 100%. Use this
@@ -65,16 +100,19 @@ class max6639:
     def set_fan_config(self, fan, freq=1, polarity=False, roc=0, spinup=True):
         assert 0 <= freq <= 3
         assert 0 <= roc <= 7
-        self._register(self.CONFIG1(fan), 0x70, roc << 4)
-        self._register(self.CONFIG2A(fan), 0x02, 0x02 if polarity else 0x00)
-        self._register(self.CONFIG3(fan), 0x83, freq | (0x00 if spinup else 0x80))
+        self.regs.read(self.CONFIG1(fan), self.CONFIG2A(fan), self.CONFIG3(fan))    # fill cache in one transaction
+        with self.regs.batch():
+            self.regs.update(self.CONFIG1(fan), 0x70, roc << 4)
+            self.regs.update(self.CONFIG2A(fan), 0x02, 0x02 if polarity else 0x00)
+            self.regs.update(self.CONFIG3(fan), 0x83, freq | (0x00 if spinup else 0x80))
 
     # Set fan 1 or 2 into pwm mode, with duty cycle 0 to 100%
     def set_pwm_mode(self, fan, duty):
         assert 0 <= duty <= 100
-        self._register(self.CONFIG1(fan), 0x80, 0x80)   # set PWM mode
         width=int(round(duty*1.2))                      # convert percent to 120ths
-        self.i2c.io([self.DUTY(fan), width])            # set PWM width, DO NOT CACHE
+        with self.regs.batch():
+            self.regs.update(self.CONFIG1(fan), 0x80, 0x80) # set PWM mode
+            self.regs.write(self.DUTY(fan), width)      # set PWM width, volatile so not cached
 
     # Set fan 1 or 2 into RPM mode.
     # rpm        = base RPM, 500 to 16000.
@@ -95,30 +133,31 @@ class max6639:
         elif rpm < 6000: self.clock = 2         # max 8000 rpm
         else: self.clock = 3                    # max 16000 rpm
 
-        # enable rpm mode
-        self._register(self.START_TACH(fan), 0xFF, (60000<<self.clock)//rpm)        # set start speed
-        self._register(self.PPR(fan), 0xFF, ppr<<6 + 0x1E)                          # ppr and min tach
-        if target:
-            self._register(self.CONFIG1(fan), 0x8F, [8,4][fan-1] | self.clock)      # fan monitors temp1, fan2 monitors temp 2
-            self._register(self.START_TEMP(fan), 0xFF, target)                      # set start temperature
-            self._register(self.CONFIG2A(fan), 0x01, 0x01 if continuous else 0x00)  # maybe set continuous run flag
-        else:
-            self._register(self.CONFIG1(fan), 0x8F, self.clock)                     # run without monitor
-            self._register(self.CONFIG2A(fan), 0x01, 0x01)                          # continuous
+        # enable rpm mode, all changes are written in one transaction
+        self.regs.read(self.CONFIG1(fan), self.CONFIG2A(fan))                       # fill cache in one transaction
+        with self.regs.batch():
+            self.regs.write(self.START_TACH(fan), (60000<<self.clock)//rpm)         # set start speed
+            self.regs.write(self.PPR(fan), ((ppr-1)<<6) | 0x1E)                     # ppr and min tach
+            if target:
+                self.regs.update(self.CONFIG1(fan), 0x8F, [8,4][fan-1] | self.clock)    # fan monitors temp1, fan2 monitors temp 2
+                self.regs.write(self.START_TEMP(fan), target)                       # set start temperature
+                self.regs.update(self.CONFIG2A(fan), 0x01, 0x01 if continuous else 0x00)    # maybe set continuous run flag
+            else:
+                self.regs.update(self.CONFIG1(fan), 0x8F, self.clock)               # run without monitor
+                self.regs.update(self.CONFIG2A(fan), 0x01, 0x01)                    # continuous
 
     # Return temp 0 to 255.875 degrees C from indexed channel 1 or 2, or return
     # -1 if diode fault.
     def get_temp(self, channel):
-        l = self.i2c.io(self.XTEMP(channel),1)[0][0]    # read low first from reg 5 or 6
+        l, h = self.regs.read(self.XTEMP(channel), self.TEMP(channel))   # low first from reg 5 or 6, then high from 0 or 1
         if l & 1: return -1                             # diode fault?
-        h = self.i2c.io(self.TEMP(channel),1)[0][0]     # read high from reg 0 or 1
         return h+((l>>5)/8.0)                           # return float
 
     # Returns current pwm percent and rpm for indexed fan. rpm result is only
     # valid if fan in rpm mode.
     def get_fan_speed(self, fan):
-        pwm=int(round(self.i2c.io(self.DUTY(fan),1)[0][0]/1.2))
-        tach = self.i2c.io(self.TACH(fan),1)[0][0]
+        duty, tach = self.regs.read(self.DUTY(fan), self.TACH(fan))
+        pwm=int(round(duty/1.2))
         rpm = (60000 << self.clock)//tach if tach else 0
         return (pwm,rpm)
 
@@ -130,7 +169,7 @@ if __name__ == "__main__":
     # reset and use local temp as temp2, hi freq PWM
     chip.reset(local=True, pwmhi=True)
 
-    print("Device ID = 0x%02X, manufacturer = 0x%02X, revision = 0x%02X" % tuple(chip.i2c.io(chip.ID,3)[0]))
+    print("Device ID = 0x%02X, manufacturer = 0x%02X, revision = 0x%02X" % tuple(chip.regs.read(chip.ID, chip.MANUFACTURER, chip.REVISION)))
 
     # run fan 1 at 50% duty
     chip.set_pwm_mode(1, 50)
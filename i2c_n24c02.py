@@ -2,37 +2,15 @@
 
 from __future__ import print_function
 
-try: from i2c import i2c, blist
-except: from .i2c import i2c, blist
+try: from i2c_24cxx import eeprom
+except: from .i2c_24cxx import eeprom
 
 import time
 
-class n24c02:
+# 256 bytes with 16-byte pages, see i2c_24cxx for the implementation
+class n24c02(eeprom):
     def __init__(self, bus, addr=0xa0):
-        self.addr = addr
-        self.i2c = i2c(bus=bus, addr=addr)
-
-    # read len bytes from offset
-    def read(self, offset, len=1):
-        assert offset >= 0 and len >= 1 and offset+len <= 256
-        return self.i2c.io(offset,len)[0]
-
-    # write data to offset
-    def write(self, offset, data):
-        data = blist(data)              # convert data to list of ints
-        assert offset >= 0 and len(data) >= 1 and offset + len(data) <= 256
-        while data:
-            chunk = 16 - (offset & 15)  # constrain to 16-byte page
-            self.i2c.io([offset]+data[0:chunk])
-            time.sleep(0.004)           # requires 4mS
-            del data[0:chunk]
-            offset += chunk
-
-    # dump EEPROM contents to stdout
-    def dump(self):
-        data = self.read(0, 256)
-        for ofs in range(0, 256, 32):
-            print("%02X:" % ofs, "%02X "*32 % tuple(data[ofs:ofs+32]))
+        eeprom.__init__(self, bus, addr, size=256, page=16, write_time=0.005)
 
 if __name__ == "__main__":
 
@@ -40,7 +18,7 @@ if __name__ == "__main__":
     m = n24c02(bus=1, addr=0x50)
 
     # erase
-    m.write(0, [255]*256)
+    print("Erase skipped %d pages, wrote %d" % m.write(0, [255]*256))
 
     # write stuff
     m.write(0, [1,2,3,4,5])
@@ -2,8 +2,14 @@
 
 from __future__ import print_function
 
-try: from i2c import i2c
-except: from .i2c import i2c
+try:
+    from i2c import i2c
+    from regmap import regmap, register
+except:
+    from .i2c import i2c
+    from .regmap import regmap, register
+
+from contextlib import contextmanager
 
 class tca6408:
 
@@ -13,26 +19,58 @@ class tca6408:
     INV = 2     # 1 = pin logical state is inverse of physicall
     DIR = 3     # 1 = pin is input
 
-    # Create a tca6408 object with given bus and slave address
-    def __init__(self, bus, addr=0x20):
+    # Register map with power-on values, see regmap.py. The device does not
+    # auto-increment.
+    REGISTERS = (
+        register("IN",  IN, access="r", volatile=True),
+        register("OUT", OUT, reset=0xFF),
+        register("INV", INV, reset=0x00),
+        register("DIR", DIR, reset=0xFF),
+    )
+
+    # Create a tca6408 object with given bus and slave address. If irq is
+    # given, it's a gpio object (e.g. from gpio.py) connected to the INT pin and
+    # configured so get_input() returns True when INT is asserted, i.e. with
+    # invert=True. Then the IN register is only re-read after an interrupt.
+    def __init__(self, bus, addr=0x20, irq=None):
         self.addr = addr
         self.i2c = i2c(bus=bus, addr=addr)
-        self.cache = {}
+        self.irq = irq
+        self.regs = regmap(self.i2c, self.REGISTERS, autoinc=False)
+        self.inputs = None      # cached IN register, if irq
 
     # Set or clear masked bits in specified register to specified value
-    # Values are cached!
+    # Values are cached! The cached IN register is forgotten if DIR or INV
+    # changes, since INV changes what IN reads without asserting INT.
     def _register(self, reg, mask, value):
         assert 1 <= reg <= 3 and 1 <= mask <= 0xff
-        if reg not in self.cache: self.cache[reg] = self.i2c.io(reg,1)[0][0]
-        r = (self.cache[reg] & ~mask) | (value & mask)
-        if r != self.cache[reg]:
-            self.cache[reg] = r
-            self.i2c.io([reg, r])
+        if self.regs.update(reg, mask, value) and reg in (self.DIR, self.INV): self.inputs = None
+
+    # Write registers changed during batch() in a single transaction. OUT and
+    # INV are written before DIR, i.e. in address order, so new outputs start in
+    # the right state.
+    def flush(self):
+        self.regs.flush()
+
+    # Context in which pin changes, including those made via _gpio objects, are
+    # gathered and then written by flush() on exit, e.g.:
+    #   with chip.batch():
+    #       for g in gpios: g.output(1)
+    @contextmanager
+    def batch(self):
+        with self.regs.batch(): yield self
+
+    # return IN register, from cache if irq is not asserted
+    def _inputs(self):
+        if self.irq is None or self.inputs is None or self.irq.get_input():
+            self.inputs = self.regs.read(self.IN)[0]
+        return self.inputs
 
     # change masked gpios to inputs and return their states
     def input(self, mask):
         self._register(self.DIR, mask, mask)           # change to inputs
-        return self.i2c.io([self.IN, 1])[0][0] & mask   # return masked states
+        if self.regs.pending: self.flush()              # pending changes must be applied first
+        return self._inputs() & mask                    # return masked states
 
     # change masked gpios to outputs and set them to specified state.
     def output(self, mask, states):
@@ -45,8 +83,9 @@ class tca6408:
 
     # reset to HI-Z, disable inversion
     def reset(self):
-        self.input(0xFF)
-        self.invert(0xFF, 0x00)
+        with self.batch():
+            self.invert(0xFF, 0x00)
+            self.input(0xFF)
 
     # class for a single gpio
     class _gpio:
@@ -13,16 +13,19 @@ class tmp101:
     LOW     = 2
     HIGH    = 3
 
+    # conversion time in seconds for each resolution setting
+    CONVERSION = (0.040, 0.080, 0.160, 0.320)
+
     def __init__(self, bus, addr=0x49):
         self.addr = addr
         self.i2c=i2c(bus, addr)
 
-    # convert hi/low registers to -128.0 to +127.9375 C
+    # convert hi/low registers to -128.0 to +127.9375 C. hl can also be a pair
+    # of numpy integer arrays, to convert many samples at once.
     @staticmethod
     def _hl2c(hl):
         c = hl[0] + ((hl[1] >> 4) * 0.0625)
-        if c >= 128: c = -(256-c)
-        return c
+        return c - 256 * (c >= 128)
 
     # convert -128 to +127.9375C to hi/low registers
     @staticmethod
@@ -37,6 +40,16 @@ class tmp101:
         self.i2c.io(self.TEMP)                                  # set pointer register = 0
         return self._hl2c(self.i2c.io(None,2)[0])               # return 2 bytes as centigrade
 
+    # Return a dict of arguments for sampler.add() to sample the temperature.
+    # The device converts continuously so there is no trigger.
+    def sampler_spec(self):
+        return {"dev": self.i2c, "reg": self.TEMP, "length": 2, "decode": self._hl2c}
+
+    # Return dict of cache time-to-live by method name, for ttlcache. The
+    # temperature doesn't change faster than the current conversion time.
+    def ttls(self):
+        return {"get_temperature": self.CONVERSION[self.get_resolution()]}
+
     # return configuration byte (and alert status)
     def get_config(self):
         self.i2c.io(self.CONFIG)                                # set register pointer
@@ -0,0 +1,97 @@
+""" Pluggable transport for i2c.py and spi.py """
+
+# Normally i2c and spi objects open /dev/i2c-X or /dev/spidevX.X themselves
+# and issue ioctls directly. If a backend is installed before they are
+# created, they instead pass every transfer and configuration ioctl to it,
+# e.g. to record or replay traces (see iotrace.py):
+#
+#   iobackend.use(iotrace.recorder("trace.bin"))
+#   t = tmp101(1, 0x49)
+#
+# A backend provides four methods:
+#
+#   i2c_transfer(bus, msgs)
+#       msgs is a list of (addr, flags, data) where data is the bytes to
+#       write, or the number of bytes to read if flags & I2C_M_RD. Performs
+#       one I2C_RDWR and returns a list of bytes read, one per read message.
+#
+#   i2c_ioctl(bus, request, value)
+#       Performs I2C_RETRIES or I2C_TIMEOUT.
+#
+#   spi_transfer(bus, chipselect, transfers)
+#       transfers is a list of (tx, speed_hz, delay_usecs, bits_per_word,
+#       cs_change) where tx is the bytes to send. Performs one
+#       SPI_IOC_MESSAGE and returns a list of bytes received, one per
+#       transfer.
+#
+#   spi_ioctl(bus, chipselect, request, value)
+#       Performs an SPI_IOC_RD_* request and returns the value, or an
+#       SPI_IOC_WR_* request with the given value.
+
+from __future__ import print_function
+import os, fcntl, threading
+from ctypes import *
+
+try:
+    import i2c, spi, iostats
+except:
+    from . import i2c, spi, iostats
+
+# Install backend for all i2c and spi objects created from now on, or None to
+# go back to direct device access. Returns the previous backend.
+def use(backend):
+    old = i2c.backend
+    i2c.backend = spi.backend = backend
+    return old
+
+# The backend which talks to the local device files, opened on first use and
+# shared by all objects on the same bus.
+class local:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fds = {}   # by device path
+
+    def _fd(self, path):
+        with self.lock:
+            fd = self.fds.get(path)
+            if fd is None: fd = self.fds[path] = os.open(path, os.O_RDWR)
+            return fd
+
+    # close all devices
+    def close(self):
+        with self.lock:
+            for fd in self.fds.values(): os.close(fd)
+            self.fds = {}
+
+    def i2c_transfer(self, bus, msgs):
+        bufs = []
+        messages = []
+        for addr, flags, data in msgs:
+            if flags & i2c.I2C_M_RD: bufs.append(create_string_buffer(data))
+            else: bufs.append(create_string_buffer(bytes(bytearray(data)), len(data)))
+            messages.append(i2c.i2c_msg(addr=addr, flags=flags, len=sizeof(bufs[-1]), buf=addressof(bufs[-1])))
+        t = (i2c.i2c_msg*len(messages))(*messages)
+        fd = self._fd("/dev/i2c-%d" % bus)
+        data = i2c.i2c_rdwr_ioctl_data(msgs=addressof(t), nmsgs=len(t))
+        if iostats.enabled: iostats.ioctl("i2c", bus, i2c.usage(t), fd, i2c.I2C_RDWR, data, False)
+        else: fcntl.ioctl(fd, i2c.I2C_RDWR, data, False)
+        return [b.raw for b, m in zip(bufs, t) if m.flags & i2c.I2C_M_RD]
+
+    def i2c_ioctl(self, bus, request, value):
+        fcntl.ioctl(self._fd("/dev/i2c-%d" % bus), request, c_uint(value), False)
+
+    def spi_transfer(self, bus, chipselect, transfers):
+        bufs = []
+        t = (spi.spi_ioc_transfer*len(transfers))()
+        for n, (tx, speed_hz, delay_usecs, bits_per_word, cs_change) in enumerate(transfers):
+            bufs.append(create_string_buffer(bytes(bytearray(tx)), len(tx)))
+            t[n] = spi.spi_ioc_transfer(addressof(bufs[-1]), addressof(bufs[-1]), len(tx), speed_hz, delay_usecs, bits_per_word, cs_change)
+        spi._message(self._fd("/dev/spidev%d.%d" % (bus, chipselect)), bus, chipselect, t, len(t), None)
+        return [b.raw for b in bufs]
+
+    def spi_ioctl(self, bus, chipselect, request, value):
+        read = bool(request & 0x80000000)
+        buf = (c_ubyte*1)() if (request >> 16) & 0x3fff == 1 else (c_uint*1)()
+        if not read: buf[0] = value
+        fcntl.ioctl(self._fd("/dev/spidev%d.%d" % (bus, chipselect)), request, buf, read)
+        if read: return buf[0]
@@ -0,0 +1,136 @@
+""" Transaction counters and latency histograms for i2c, spi and gpio """
+
+# Disabled by default, in which case the cost to the I/O paths is a single
+# test of iostats.enabled. When enabled, every ioctl issued by i2c.py, spi.py
+# and gpio.py is counted per kind ("i2c", "spi" or "gpio"), bus and address
+# (the slave address, chip select, or gpio line), and optionally per calling
+# driver method:
+#
+#   iostats.enable(by_caller=True)
+#   ...
+#   print(iostats.snapshot())
+#   print(iostats.prometheus())
+
+from __future__ import print_function
+import sys, os, time, errno, threading, fcntl
+
+clock = getattr(time, "perf_counter", time.time)
+
+enabled = False         # true if counting
+callers = False         # true if also counting by calling function
+BUCKETS = 24            # latency histogram has log2 buckets from 1uS to 2^23 uS (8.4 S), and over
+NACKS = (errno.EREMOTEIO, errno.ENXIO)  # errnos which mean the slave did not acknowledge
+
+lock = threading.Lock()
+counters = {}           # by (kind, bus, addr, caller)
+
+# Source files of the I/O modules, skipped when looking for the caller
+_skip = set()
+for _name in ("i2c", "spi", "gpio", "iostats", "deadline", "iobackend", "regmap"):
+    _skip.add(os.path.join(os.path.dirname(os.path.abspath(__file__)), _name + ".py"))
+
+class _counter:
+    def __init__(self):
+        self.transactions = 0
+        self.messages = 0
+        self.written = 0        # bytes written
+        self.read = 0           # bytes read
+        self.errors = 0
+        self.nacks = 0          # errors which are NACKs
+        self.seconds = 0.0      # total latency
+        self.histogram = [0] * (BUCKETS + 1)
+
+# start counting, if by_caller then also count by calling function
+def enable(by_caller=False):
+    global enabled, callers
+    callers = by_caller
+    enabled = True
+
+# stop counting
+def disable():
+    global enabled
+    enabled = False
+
+# discard all counts
+def reset():
+    global counters
+    with lock: counters = {}
+
+# return "module.function" of the first caller outside the I/O modules
+def _caller():
+    f = sys._getframe(2)
+    while f is not None and os.path.abspath(f.f_code.co_filename) in _skip: f = f.f_back
+    if f is None: return None
+    return "%s.%s" % (os.path.splitext(os.path.basename(f.f_code.co_filename))[0], f.f_code.co_name)
+
+# Perform fcntl.ioctl(fd, request, arg, mutate) and count it. usage is an
+# ordered dict of [messages, bytes written, bytes read] by address. Messages
+# and bytes are counted for each address, but the transaction, its latency
+# and any error only for the first, so a transaction addressing several
+# devices (e.g. ad2420 combined transfers) isn't counted several times.
+def ioctl(kind, bus, usage, fd, request, arg, mutate):
+    caller = _caller() if callers else None
+    error = None
+    start = clock()
+    try:
+        return fcntl.ioctl(fd, request, arg, mutate)
+    except (IOError, OSError) as e:
+        error = e
+        raise
+    finally:
+        elapsed = clock() - start
+        bucket = min(int(elapsed * 1000000).bit_length(), BUCKETS)
+        with lock:
+            first = True
+            for addr, (messages, written, read) in usage.items():
+                key = (kind, bus, addr, caller)
+                c = counters.get(key)
+                if c is None: c = counters[key] = _counter()
+                c.messages += messages
+                c.written += written
+                c.read += read
+                if not first: continue
+                first = False
+                c.transactions += 1
+                c.seconds += elapsed
+                c.histogram[bucket] += 1
+                if error is not None:
+                    c.errors += 1
+                    if error.errno in NACKS: c.nacks += 1
+
+# Return list of dicts, one per (kind, bus, addr, caller), with all counters.
+# "histogram" is a list of counts of latencies under 1 uS, 2 uS, 4 uS, etc,
+# the last is for everything longer.
+def snapshot():
+    with lock:
+        return [dict(kind=k[0], bus=k[1], addr=k[2], caller=k[3], transactions=c.transactions, messages=c.messages,
+                     written=c.written, read=c.read, errors=c.errors, nacks=c.nacks, seconds=c.seconds,
+                     histogram=list(c.histogram))
+                for k, c in sorted(counters.items(), key=lambda kc: tuple(str(k) for k in kc[0]))]
+
+# Return snapshot() in Prometheus text exposition format
+def prometheus(prefix="plio"):
+    lines = []
+    def metric(name, type, help):
+        lines.append("# HELP %s_%s %s" % (prefix, name, help))
+        lines.append("# TYPE %s_%s %s" % (prefix, name, type))
+    def labels(s, extra=""):
+        l = 'kind="%s",bus="%s",addr="%s"' % (s["kind"], s["bus"], s["addr"] if s["kind"] == "gpio" else "0x%02X" % s["addr"])
+        if s["caller"]: l += ',caller="%s"' % s["caller"]
+        return "{" + l + extra + "}"
+    snap = snapshot()
+    for name, help in (("transactions", "ioctls issued"), ("messages", "messages transferred"),
+                       ("written", "bytes written"), ("read", "bytes read"),
+                       ("errors", "failed ioctls"), ("nacks", "ioctls failed by NACK")):
+        metric(name + "_total", "counter", help)
+        for s in snap: lines.append("%s_%s_total%s %d" % (prefix, name, labels(s), s[name]))
+    metric("latency_seconds", "histogram", "ioctl latency")
+    for s in snap:
+        total = 0
+        for n, count in enumerate(s["histogram"]):
+            total += count
+            le = "+Inf" if n == BUCKETS else "%g" % ((1 << n) / 1000000.0)
+            lines.append("%s_latency_seconds_bucket%s %d" % (prefix, labels(s, ',le="%s"' % le), total))
+        lines.append("%s_latency_seconds_sum%s %g" % (prefix, labels(s), s["seconds"]))
+        lines.append("%s_latency_seconds_count%s %d" % (prefix, labels(s), s["transactions"]))
+    return "\n".join(lines) + "\n"
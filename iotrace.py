@@ -0,0 +1,251 @@
+""" Record i2c and spi transactions to a binary trace, and replay them """
+
+# The recorder is an iobackend which passes everything to another backend
+# (by default the local devices) and appends each transaction, with its
+# responses or error, to a trace file:
+#
+#   iobackend.use(iotrace.recorder("trace.bin"))
+#
+# The replay backend serves the responses from a trace back to the drivers,
+# without any hardware and at full speed, so a field problem can be
+# reproduced or benchmarked offline:
+#
+#   iobackend.use(iotrace.replay("trace.bin"))
+#
+# "python iotrace.py trace.bin" prints a trace.
+#
+# The file starts with MAGIC, followed by records. Each record is a HEADER of
+# type, body length, timestamp, errno (0 if the transaction succeeded), bus
+# (NOBUS if None), address (chip select for spi, else 0) and item count,
+# followed by a body. Integers are little-endian.
+#
+#   I2C_TRANSFER : per message, I2C_ITEM of addr, flags and length, then the
+#                  written bytes if it's a write. Then, if successful, the
+#                  bytes read by each read message.
+#   SPI_TRANSFER : per transfer, SPI_ITEM of length, speed_hz, delay_usecs,
+#                  bits_per_word and cs_change, then the bytes sent. Then, if
+#                  successful, the bytes received by each transfer.
+#   I2C_IOCTL,
+#   SPI_IOCTL    : IOCTL of request and value (the value read, for reads)
+
+from __future__ import print_function
+import os, sys, time, errno, struct, threading, collections
+
+try:
+    import iobackend
+    from i2c import I2C_M_RD
+except:
+    from . import iobackend
+    from .i2c import I2C_M_RD
+
+MAGIC = b"PLIOTRC\x01"
+HEADER = struct.Struct("<BIdiHHH")
+I2C_ITEM = struct.Struct("<HHH")
+SPI_ITEM = struct.Struct("<IIHBB")
+IOCTL = struct.Struct("<II")
+NOBUS = 0xFFFF
+
+# record types
+I2C_TRANSFER = 1
+I2C_IOCTL    = 2
+SPI_TRANSFER = 3
+SPI_IOCTL    = 4
+
+# A decoded record. request and response depend on type:
+#   I2C_TRANSFER : msgs as passed to i2c_transfer(), list of bytes read
+#   SPI_TRANSFER : transfers as passed to spi_transfer(), list of bytes received
+#   I2C_IOCTL,
+#   SPI_IOCTL    : (request, value), value read or None
+record = collections.namedtuple("record", "type timestamp errno bus addr request response")
+
+# raised by replay when the drivers don't do what the trace says they did
+class mismatch(Exception): pass
+
+class recorder:
+    # Append to trace file at path, passing transactions to backend (default
+    # iobackend.local()). Writes are buffered, call flush() or close() to be
+    # sure everything is on disk.
+    def __init__(self, path, backend=None):
+        self.backend = backend or iobackend.local()
+        self.lock = threading.Lock()
+        new = not os.path.exists(path) or not os.path.getsize(path)
+        self.file = open(path, "ab")
+        if new: self.file.write(MAGIC)
+
+    def flush(self):
+        with self.lock: self.file.flush()
+
+    def close(self):
+        with self.lock: self.file.close()
+
+    def __enter__(self): return self
+    def __exit__(self, *args): self.close()
+
+    # write record
+    def _write(self, type, timestamp, error, bus, addr, count, body):
+        header = HEADER.pack(type, len(body), timestamp, error, NOBUS if bus is None else bus, addr, count)
+        with self.lock: self.file.write(header + body)
+
+    # call function(*args), record it with request, return its result
+    def _call(self, type, bus, addr, request, function, *args):
+        timestamp = time.time()
+        try:
+            result = function(*args)
+        except (IOError, OSError) as e:
+            self._write(type, timestamp, e.errno or errno.EIO, bus, addr, len(request), encode(type, request))
+            raise
+        self._write(type, timestamp, 0, bus, addr, len(request), encode(type, request, result))
+        return result
+
+    def i2c_transfer(self, bus, msgs):
+        return self._call(I2C_TRANSFER, bus, 0, msgs, self.backend.i2c_transfer, bus, msgs)
+
+    def spi_transfer(self, bus, chipselect, transfers):
+        return self._call(SPI_TRANSFER, bus, chipselect, transfers, self.backend.spi_transfer, bus, chipselect, transfers)
+
+    def i2c_ioctl(self, bus, request, value):
+        return self._call(I2C_IOCTL, bus, 0, (request, value), self.backend.i2c_ioctl, bus, request, value)
+
+    def spi_ioctl(self, bus, chipselect, request, value):
+        return self._call(SPI_IOCTL, bus, chipselect, (request, value), self.backend.spi_ioctl, bus, chipselect, request, value)
+
+# Return a list of the records in trace file at path. A truncated last
+# record, e.g. if the recorder was killed, is ignored.
+def load(path):
+    with open(path, "rb") as f: data = f.read()
+    if data[:len(MAGIC)] != MAGIC: raise ValueError("%s is not a trace file" % path)
+    records = []
+    offset = len(MAGIC)
+    while offset + HEADER.size <= len(data):
+        type, length, timestamp, error, bus, addr, count = HEADER.unpack_from(data, offset)
+        offset += HEADER.size
+        if offset + length > len(data): break
+        body = data[offset:offset+length]
+        offset += length
+        if bus == NOBUS: bus = None
+        records.append(record(type, timestamp, error, bus, addr, *decode(type, count, body, not error)))
+    return records
+
+# Return record body for type, given request and response (None if the
+# transaction failed). For ioctls the request is (request, value) and, if value
+# is None, the response is recorded as the value.
+def encode(type, request, response=None):
+    parts = []
+    if type == I2C_TRANSFER:
+        for addr, flags, data in request:
+            if flags & I2C_M_RD: parts.append(I2C_ITEM.pack(addr, flags, data))
+            else: parts += [I2C_ITEM.pack(addr, flags, len(data)), bytes(bytearray(data))]
+    elif type == SPI_TRANSFER:
+        for tx, speed_hz, delay_usecs, bits_per_word, cs_change in request:
+            parts += [SPI_ITEM.pack(len(tx), speed_hz, delay_usecs, bits_per_word, cs_change), bytes(bytearray(tx))]
+    else:
+        return IOCTL.pack(request[0], request[1] if request[1] is not None else response or 0)
+    if response is not None: parts += [bytes(bytearray(r)) for r in response]
+    return b"".join(parts)
+
+# Return (request, response) from record body with count items. response is
+# None unless asked for.
+def decode(type, count, body, response=True):
+    n = 0
+    if type == I2C_TRANSFER:
+        msgs, sizes = [], []
+        for i in range(count):
+            addr, flags, length = I2C_ITEM.unpack_from(body, n)
+            n += I2C_ITEM.size
+            if flags & I2C_M_RD:
+                msgs.append((addr, flags, length))
+                sizes.append(length)
+            else:
+                msgs.append((addr, flags, body[n:n+length]))
+                n += length
+    elif type == SPI_TRANSFER:
+        msgs, sizes = [], []
+        for i in range(count):
+            length, speed_hz, delay_usecs, bits_per_word, cs_change = SPI_ITEM.unpack_from(body, n)
+            n += SPI_ITEM.size
+            msgs.append((body[n:n+length], speed_hz, delay_usecs, bits_per_word, cs_change))
+            sizes.append(length)
+            n += length
+    else:
+        request, value = IOCTL.unpack(body)
+        return (request, value), None
+    if not response: return msgs, None
+    response = []
+    for size in sizes:
+        response.append(body[n:n+size])
+        n += size
+    return msgs, response
+
+class replay:
+    # Serve responses from the trace file at path. Each transaction must match
+    # the next record, else mismatch is raised. If strict, written data must
+    # match too, otherwise only the type, bus, address and message layout
+    # (e.g. a driver writing a different register value still gets the
+    # recorded response). Recorded errors are raised again.
+    def __init__(self, path, strict=True):
+        self.records = load(path)
+        self.strict = strict
+        self.index = 0
+        self.lock = threading.Lock()
+
+    # return number of records not yet replayed
+    def remaining(self): return len(self.records) - self.index
+
+    # start again from the first record
+    def rewind(self): self.index = 0
+
+    # return the next record if it matches, else raise mismatch
+    def _next(self, type, bus, addr, request, layout, exact=True):
+        with self.lock:
+            if self.index >= len(self.records): raise mismatch("trace exhausted")
+            r = self.records[self.index]
+            if r.type != type or r.bus != bus or r.addr != addr or layout(r.request) != layout(request) or \
+               (self.strict and exact and r.request != request):
+                raise mismatch("record %d is %r, not type %d bus %s addr %d %r" % (self.index, r, type, bus, addr, request))
+            self.index += 1
+        if r.errno: raise IOError(r.errno, os.strerror(r.errno))
+        return r
+
+    def i2c_transfer(self, bus, msgs):
+        msgs = [(addr, flags, data if flags & I2C_M_RD else bytes(bytearray(data))) for addr, flags, data in msgs]
+        layout = lambda m: [(a, f, d if f & I2C_M_RD else len(d)) for a, f, d in m]
+        return self._next(I2C_TRANSFER, bus, 0, msgs, layout).response
+
+    def spi_transfer(self, bus, chipselect, transfers):
+        transfers = [(bytes(bytearray(t[0])),) + tuple(t[1:]) for t in transfers]
+        layout = lambda t: [(len(x[0]),) + tuple(x[1:]) for x in t]
+        return self._next(SPI_TRANSFER, bus, chipselect, transfers, layout).response
+
+    def i2c_ioctl(self, bus, request, value):
+        self._next(I2C_IOCTL, bus, 0, (request, value), lambda r: r[0])
+
+    def spi_ioctl(self, bus, chipselect, request, value):
+        read = bool(request & 0x80000000)
+        r = self._next(SPI_IOCTL, bus, chipselect, (request, value), lambda r: r[0], not read)
+        if read: return r.request[1]
+
+# print a trace in readable form
+def dump(path):
+    records = load(path)
+    start = records[0].timestamp if records else 0
+    def hexes(b): return " ".join("%02X" % c for c in bytearray(b))
+    for r in records:
+        where = "spi %s.%d" % (r.bus, r.addr) if r.type in (SPI_TRANSFER, SPI_IOCTL) else "i2c %s" % r.bus
+        print("%10.6f %s%s" % (r.timestamp - start, where, " errno %d (%s)" % (r.errno, os.strerror(r.errno)) if r.errno else ""))
+        if r.type == I2C_TRANSFER:
+            reads = iter(r.response or [])
+            for addr, flags, data in r.request:
+                if flags & I2C_M_RD: print("  %02X: read %d:" % (addr, data), hexes(next(reads, b"")))
+                else: print("  %02X: write" % addr, hexes(data))
+        elif r.type == SPI_TRANSFER:
+            rx = iter(r.response or [])
+            for t in r.request:
+                print("  tx", hexes(t[0]), "rx", hexes(next(rx, b"")), "(%d Hz, %d uS, %d bits, cs_change %d)" % t[1:])
+        else:
+            print("  ioctl %08X value %d" % r.request)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("usage: iotrace.py trace.bin")
+        sys.exit(1)
+    dump(sys.argv[1])
@@ -0,0 +1,192 @@
+""" Declarative register maps, with a shadow cache and coalesced transfers """
+
+# A driver describes its registers once, with their address, width in bytes,
+# access, whether they are volatile (changed by the device, so never cached),
+# the reset value if known, and optionally named bitfields:
+#
+#   REGISTERS = (
+#       register("STATUS", 0x00, access="r", volatile=True),
+#       register("CONFIG", 0x01, reset=0x00, fields={"MODE": 0x03, "ENABLE": 0x80}),
+#       register("RESULT", 0x02, width=2, access="r", volatile=True),
+#   )
+#
+# and wraps its i2c object:
+#
+#   self.regs = regmap(self.i2c, self.REGISTERS)
+#   self.regs.update("CONFIG", 0x03, 2)     # read-modify-write
+#   self.regs.set(MODE=2, ENABLE=1)         # the same, by field
+#   status, result = self.regs.read("STATUS", "RESULT")
+#
+# Non-volatile registers are cached after the first read or write, so
+# read-modify-write needs no bus read and writing an unchanged value is
+# skipped. Several registers are read in one I2C_RDWR transaction, and writes
+# made inside batch() are written together on exit. If the device
+# auto-increments its register pointer, registers at consecutive addresses are
+# transferred as a single burst.
+#
+# Registers are referred to by name or address. Multi-byte registers are big
+# endian.
+
+from __future__ import print_function
+from contextlib import contextmanager
+
+try: from i2c import I2C_RDWR_IOCTL_MAX_MSGS
+except: from .i2c import I2C_RDWR_IOCTL_MAX_MSGS
+
+class register:
+    # access is "r", "w" or "rw". fields is a dict of masks by field name.
+    def __init__(self, name, addr, width=1, access="rw", volatile=False, reset=None, fields=None):
+        assert access in ("r", "w", "rw")
+        self.name = name
+        self.addr = addr
+        self.width = width
+        self.access = access
+        self.volatile = volatile
+        self.reset = reset
+        self.fields = fields or {}
+
+# return value as width big-endian bytes
+def _bytes(value, width):
+    return [(value >> (8 * n)) & 0xFF for n in reversed(range(width))]
+
+# return the value of big-endian bytes
+def _value(data):
+    v = 0
+    for b in data: v = (v << 8) | b
+    return v
+
+class regmap:
+    # dev is an i2c object, or anything with an equivalent io() method.
+    # autoinc is true if the device increments its register pointer after each
+    # byte, so adjacent registers can be accessed in one message.
+    def __init__(self, dev, registers, autoinc=True):
+        self.dev = dev
+        self.autoinc = autoinc
+        self.registers = {}     # by name and by address
+        self.fields = {}        # (register, mask) by field name
+        for r in registers:
+            self.registers[r.name] = self.registers[r.addr] = r
+            for name, mask in r.fields.items(): self.fields[name] = (r, mask)
+        self.cache = {}         # values of non-volatile registers, by address
+        self.pending = {}       # values written inside batch(), by address
+        self.batching = 0       # batch() nesting depth
+
+    # return register given its name, address, or itself
+    def _reg(self, reg):
+        if isinstance(reg, register): return reg
+        try: return self.registers[reg]
+        except KeyError: raise KeyError("No register %r" % (reg,))
+
+    # Return list of runs of registers which can be transferred in one message.
+    # Order is preserved, since it matters to some devices.
+    def _runs(self, regs):
+        runs = []
+        for r in regs:
+            if self.autoinc and runs and runs[-1][-1].addr + runs[-1][-1].width == r.addr: runs[-1].append(r)
+            else: runs.append([r])
+        return runs
+
+    # perform io() with specs, split into transactions of at most the maximum messages
+    def _io(self, specs):
+        results = []
+        per = I2C_RDWR_IOCTL_MAX_MSGS // 2 * 2
+        for first in range(0, len(specs), per):
+            chunk = specs[first:first+per]
+            while chunk[-1] is None: chunk = chunk[:-1]
+            results += self.dev.io(*chunk)
+        return results
+
+    # Return list of values of given registers. Cached values are used where
+    # possible, the rest are read in one transaction.
+    def read(self, *regs):
+        regs = [self._reg(r) for r in regs]
+        values = {}
+        wanted = []
+        for r in regs:
+            assert "r" in r.access, "%s is write-only" % r.name
+            if not r.volatile and r.addr in self.cache: values[r.addr] = self.cache[r.addr]
+            elif r not in wanted: wanted.append(r)
+        if wanted:
+            runs = self._runs(wanted)
+            specs = []
+            for run in runs: specs += [[run[0].addr], sum(r.width for r in run)]
+            for run, data in zip(runs, self._io(specs)):
+                for r in run:
+                    values[r.addr] = _value(data[:r.width])
+                    data = data[r.width:]
+                    if not r.volatile: self.cache[r.addr] = values[r.addr]
+        return [values[r.addr] for r in regs]
+
+    # Write value to register, unless it's cached with that value already.
+    # Inside batch() the write is deferred. Return true if the value was
+    # written or deferred, false if skipped.
+    def write(self, reg, value):
+        r = self._reg(reg)
+        assert "w" in r.access, "%s is read-only" % r.name
+        if not r.volatile and self.cache.get(r.addr) == value: return False
+        if self.batching: self.pending[r.addr] = value
+        else: self.dev.io([r.addr] + _bytes(value, r.width))
+        if not r.volatile: self.cache[r.addr] = value
+        return True
+
+    # Change masked bits of register to value, reading it first if not cached.
+    # Return true if the register changed, as by write().
+    def update(self, reg, mask, value):
+        r = self._reg(reg)
+        old = self.pending[r.addr] if r.addr in self.pending else self.read(r.addr)[0]
+        new = (old & ~mask) | (value & mask)
+        if new == old and not r.volatile: return False
+        return self.write(r.addr, new)
+
+    # return value of named field, shifted down
+    def get(self, field):
+        r, mask = self.fields[field]
+        return (self.read(r.addr)[0] & mask) // (mask & -mask)
+
+    # Set named fields to values, shifted up into place. Fields of the same
+    # register are combined into one update.
+    def set(self, **fields):
+        updates = {}
+        for field, value in fields.items():
+            r, mask = self.fields[field]
+            m, v = updates.get(r.addr, (0, 0))
+            updates[r.addr] = (m | mask, v | ((value * (mask & -mask)) & mask))
+        with self.batch():
+            for addr, (mask, value) in sorted(updates.items()): self.update(addr, mask, value)
+
+    # Write registers changed during batch(), in address order, in one transaction
+    def flush(self):
+        values = self.pending
+        self.pending = {}
+        regs = [self.registers[a] for a in sorted(values)]
+        if not regs: return
+        specs = []
+        for run in self._runs(regs):
+            data = [run[0].addr]
+            for r in run: data += _bytes(values[r.addr], r.width)
+            specs += [data, None]
+        try:
+            self._io(specs)
+        except:
+            self.invalidate(*regs)      # don't know what the device has now
+            raise
+
+    # Context in which writes are gathered, then written by flush() on exit
+    @contextmanager
+    def batch(self):
+        self.batching += 1
+        try:
+            yield self
+        finally:
+            self.batching -= 1
+            if not self.batching: self.flush()
+
+    # Forget cached values of given registers, or all, so they're read again
+    def invalidate(self, *regs):
+        if not regs: self.cache = {}
+        for r in regs: self.cache.pop(self._reg(r).addr, None)
+
+    # Set the cache to the reset values, call after resetting the device.
+    # Registers without a known reset value will be read on next use.
+    def reset(self):
+        self.cache = dict((r.addr, r.reset) for r in self.registers.values() if r.reset is not None and not r.volatile)
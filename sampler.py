@@ -0,0 +1,202 @@
+""" Sample multiple sensors at target rates """
+
+# Each channel is registered with a name, a target rate in Hz, and either a
+# register to read or a function to call. Channels are grouped by bus, and each
+# bus is serviced by its own thread so slow buses don't delay fast ones. On
+# each pass, the thread triggers conversion on all due channels which need it,
+# waits for the longest conversion time, then reads all due register channels
+# in as few combined I2C transactions as possible, then calls function
+# channels. Samples are passed to the callback as they are collected.
+#
+# Drivers provide sampler_spec() methods which return suitable arguments for
+# add(), e.g.:
+#
+#   s = sampler(callback=print)
+#   s.add("ambient", 4, **tmp101(1, 0x49).sampler_spec())
+#   s.add("12V", 10, **ltc2945(1, 0x69).sampler_spec(1))
+#   s.add("fan", 1, read=lambda: fans.get_temp(1), bus=1)
+#   s.start()
+
+from __future__ import print_function
+import sys, time, threading, collections
+
+try: from i2c import I2C_RDWR_IOCTL_MAX_MSGS
+except: from .i2c import I2C_RDWR_IOCTL_MAX_MSGS
+
+# A sample delivered to the callback, timestamp is time.time() after the read.
+sample = collections.namedtuple("sample", "name timestamp value")
+
+class channel:
+    def __init__(self, name, rate, read, dev, reg, length, decode, trigger, conversion):
+        self.name = name
+        self.period = 1.0 / rate
+        self.read = read
+        self.dev = dev
+        self.reg = reg
+        self.length = length
+        self.decode = decode
+        self.trigger = trigger
+        self.conversion = conversion
+        self.due = 0            # when next sample is due
+        self.last = None        # timestamp of last sample
+        self.count = 0          # number of samples
+        self.errors = 0         # number of failed reads
+        self.error = None       # exception of the last failure
+        self.n = 0              # number of intervals, and their running mean and
+        self.mean = 0.0         # sum of squared differences (Welford's method)
+        self.m2 = 0.0
+
+    # count failure e
+    def _fail(self, e):
+        self.errors += 1
+        self.error = e
+
+    # update statistics with new sample timestamp
+    def _update(self, timestamp):
+        if self.last is not None:
+            interval = timestamp - self.last
+            self.n += 1
+            delta = interval - self.mean
+            self.mean += delta / self.n
+            self.m2 += delta * (interval - self.mean)
+        self.last = timestamp
+        self.count += 1
+
+    # return dict of sample count, errors, achieved rate in Hz, and jitter
+    # (standard deviation of the sample interval) in seconds
+    def stats(self):
+        return {"count": self.count, "errors": self.errors,
+                "rate": 1 / self.mean if self.mean else 0.0,
+                "jitter": (self.m2 / self.n) ** 0.5 if self.n else 0.0}
+
+class sampler:
+
+    # callback(sample) is called from the bus threads for each sample, it
+    # should not block. Exceptions it raises are reported to stderr.
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.buses = collections.OrderedDict()  # lists of channels, by bus
+        self.latest = {}                        # most recent sample, by name
+        self.threads = []
+        self.running = False
+
+    # Add a channel to be sampled at rate Hz. Either:
+    #   read       : function returning the value, or
+    #   dev        : i2c object, with
+    #   reg        : register to read
+    #   length     : number of bytes to read
+    #   decode     : function given the list of bytes read, returns the value
+    # Optionally:
+    #   trigger    : function to start a conversion before reading, which may
+    #                return the seconds for it to complete instead of conversion
+    #   conversion : seconds for the conversion to complete
+    #   bus        : the bus to schedule on, default is dev.bus. Channels with
+    #                a read function and no bus are scheduled on their own.
+    def add(self, name, rate, read=None, dev=None, reg=None, length=1, decode=None, trigger=None, conversion=0, bus=None):
+        assert not self.running
+        assert (read is None) != (dev is None)
+        if bus is None: bus = dev.bus if dev is not None else name
+        c = channel(name, rate, read, dev, reg, length, decode or (lambda data: data), trigger, conversion)
+        self.buses.setdefault(bus, []).append(c)
+
+    # Perform one pass over channels which are due at time now. Any exception
+    # from a channel's trigger, read or decode counts as an error of that
+    # channel, so one bad driver can't stop the bus's thread.
+    def _pass(self, channels, now):
+        due = [c for c in channels if c.due <= now]
+        if not due: return
+
+        # trigger conversions, then wait for the slowest
+        wait = 0
+        for c in due:
+            if c.trigger:
+                try:
+                    t = c.trigger()
+                    wait = max(wait, c.conversion if t is None else t)
+                except Exception as e:
+                    c._fail(e)
+        if wait: time.sleep(wait)
+
+        # read register channels with combined transactions, each read takes two messages
+        samples = []
+        regs = [c for c in due if c.dev is not None]
+        per = I2C_RDWR_IOCTL_MAX_MSGS // 2
+        for first in range(0, len(regs), per):
+            batch = regs[first:first+per]
+            try:
+                results = batch[0].dev.multi_io(*[(c.dev.addr, [c.reg], c.length) for c in batch])
+            except Exception:
+                # find out which failed
+                results = []
+                for c in batch:
+                    try: results.append(c.dev.io([c.reg], c.length)[0])
+                    except Exception as e:
+                        c._fail(e)
+                        results.append(None)
+            timestamp = time.time()
+            for c, data in zip(batch, results):
+                if data is None: continue
+                try: samples.append((c, timestamp, c.decode(data)))
+                except Exception as e: c._fail(e)
+
+        # call function channels
+        for c in due:
+            if c.read is None: continue
+            try:
+                value = c.read()
+                samples.append((c, time.time(), value))
+            except Exception as e:
+                c._fail(e)
+
+        # deliver, and schedule next, skipping missed periods
+        for c, timestamp, value in samples:
+            c._update(timestamp)
+            s = sample(c.name, timestamp, value)
+            self.latest[c.name] = s
+            if self.callback:
+                try: self.callback(s)
+                except Exception as e: print("sampler: callback for %r failed: %r" % (s, e), file=sys.stderr)
+        for c in due:
+            c.due += c.period
+            if c.due < now: c.due = now + c.period
+
+    # service one bus until stopped
+    def _run(self, channels):
+        now = time.time()
+        for c in channels: c.due = now
+        while self.running:
+            self._pass(channels, time.time())
+            delay = min(c.due for c in channels) - time.time()
+            if delay > 0: time.sleep(delay)
+
+    # start a thread for each bus
+    def start(self):
+        assert not self.running
+        self.running = True
+        for channels in self.buses.values():
+            t = threading.Thread(target=self._run, args=(channels,))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    # stop all threads
+    def stop(self):
+        self.running = False
+        for t in self.threads: t.join()
+        self.threads = []
+
+    # return dict of channel statistics, by name
+    def stats(self):
+        return dict((c.name, c.stats()) for channels in self.buses.values() for c in channels)
+
+if __name__ == "__main__":
+
+    try: from i2c_tmp101 import tmp101
+    except: from .i2c_tmp101 import tmp101
+
+    s = sampler(callback=print)
+    s.add("ambient", 4, **tmp101(1, 0x49).sampler_spec())
+    s.start()
+    time.sleep(5)
+    s.stop()
+    print(s.stats())
@@ -0,0 +1,223 @@
+""" Scan i2c adapters and identify known devices """
+
+# Probes addresses 0x08 to 0x77 on every /dev/i2c-X adapter, one worker thread
+# per adapter, then fingerprints responding addresses via their ID registers
+# and returns ready-to-use driver instances:
+#
+#   for d in scan(): print(d.bus, hex(d.addr), d.part, d.driver)
+#
+# or from the command line:
+#
+#   python -m plio.scan [-r]
+#
+# The kernel aborts an I2C_RDWR at the first message which isn't acknowledged,
+# and doesn't say which one that was, so each address is probed with its own
+# ioctl. Like i2cdetect, the probe is a zero-length write except in the EEPROM
+# ranges, where it's a one byte read.
+#
+# Fingerprinting reads registers, i.e. writes a register pointer, so parts are
+# only tried at the addresses they can have.
+#
+# Results are cached per adapter in CACHE, which is in a directory only
+# writable by the user (root's is in /run). On later scans only the cached
+# addresses are probed, and the adapter is only swept again if its name has
+# changed or a cached device doesn't respond.
+
+from __future__ import print_function
+import os, re, sys, glob, json, errno, collections
+
+try:
+    import deadline
+    from i2c import i2c
+    from executor import executor
+    from i2c_24cxx import eeprom
+    from i2c_ad2420 import ad2420
+    from i2c_ltc2945 import ltc2945
+    from i2c_ltc2991 import ltc2991
+    from i2c_max6639 import max6639
+    from i2c_tca6408 import tca6408
+    from i2c_tmp101 import tmp101
+except:
+    from . import deadline
+    from .i2c import i2c
+    from .executor import executor
+    from .i2c_24cxx import eeprom
+    from .i2c_ad2420 import ad2420
+    from .i2c_ltc2945 import ltc2945
+    from .i2c_ltc2991 import ltc2991
+    from .i2c_max6639 import max6639
+    from .i2c_tca6408 import tca6408
+    from .i2c_tmp101 import tmp101
+
+CACHE = "/run/plio-scan.json" if os.geteuid() == 0 else \
+        os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "plio", "scan.json")
+FIRST = 0x08
+LAST = 0x77
+NACKS = (errno.ENXIO, errno.EREMOTEIO, errno.EIO, errno.ETIMEDOUT)
+
+# A device found by scan(), part is None if not identified, in which case
+# driver is a plain i2c object
+device = collections.namedtuple("device", "bus addr part driver")
+
+# Return sorted list of i2c adapter numbers
+def adapters():
+    return sorted(int(re.sub(r"\D", "", p)) for p in glob.glob("/dev/i2c-*"))
+
+# return the kernel's name for an adapter, or None
+def adapter_name(bus):
+    try:
+        with open("/sys/class/i2c-adapter/i2c-%d/name" % bus) as f: return f.readline().strip()
+    except (IOError, OSError):
+        return None
+
+# Return true if addr acknowledges, via the i2c object dev on the same bus.
+# A NACK is an answer, so it isn't retried.
+def _probe(dev, addr, read):
+    try:
+        with deadline.probing():
+            if read: dev.multi_io((addr, None, 1))
+            else: dev.multi_io((addr, []))
+        return True
+    except (IOError, OSError) as e:
+        if e.errno in NACKS: return False
+        raise
+
+# Return list of addresses on bus which acknowledge a probe. If the adapter
+# can't do zero-length writes, all probes are reads. dev is an i2c object on
+# the bus to use, else one is opened and closed.
+def probe(bus, addrs=None, dev=None):
+    if dev is None:
+        dev = i2c(bus, FIRST)
+        try: return probe(bus, addrs, dev)
+        finally: dev.close()
+    found = []
+    quick = True
+    for addr in range(FIRST, LAST+1) if addrs is None else addrs:
+        read = not quick or 0x30 <= addr <= 0x37 or 0x50 <= addr <= 0x5F
+        try:
+            ok = _probe(dev, addr, read)
+        except (IOError, OSError) as e:
+            if read or e.errno not in (errno.EOPNOTSUPP, errno.EINVAL): raise
+            quick = False
+            ok = _probe(dev, addr, True)
+        if ok: found.append(addr)
+    return found
+
+# Fingerprints, in order of precedence, each is (part, addresses, function)
+# where function(read) returns true if the part is present and read(reg, n)
+# returns n register bytes.
+def _ltc2991(read):
+    # VCC is always measured, with the data valid bit, and in range 2.7 to 5.5V
+    hi, lo = read(ltc2991.VCC, 2)
+    return bool(hi & 0x80) and 2.7 <= 2.5 + ((hi & 0x3F) << 8 | lo) * 0.00030518 <= 5.5
+
+def _ltc2945(read):
+    # 12-bit results are left justified, so the low nibbles are always 0
+    return all(read(r, 1)[0] & 0x0F == 0 for r in (ltc2945.SENSE_LSB, ltc2945.VIN_LSB, ltc2945.ADIN_LSB))
+
+def _tmp101(read):
+    # 12-bit temperatures are left justified, and in the -55 to 125C operating range
+    hl = read(tmp101.TEMP, 2)
+    return hl[1] & 0x0F == 0 and -55 <= tmp101._hl2c(hl) <= 125 and read(tmp101.LOW, 2)[1] & 0x0F == 0
+
+def _tca6408(read):
+    # OUT, INV and DIR have their power-on values, i.e. not yet configured
+    return read(tca6408.OUT, 1)[0] == 0xFF and read(tca6408.INV, 1)[0] == 0x00 and read(tca6408.DIR, 1)[0] == 0xFF
+
+FINGERPRINTS = (
+    ("max6639", (0x2C, 0x2E, 0x2F), lambda read: read(max6639.ID, 1)[0] == 0x58 and read(max6639.MANUFACTURER, 1)[0] == 0x4D),
+    ("ad2420",  (0x68, 0x6A, 0x6C, 0x6E), lambda read: read(ad2420.VENDOR, 1)[0] == 0xAD and read(ad2420.PRODUCT, 1)[0] & 0xF0 == 0x20),
+    ("ltc2991", range(0x48, 0x50), _ltc2991),
+    ("ltc2945", range(0x67, 0x70), _ltc2945),
+    ("tca6408", (0x20, 0x21), _tca6408),
+    ("tmp101",  range(0x48, 0x50), _tmp101),
+    ("eeprom",  range(0x50, 0x58), lambda read: True),
+)
+
+# driver constructors by part
+DRIVERS = {"max6639": max6639, "ad2420": ad2420, "ltc2991": ltc2991, "ltc2945": ltc2945,
+           "tca6408": tca6408, "tmp101": tmp101, "eeprom": eeprom}
+
+# Return the part name of the device at addr on bus, or None. dev is an i2c
+# object on the bus to use, else one is opened and closed.
+def identify(bus, addr, dev=None):
+    if dev is None:
+        dev = i2c(bus, addr)
+        try: return identify(bus, addr, dev)
+        finally: dev.close()
+    read = lambda reg, n: dev.multi_io((addr, [reg], n))[0]
+    for part, addrs, match in FINGERPRINTS:
+        if addr not in addrs: continue
+        try:
+            if match(read): return part
+        except (IOError, OSError):
+            pass
+    return None
+
+# Return list of (addr, part) found on bus, using i2c object dev
+def _sweep(bus, dev):
+    found = []
+    skip = set()
+    for addr in probe(bus, dev=dev):
+        if addr in skip: continue
+        part = identify(bus, addr, dev)
+        if part == "ad2420": skip.add(addr+1)      # the A2B bus address
+        found.append((addr, part))
+    return found
+
+# return cached (addr, part) list for bus if its devices still respond, else None
+def _cached(bus, entry, dev):
+    if entry is None or entry["name"] != adapter_name(bus): return None
+    found = [tuple(d) for d in entry["devices"]]
+    try:
+        if probe(bus, [addr for addr, part in found], dev) != [addr for addr, part in found]: return None
+    except (IOError, OSError):
+        return None
+    return found
+
+# Scan the given buses (default all), return list of devices. Uses and updates
+# cache file unless it's None, if refresh then always do a full sweep.
+def scan(buses=None, cache=CACHE, refresh=False):
+    if buses is None: buses = adapters()
+    entries = {}
+    if cache and not refresh:
+        try:
+            with open(cache) as f: entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            pass
+
+    def _scan(bus):
+        dev = i2c(bus, FIRST)
+        try:
+            found = _cached(bus, entries.get(str(bus)), dev)
+            if found is None: found = _sweep(bus, dev)
+            return found
+        finally:
+            dev.close()
+
+    e = executor()
+    futures = [(bus, e.submit(("i2c", bus), _scan, bus)) for bus in buses]
+    devices = []
+    for bus, f in futures:
+        try: found = f.result()
+        except (IOError, OSError): continue     # e.g. no permission
+        entries[str(bus)] = {"name": adapter_name(bus), "devices": found}
+        for addr, part in found:
+            devices.append(device(bus, addr, part, DRIVERS[part](bus, addr) if part else i2c(bus, addr)))
+    e.shutdown()
+
+    if cache:
+        try:
+            if not os.path.isdir(os.path.dirname(cache)): os.makedirs(os.path.dirname(cache), 0o700)
+            with open(cache, "w") as f: json.dump(entries, f)
+        except (IOError, OSError):
+            pass
+    return devices
+
+if __name__ == "__main__":
+    refresh = "-r" in sys.argv[1:]
+    if [a for a in sys.argv[1:] if a != "-r"]:
+        print("usage: scan.py [-r]\n  -r : ignore cached results")
+        sys.exit(1)
+    for d in scan(refresh=refresh):
+        print("i2c-%d 0x%02X %s" % (d.bus, d.addr, d.part or "unknown"))
@@ -0,0 +1,184 @@
+""" Fixed-capacity numpy time-series storage for sensor data """
+
+# A series holds the most recent samples of one channel in ring buffers of
+# timestamps and values, plus optional downsampled tiers each holding the
+# min, max and mean of a fixed number of samples from the tier below. Memory
+# use is fixed when the series is created, e.g. a day of 10 Hz samples plus a
+# week of one minute aggregates:
+#
+#   s = store(capacity=864000, tiers=((600, 10080),))
+#
+# A store holds a series per channel name. Requires numpy.
+
+from __future__ import print_function
+
+# Fixed-capacity ring buffer of float64 fields. Each row is written twice, at
+# index n and n+capacity, so the most recent rows are always contiguous and
+# can be returned as views without copying. append() is O(1).
+class ring:
+    def __init__(self, capacity, fields):
+        import numpy
+        self.capacity = capacity
+        self.fields = fields
+        self.data = numpy.zeros((len(fields), 2 * capacity))
+        self.head = 0           # index of next row
+        self.count = 0          # number of valid rows
+
+    def __len__(self): return self.count
+
+    # add one row
+    def append(self, *values):
+        h = self.head
+        self.data[:, h] = self.data[:, h + self.capacity] = values
+        self.head = (h + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    # add many rows, given one array per field
+    def extend(self, *columns):
+        import numpy
+        columns = numpy.array(columns, dtype=self.data.dtype, ndmin=2)
+        n = columns.shape[1]
+        if n > self.capacity:
+            columns = columns[:, n - self.capacity:]
+            self.head = (self.head + n - self.capacity) % self.capacity
+            n = self.capacity
+        first = min(n, self.capacity - self.head)
+        for h, c in ((self.head, columns[:, :first]), (0, columns[:, first:])):
+            if not c.shape[1]: continue
+            self.data[:, h:h + c.shape[1]] = c
+            self.data[:, h + self.capacity:h + self.capacity + c.shape[1]] = c
+        self.head = (self.head + n) % self.capacity
+        self.count = min(self.count + n, self.capacity)
+
+    # return views of the most recent n rows (or all), one array per field
+    def last(self, n=None):
+        n = self.count if n is None else min(n, self.count)
+        end = self.head + self.capacity
+        return tuple(self.data[:, end - n:end])
+
+# A tier aggregates every "factor" rows of the level below into one row of
+# (timestamp of first, min, max, mean).
+class tier(ring):
+    def __init__(self, factor, capacity):
+        import numpy
+        ring.__init__(self, capacity, ("timestamp", "min", "max", "mean"))
+        self.factor = factor
+        self.pending = numpy.zeros((4, factor))     # partial bucket
+        self.npending = 0
+
+    # Given arrays of timestamp, min, max and mean from the level below, return
+    # arrays of completed aggregates, which are also appended to this tier
+    def feed(self, t, mn, mx, mean):
+        import numpy
+        f = self.factor
+        rows = numpy.array((t, mn, mx, mean), dtype=float).reshape(4, -1)
+        out = []
+        # complete the pending bucket first
+        if self.npending:
+            k = min(f - self.npending, rows.shape[1])
+            self.pending[:, self.npending:self.npending + k] = rows[:, :k]
+            self.npending += k
+            rows = rows[:, k:]
+            if self.npending < f: return None
+            out.append(self.pending.copy().reshape(4, 1, f))
+            self.npending = 0
+        # then whole buckets
+        whole = rows.shape[1] // f * f
+        if whole: out.append(rows[:, :whole].reshape(4, -1, f))
+        # leave the rest pending
+        rest = rows.shape[1] - whole
+        self.pending[:, :rest] = rows[:, whole:]
+        self.npending = rest
+        if not out: return None
+        b = numpy.concatenate(out, axis=1)
+        agg = (b[0, :, 0], b[1].min(axis=1), b[2].max(axis=1), b[3].mean(axis=1))
+        self.extend(*agg)
+        return agg
+
+class series:
+    # capacity is number of raw samples, tiers is a list of (factor, capacity)
+    # for each downsampled tier, each factor relative to the previous tier
+    def __init__(self, capacity, tiers=()):
+        self.raw = ring(capacity, ("timestamp", "value"))
+        self.tiers = [tier(f, c) for f, c in tiers]
+
+    def __len__(self): return len(self.raw)
+
+    # add one sample
+    def append(self, timestamp, value):
+        self.raw.append(timestamp, value)
+        if self.tiers:
+            t = self.tiers[0]
+            t.pending[:, t.npending] = (timestamp, value, value, value)
+            t.npending += 1
+            if t.npending == t.factor:
+                # bucket complete, push it up through the tiers
+                t.npending = 0
+                p = t.pending
+                agg = (p[0, 0], p[1].min(), p[2].max(), p[3].mean())
+                t.append(*agg)
+                for t in self.tiers[1:]:
+                    agg = t.feed(*agg)
+                    if agg is None: break
+
+    # add many samples, given arrays of timestamps and values
+    def extend(self, timestamps, values):
+        self.raw.extend(timestamps, values)
+        agg = (timestamps, values, values, values)
+        for t in self.tiers:
+            agg = t.feed(*agg)
+            if agg is None: break
+
+    # return views (timestamps, values) of the most recent n raw samples
+    def last(self, n=None): return self.raw.last(n)
+
+    # return views (timestamps, min, max, mean) of the most recent n rows of
+    # tier level (0 is the first downsampled tier)
+    def downsampled(self, level, n=None): return self.tiers[level].last(n)
+
+    # return views (timestamps, values) of raw samples with start <= timestamp < end
+    def window(self, start, end=None):
+        import numpy
+        t, v = self.raw.last()
+        first = numpy.searchsorted(t, start)
+        last = len(t) if end is None else numpy.searchsorted(t, end)
+        return t[first:last], v[first:last]
+
+# A collection of series with the same capacity and tiers, by channel name
+class store:
+    def __init__(self, capacity, tiers=()):
+        self.capacity = capacity
+        self.tiers = tiers
+        self.series = {}
+
+    def __getitem__(self, name):
+        if name not in self.series: self.series[name] = series(self.capacity, self.tiers)
+        return self.series[name]
+
+    def __contains__(self, name): return name in self.series
+    def names(self): return list(self.series)
+
+    def append(self, name, timestamp, value): self[name].append(timestamp, value)
+    def extend(self, name, timestamps, values): self[name].extend(timestamps, values)
+
+    # Add many samples from raw register bytes, as an array-like with one row
+    # of bytes per sample. The transposed rows are passed as int64 arrays to
+    # decode, so driver helpers can convert them all at once, e.g.:
+    #   s.extend_raw("ambient", t, raw, tmp101._hl2c)
+    #   s.extend_raw("vcc", t, raw, lambda d: ltc2991._uV(d[0], d[1], 305.18))
+    def extend_raw(self, name, timestamps, raw, decode):
+        import numpy
+        self.extend(name, timestamps, decode(numpy.asarray(raw, dtype=numpy.int64).T))
+
+    # return a sampler callback which appends samples to this store
+    def callback(self): return lambda s: self.append(s.name, s.timestamp, s.value)
+
+if __name__ == "__main__":
+    import numpy, time
+    s = store(capacity=1000, tiers=((10, 100), (6, 100)))
+    t = time.time() + numpy.arange(2000) * 0.1
+    s.extend("ramp", t, numpy.arange(2000.0))
+    for n in range(5): s.append("ramp", t[-1] + (n + 1) * 0.1, 2000.0 + n)
+    print(s["ramp"].last(3))
+    print(s["ramp"].downsampled(0, 3))
+    print(s["ramp"].downsampled(1, 3))
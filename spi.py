@@ -4,6 +4,9 @@ from __future__ import print_function
 import os, fcntl
 from ctypes import *
 
+try: import iostats, deadline
+except: from . import iostats, deadline
+
 # This information is from linux/spi/spidev.h
 
 # strucutre is 32 bytes long
@@ -25,6 +28,7 @@ class spi_ioc_transfer(Structure):
 
 # send N spi_ioc_transfers
 def SPI_IOC_MESSAGE(N): return 0x40006B00+((N*sizeof(spi_ioc_transfer))<<16)
+SPI_IOC_MESSAGE_MAX        = 511        # size field is 14 bits, so at most 511 transfers per message
 
 SPI_IOC_RD_MODE            = 0x80016B01 # get SPI_MODE (see below)
 SPI_IOC_WR_MODE            = 0x40016B01 # set SPI_MODE
@@ -50,11 +54,131 @@ def blist(data):
     if type(data) is not list: data=list(data)
     return data
 
+# given the first n spi_ioc_transfers of a message, return dict of [transfers,
+# bytes written, bytes read] by chip select, for iostats
+def usage(chipselect, transfers, n):
+    return {chipselect: [n, sum(transfers[i].len for i in range(n)), sum(transfers[i].len for i in range(n) if transfers[i].rx_buf)]}
+
+# Optional transport backend, see iobackend.py. If set when an spi object is
+# created, the object does not open /dev/spidevX.X itself but passes all
+# transfers to backend.spi_transfer() and ioctls to backend.spi_ioctl().
+backend = None
+
+# Perform SPI_IOC_MESSAGE ioctl with the first n transfers, counting it if
+# iostats is enabled, or pass them to backend if not None. Subject to deadline
+# if enabled, but only retried if the deadline allows combined transactions,
+# since e.g. repeating a chunk of a streamed read returns the next bytes.
+def message(fd, bus, chipselect, transfers, n, backend=None):
+    if deadline.enabled: deadline.call(("spi", bus, chipselect), lambda: _message(fd, bus, chipselect, transfers, n, backend))
+    else: _message(fd, bus, chipselect, transfers, n, backend)
+
+def _message(fd, bus, chipselect, transfers, n, backend):
+    if backend is not None:
+        rx = backend.spi_transfer(bus, chipselect, [(string_at(t.tx_buf, t.len) if t.tx_buf else bytes(bytearray(t.len)), t.speed_hz, t.delay_usecs, t.bits_per_word, t.cs_change) for t in transfers[0:n]])
+        for t, r in zip(transfers[0:n], rx):
+            if t.rx_buf: memmove(t.rx_buf, bytes(bytearray(r)), min(t.len, len(r)))
+    elif iostats.enabled: iostats.ioctl("spi", bus, usage(chipselect, transfers, n), fd, SPI_IOC_MESSAGE(n), transfers, True)
+    else: fcntl.ioctl(fd, SPI_IOC_MESSAGE(n), transfers, True)
+
+# Return the spidev driver's maximum bytes per message, any larger transfer
+# fails with EMSGSIZE. Default is 4096 if the module parameter is not visible.
+def get_bufsiz():
+    try:
+        with open("/sys/module/spidev/parameters/bufsiz") as f: return int(f.readline())
+    except (IOError, OSError, ValueError):
+        return 4096
+
+# Given an spi.io() transfer specification, return the data part and list of
+# spi_ioc_transfer fields after 'len'
+def parse(spec):
+    if type(spec) == dict:
+        return spec["data"], [int(spec.get("speed_hz",0)), int(spec.get("delay_usecs",0)), int(spec.get("bits_per_word",0)), int(spec.get("cs_change",0)), 0, 0]
+    return spec, [0, 0, 0, 0, 0, 0]
+
+# A reusable spi transaction, as returned by spi.prepare(). The transfer
+# descriptors and buffers are built once, so calling it performs exactly one
+# ioctl with no allocation.
+#   tx[n] : writable memoryview of the data sent by transfer n, update it in
+#           place to change what is sent next time
+#   rx[n] : memoryview of the data received by transfer n, valid until the
+#           next call
+class transaction:
+    def __init__(self, fd, specs, bus=None, chipselect=None, backend=None):
+        assert 0 < len(specs) <= SPI_IOC_MESSAGE_MAX
+        self.fd = fd
+        self.backend = backend
+        self.bus = bus
+        self.chipselect = chipselect
+        self.transfers = (spi_ioc_transfer*len(specs))()
+        self.request = SPI_IOC_MESSAGE(len(specs))
+        self.buffers = []   # keep buffers alive
+        self.tx = []
+        self.rx = []
+        for t, s in zip(self.transfers, specs):
+            data, options = parse(s)
+            data = [0]*data if type(data) is int else blist(data)
+            size = len(data)
+            tx = bytearray(data)
+            rx = bytearray(size)
+            t.tx_buf = addressof((c_ubyte*size).from_buffer(tx)) if size else 0
+            t.rx_buf = addressof((c_ubyte*size).from_buffer(rx)) if size else 0
+            t.len = size
+            t.speed_hz, t.delay_usecs, t.bits_per_word, t.cs_change = options[0:4]
+            self.buffers += [tx, rx]
+            self.tx.append(memoryview(tx))
+            self.rx.append(memoryview(rx))
+
+    # perform the transaction, return the list of rx memoryviews
+    def __call__(self):
+        if self.backend is not None or deadline.enabled: message(self.fd, self.bus, self.chipselect, self.transfers, len(self.transfers), self.backend)
+        elif iostats.enabled: iostats.ioctl("spi", self.bus, usage(self.chipselect, self.transfers, len(self.transfers)), self.fd, self.request, self.transfers, True)
+        else: fcntl.ioctl(self.fd, self.request, self.transfers, True)
+        return self.rx
+
+# Decode raw samples from spi.acquire() into a numpy int64 array, in one
+# vectorized step. Each row of raw is one sample:
+#   bits_per_word : as used for the transfer, words over 8 bits occupy 2 or 4
+#                   bytes in native order, as delivered by spidev
+#   big_endian    : if true the first word of the sample is most significant
+#   shift         : shift the combined words right this many bits
+#   bits          : then keep this many low bits (default all)
+#   signed        : then sign-extend from the top bit
+# For example an MCP3201 read with acquire(2, n) is decoded with shift=1, bits=12.
+def decode(raw, bits_per_word=8, big_endian=True, shift=0, bits=None, signed=False):
+    import numpy
+    raw = numpy.ascontiguousarray(raw, dtype=numpy.uint8)
+    if bits_per_word <= 8:
+        words = raw
+        wbits = 8
+    else:
+        words = raw.view(numpy.dtype("=u%d" % (2 if bits_per_word <= 16 else 4)))
+        wbits = bits_per_word
+    words = words.astype(numpy.int64) & ((1 << wbits)-1)
+    if not big_endian: words = words[:, ::-1]
+    assert words.shape[1] * wbits <= 63
+    v = numpy.zeros(len(words), dtype=numpy.int64)
+    for n in range(words.shape[1]): v = (v << wbits) | words[:, n]
+    if shift: v >>= shift
+    if bits is not None:
+        v &= (1 << bits)-1
+        if signed:
+            sign = 1 << (bits-1)
+            v = (v ^ sign) - sign
+    elif signed:
+        sign = 1 << (words.shape[1] * wbits - shift - 1)
+        v = (v ^ sign) - sign
+    return v
+
 class spi:
     # Given a bus and chip select number, open SPI device and optionally init
     # various properties via ioctl
     def __init__(self, bus, chipselect, spi_mode=None, lsb_first=None, bits_per_word=None, speed_hz=None):
-        self.fd=os.open("/dev/spidev%d.%d" % (bus, chipselect), os.O_RDWR)
+        self.backend=backend
+        self.fd=os.open("/dev/spidev%d.%d" % (bus, chipselect), os.O_RDWR) if backend is None else None
+        self.bus=bus
+        self.chipselect=chipselect
+        self.bufsiz=get_bufsiz()
+        self.stream_buffers=None # alternating buffers for stream_read, allocated on first use
         if spi_mode is not None: self.set_spi_mode(spi_mode)
         if lsb_first is not None: self.set_lsb_first(lsb_first)
         if bits_per_word is not None: self.set_bits_per_word(bits_per_word)
@@ -75,14 +199,7 @@ class spi:
         transfers=[] # list of transfers
         buffers=[]   # transaction buffers
         for s in specs:
-            if type(s) == dict:
-                data=s["data"]
-                # spi_ioc_transfer flags after 'len'
-                options=[int(s.get("speed_hz",0)), int(s.get("delay_usecs",0)), int(s.get("bits_per_word",0)), int(s.get("cs_change",0)), 0, 0]
-            else:
-                data=s
-                options=[0, 0, 0, 0, 0, 0]
-
+            data, options = parse(s)
             if type(data) is int:
                 # single byte, just read that many
                 size=data
@@ -98,54 +215,171 @@ class spi:
                 transfers.append(spi_ioc_transfer(buffer, buffer, size, *options))
 
         t=(spi_ioc_transfer*len(transfers))(*transfers)
-        fcntl.ioctl(self.fd, SPI_IOC_MESSAGE(len(t)), t, False)
+        message(self.fd, self.bus, self.chipselect, t, len(t), self.backend)
 
         # collect the responses
         return [list(bytearray(m.raw)) for m in buffers]
 
+    # Given the same transfer specifications as io(), return a reusable
+    # transaction which performs them each time it's called, e.g.:
+    #   t = dev.prepare([0x0B, 0x00], 2)
+    #   while True:
+    #       status = t()[1][0]
+    def prepare(self, *specs):
+        return transaction(self.fd, specs, self.bus, self.chipselect, self.backend)
+
+    # Send cmd, then read total bytes in messages no larger than bufsiz (or
+    # chunk, if smaller). Chip select is held asserted between messages via
+    # cs_change. For each message calls address(offset, size) to get the
+    # receive buffer address, and yields (offset, size) after it completes.
+    # If the stream stops early, because a message failed or the generator
+    # was abandoned, chip select is released by an empty message.
+    def _stream(self, cmd, total, chunk, address):
+        size = min(chunk or self.bufsiz, self.bufsiz)
+        cmd = blist(cmd)
+        assert len(cmd) < size
+        cbuf = create_string_buffer(bytes(bytearray(cmd)), len(cmd))
+        head = (spi_ioc_transfer*2)()       # first message, command then data
+        head[0].tx_buf = addressof(cbuf)
+        head[0].rx_buf = 0
+        head[0].len = len(cmd)
+        body = (spi_ioc_transfer*1)()       # subsequent messages, data only
+        t, n, offset = head, len(cmd), 0
+        try:
+            while offset < total:
+                length = min(total-offset, size-n)
+                t[-1].tx_buf = 0            # send zeros
+                t[-1].rx_buf = address(offset, length)
+                t[-1].len = length
+                t[-1].cs_change = offset+length < total  # keep chip select for the next message
+                message(self.fd, self.bus, self.chipselect, t, len(t), self.backend)
+                yield offset, length
+                offset += length
+                t, n = body, 0
+        finally:
+            if offset < total: self._release()
+
+    # release chip select, if it was left asserted by cs_change
+    def _release(self):
+        t = (spi_ioc_transfer*1)()
+        try: message(self.fd, self.bus, self.chipselect, t, 1, self.backend)
+        except (IOError, OSError): pass
+
+    # Send cmd, then read total bytes as a series of chunks without releasing
+    # chip select, e.g. to dump an entire flash device in constant memory.
+    # Yields a memoryview of each chunk, which is only valid until the
+    # generator is resumed twice since two buffers are used alternately.
+    def stream_read(self, cmd, total, chunk=None):
+        if self.stream_buffers is None: self.stream_buffers=[bytearray(self.bufsiz), bytearray(self.bufsiz)]
+        bufs = self.stream_buffers
+        n = [0]                             # count of chunks
+        def address(offset, length):
+            n[0] += 1
+            return addressof((c_ubyte*length).from_buffer(bufs[n[0] & 1]))
+        for offset, length in self._stream(cmd, total, chunk, address):
+            yield memoryview(bufs[n[0] & 1])[:length]
+
+    # Send cmd, then read len(buf) bytes directly into writable buffer buf (e.g.
+    # a bytearray), in as many messages as needed. Returns number of bytes read.
+    def readinto(self, cmd, buf, chunk=None):
+        total = len(buf)
+        if not total: return 0
+        base = addressof((c_ubyte*total).from_buffer(buf))
+        for offset, length in self._stream(cmd, total, chunk, lambda o, l: base+o): pass
+        return total
+
+    # Acquire count samples, e.g. from an external ADC. Each sample is one
+    # transfer sending cmd (or that many zeros if cmd is an int), with chip
+    # select cycled between samples. As many samples as will fit are sent in
+    # each ioctl and received straight into a numpy uint8 array of shape
+    # (count, sample length), which is returned. Pass an existing array as
+    # "out" to avoid allocation. Use decode() to convert the result.
+    def acquire(self, cmd, count, speed_hz=0, bits_per_word=0, delay_usecs=0, out=None):
+        import numpy
+        if type(cmd) is int: cmd = [0]*cmd
+        cmd = blist(cmd)
+        size = len(cmd)
+        assert 0 < size <= self.bufsiz and count > 0
+        if out is None: out = numpy.empty((count, size), dtype=numpy.uint8)
+        assert out.shape == (count, size) and out.dtype == numpy.uint8 and out.flags.c_contiguous
+        per = min(SPI_IOC_MESSAGE_MAX, self.bufsiz // size, count)
+
+        # every transfer sends the same command
+        cbuf = create_string_buffer(bytes(bytearray(cmd)), size)
+        t = (spi_ioc_transfer*per)()
+        for x in t:
+            x.tx_buf = addressof(cbuf)
+            x.len = size
+            x.speed_hz = speed_hz
+            x.delay_usecs = delay_usecs
+            x.bits_per_word = bits_per_word
+            x.cs_change = 1
+        # rx_buf is the second 64-bit field of each 32-byte transfer, so set
+        # them all at once via a numpy view
+        rx_buf = numpy.frombuffer(t, dtype=numpy.uint64).reshape(per, 4)[:, 1]
+        offsets = numpy.arange(per, dtype=numpy.uint64) * size
+        base = out.ctypes.data
+        for first in range(0, count, per):
+            n = min(per, count-first)
+            rx_buf[:] = base + first*size + offsets
+            t[n-1].cs_change = 0            # release chip select at end of message
+            message(self.fd, self.bus, self.chipselect, t, n, self.backend)
+            t[n-1].cs_change = 1
+        return out
+
+    # perform a configuration ioctl, buf is a one element ctypes array which is
+    # written if request is SPI_IOC_WR_* or read into if SPI_IOC_RD_*
+    def _ioctl(self, request, buf):
+        read = bool(request & 0x80000000)
+        if self.backend is not None:
+            value = self.backend.spi_ioctl(self.bus, self.chipselect, request, None if read else buf[0])
+            if read: buf[0] = value
+        else:
+            fcntl.ioctl(self.fd, request, buf, read)
+
     # return the spi transfer mode 0-3
     def get_spi_mode(self):
         u8 = (c_ubyte*1)(0)
-        fcntl.ioctl(self.fd, SPI_IOC_RD_MODE, u8, True)
+        self._ioctl(SPI_IOC_RD_MODE, u8)
         return u8[0] & 3
 
     # set the spi transfer mode 0-3
     def set_spi_mode(self, spi_mode):
         u8 = (c_ubyte*1)(spi_mode & 3)
-        fcntl.ioctl(self.fd, SPI_IOC_WR_MODE, u8, False)
+        self._ioctl(SPI_IOC_WR_MODE, u8)
 
     # return true if data is sent LSB first
     def get_lsb_first(self):
         u8 = (c_ubyte*1)(0)
-        fcntl.ioctl(self.fd, SPI_IOC_RD_LSB_FIRST, u8, True)
+        self._ioctl(SPI_IOC_RD_LSB_FIRST, u8)
         return bool(u8[0])
 
     # enable LSB first or MSB first
     def set_lsb_first(self, lsb_first):
         u8 = (c_ubyte*1)(1 if lsb_first else 0)
-        fcntl.ioctl(self.fd, SPI_IOC_WR_LSB_FIRST, u8, False)
+        self._ioctl(SPI_IOC_WR_LSB_FIRST, u8)
 
     # get number of bits per word
     def get_bits_per_word(self):
         u8 = (c_ubyte*1)(0)
-        fcntl.ioctl(self.fd, SPI_IOC_RD_BITS_PER_WORD, u8, True)
+        self._ioctl(SPI_IOC_RD_BITS_PER_WORD, u8)
         return u8[0] or 8
 
     # set number of bits per word
     def set_bits_per_word(self, bits_per_word):
         u8 = (c_ubyte*1)(bits_per_word)
-        fcntl.ioctl(self.fd, SPI_IOC_WR_BITS_PER_WORD, u8, False)
+        self._ioctl(SPI_IOC_WR_BITS_PER_WORD, u8)
 
     # get clock speed
     def get_speed_hz(self):
         u32 = (c_uint*1)(0)
-        fcntl.ioctl(self.fd, SPI_IOC_RD_MAX_SPEED_HZ, u32, True)
+        self._ioctl(SPI_IOC_RD_MAX_SPEED_HZ, u32)
         return u32[0]
 
     # set clock speed
     def set_speed_hz(self, speed_hz):
         u32 = (c_uint*1)(speed_hz)
-        fcntl.ioctl(self.fd, SPI_IOC_WR_MAX_SPEED_HZ, u32, False)
+        self._ioctl(SPI_IOC_WR_MAX_SPEED_HZ, u32)
 
 if __name__ == "__main__":
 
@@ -0,0 +1,190 @@
+""" Shared-memory table of latest sensor values """
+
+# One process samples the drivers and publishes the latest value of each
+# channel into a memory-mapped file; any number of other processes read them
+# without locks, system calls or bus traffic:
+#
+#   p = publisher(["ambient", ("12V", 0.1)])
+#   s = sampler(callback=p.callback())
+#   s.add("ambient", 4, **tmp101(1, 0x49).sampler_spec())
+#   s.add("12V", 10, **ltc2945(1, 0x69).sampler_spec(1))
+#   s.start()
+#
+# and elsewhere:
+#
+#   r = reader()
+#   print(r.read("ambient").value)
+#
+# The file starts with a header of magic, channel count, publisher pid and a
+# heartbeat timestamp, followed by the channel names, NAME bytes each, then a
+# SLOT per channel of sequence count, status, timestamp, value and expected
+# period. Each slot is a seqlock: the publisher makes the count odd, writes
+# the slot, then makes it even again, and a reader retries if the count was
+# odd or changed while it read the slot.
+#
+# A reading is stale if its channel hasn't been published for STALE periods
+# (if the channel has a period), or the publisher's heartbeat is older than
+# timeout, e.g. because the publisher has stopped, or it couldn't be read
+# consistently. The publisher updates the heartbeat every HEARTBEAT_INTERVAL
+# seconds from a thread, so slow channels don't make the table look dead.
+
+from __future__ import print_function
+import os, mmap, time, errno, struct, threading, tempfile, collections
+
+PATH = "/dev/shm/plio-telemetry" if os.path.isdir("/dev/shm") else os.path.join(tempfile.gettempdir(), "plio-telemetry")
+MAGIC = b"PLIOTLM\x01"
+HEADER = struct.Struct("<8sIId")       # magic, count, pid, heartbeat
+NAME = 32
+SLOT = struct.Struct("<Iiddd")         # sequence, status, timestamp, value, period
+SEQUENCE = struct.Struct("<I")
+HEARTBEAT = HEADER.size - 8
+STALE = 3                               # periods without an update before a channel is stale
+HEARTBEAT_INTERVAL = 1.0                # seconds between publisher heartbeats
+
+# status values, or else an errno
+OK = 0
+NODATA = -1                             # never published
+ERROR = -2                              # failed, errno unknown
+
+# A channel's latest value, timestamp is time.time() of the sample
+reading = collections.namedtuple("reading", "name timestamp value status stale")
+
+# return offset of the first slot for count channels, 8-byte aligned
+def _slots(count):
+    return (HEADER.size + count * NAME + 7) & ~7
+
+class publisher:
+    # channels is a list of names, or (name, period) where period is the
+    # expected seconds between updates, used to detect stale values. The table
+    # is created atomically, replacing any previous one at path. interval is
+    # seconds between heartbeats, or None to leave them to the caller.
+    def __init__(self, channels, path=PATH, interval=HEARTBEAT_INTERVAL):
+        channels = [c if isinstance(c, tuple) else (c, None) for c in channels]
+        self.path = path
+        self.index = dict((name, n) for n, (name, period) in enumerate(channels))
+        self.lock = threading.Lock()    # one writer per slot
+        size = _slots(len(channels)) + len(channels) * SLOT.size
+        buf = bytearray(size)
+        HEADER.pack_into(buf, 0, MAGIC, len(channels), os.getpid(), time.time())
+        for n, (name, period) in enumerate(channels):
+            assert len(name.encode()) <= NAME, "Channel name %r is too long" % name
+            struct.pack_into("%ds" % NAME, buf, HEADER.size + n * NAME, name.encode())
+            SLOT.pack_into(buf, _slots(len(channels)) + n * SLOT.size, 0, NODATA, 0.0, 0.0, period or 0.0)
+        tmp = "%s.%d" % (path, os.getpid())
+        with open(tmp, "wb") as f: f.write(buf)
+        os.rename(tmp, path)
+        self.file = open(path, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.first = _slots(len(channels))
+        self.stopped = threading.Event()
+        self.thread = None
+        if interval:
+            self.thread = threading.Thread(target=self._beat, args=(interval,))
+            self.thread.daemon = True
+            self.thread.start()
+
+    # update the heartbeat every interval seconds until closed
+    def _beat(self, interval):
+        while not self.stopped.wait(interval): self.heartbeat()
+
+    # Publish value of named channel, with timestamp default now
+    def publish(self, name, value, timestamp=None, status=OK):
+        offset = self.first + self.index[name] * SLOT.size
+        if timestamp is None: timestamp = time.time()
+        with self.lock:
+            seq, _, _, _, period = SLOT.unpack_from(self.map, offset)
+            SEQUENCE.pack_into(self.map, offset, (seq + 1) & 0xFFFFFFFF)
+            SLOT.pack_into(self.map, offset, (seq + 1) & 0xFFFFFFFF, status, timestamp, value, period)
+            SEQUENCE.pack_into(self.map, offset, (seq + 2) & 0xFFFFFFFF)
+            struct.pack_into("<d", self.map, HEARTBEAT, time.time())
+
+    # Record that reading named channel failed with IOError or OSError e,
+    # keeping the previous value
+    def error(self, name, e=None):
+        offset = self.first + self.index[name] * SLOT.size
+        with self.lock: seq, status, timestamp, value, period = SLOT.unpack_from(self.map, offset)
+        self.publish(name, value, time.time(), getattr(e, "errno", None) or ERROR)
+
+    # Update the heartbeat, for a publisher with nothing new to publish
+    def heartbeat(self):
+        with self.lock: struct.pack_into("<d", self.map, HEARTBEAT, time.time())
+
+    # Return a callback which publishes samples from sampler.py
+    def callback(self):
+        return lambda s: self.publish(s.name, s.value, s.timestamp)
+
+    # Close the table, readers will see it go stale. The file is left in place.
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None: self.thread.join()
+        self.map.close()
+        self.file.close()
+
+class reader:
+    # timeout is the age of the publisher's heartbeat after which all readings
+    # are stale
+    def __init__(self, path=PATH, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self.map = None
+        self.open()
+
+    # Map the table at path. Raises IOError if there isn't one.
+    def open(self):
+        with open(self.path, "rb") as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            inode = os.fstat(f.fileno()).st_ino
+        magic, count, self.pid, heartbeat = HEADER.unpack_from(m, 0)
+        if magic != MAGIC:
+            m.close()
+            raise IOError(errno.EINVAL, "Not a telemetry table", self.path)
+        self.names = [struct.unpack_from("%ds" % NAME, m, HEADER.size + n * NAME)[0].rstrip(b"\0").decode() for n in range(count)]
+        self.index = dict((name, n) for n, name in enumerate(self.names))
+        self.first = _slots(count)
+        if self.map is not None: self.map.close()
+        self.map = m
+        self.inode = inode
+
+    # Map the table again if the publisher has replaced it, e.g. after a
+    # restart. Returns true if it did. This one makes system calls.
+    def refresh(self):
+        try:
+            if os.stat(self.path).st_ino == self.inode: return False
+        except OSError:
+            return False
+        self.open()
+        return True
+
+    # return the publisher's last heartbeat time
+    def heartbeat(self):
+        return struct.unpack_from("<d", self.map, HEARTBEAT)[0]
+
+    # return true if the publisher has updated the table within timeout
+    def alive(self, now=None):
+        return (now or time.time()) - self.heartbeat() <= self.timeout
+
+    # Return the latest reading of named channel
+    def read(self, name, now=None):
+        offset = self.first + self.index[name] * SLOT.size
+        now = now or time.time()
+        torn = False
+        for attempt in range(1000):
+            seq, status, timestamp, value, period = SLOT.unpack_from(self.map, offset)
+            if not seq & 1 and SEQUENCE.unpack_from(self.map, offset)[0] == seq: break
+        else:
+            status, torn = ERROR, True  # the publisher died while writing
+        stale = torn or status == NODATA or not self.alive(now) or bool(period and now - timestamp > STALE * period)
+        return reading(name, timestamp, value, status, stale)
+
+    # return list of latest readings of all channels
+    def read_all(self):
+        now = time.time()
+        return [self.read(name, now) for name in self.names]
+
+    def close(self):
+        self.map.close()
+
+if __name__ == "__main__":
+    for r in reader().read_all():
+        print("%-32s %12g %s%s" % (r.name, r.value, time.strftime("%H:%M:%S", time.localtime(r.timestamp)) if r.timestamp else "-",
+                                   " stale" if r.stale else ""))
@@ -0,0 +1,134 @@
+""" Read-through cache for sensor values """
+
+# Wrap a driver so that repeated reads within a time-to-live return the cached
+# value instead of going to the bus, and concurrent callers asking for the same
+# value while it's being read wait for that read rather than starting their
+# own. Drivers provide a ttls() method with defaults derived from their
+# conversion times, e.g.:
+#
+#   t = cached(tmp101(1, 0x49))
+#   t.get_temperature()         # reads the bus
+#   t.get_temperature()         # returns cached value for up to 320 mS
+#   print(t.cache.stats())
+#
+# Arguments, including keyword arguments, are part of the cache key. Calling
+# a driver's set_* methods discards its cached values and recalculates its
+# ttls, since e.g. tmp101.set_resolution() changes the conversion time. Other
+# methods without a ttl, and all other attributes, pass straight through.
+
+from __future__ import print_function
+import time, threading
+
+class _entry:
+    def __init__(self):
+        self.event = threading.Event()
+        self.expires = None             # None while read is in flight
+        self.value = None
+        self.error = None
+
+class ttlcache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0                   # returned cached value
+        self.misses = 0                 # read the value
+        self.waits = 0                  # waited for another caller's read
+        self.errors = 0                 # reads that raised
+
+    # Return cached value for key if not expired, else call fetch() to get it
+    # and cache it for ttl seconds. If another thread is already fetching the
+    # key, wait for its result instead.
+    def get(self, key, ttl, fetch):
+        with self.lock:
+            e = self.entries.get(key)
+            if e is not None:
+                if e.expires is None:
+                    self.waits += 1
+                elif e.expires > time.time():
+                    self.hits += 1
+                    return e.value
+                else:
+                    e = None
+            if e is None:
+                self.misses += 1
+                e = self.entries[key] = _entry()
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            e.event.wait()
+            if e.error is not None: raise e.error
+            return e.value
+
+        try:
+            e.value = fetch()
+            e.expires = time.time() + ttl
+            return e.value
+        except Exception as ex:
+            e.error = ex
+            with self.lock:
+                self.errors += 1
+                if self.entries.get(key) is e: del self.entries[key]
+            raise
+        finally:
+            e.event.set()
+
+    # discard all cached values, or just those for given key, or those whose
+    # keys start with the given prefix tuple
+    def clear(self, key=None, prefix=None):
+        with self.lock:
+            if prefix is not None:
+                for k in [k for k in self.entries if k[:len(prefix)] == prefix]: del self.entries[k]
+            elif key is None: self.entries = {}
+            else: self.entries.pop(key, None)
+
+    # return dict of counters
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "waits": self.waits, "errors": self.errors}
+
+class cached:
+    # Wrap driver, ttls are seconds by method name and override the driver's
+    # own ttls(). Pass cache to share one ttlcache between several drivers.
+    def __init__(self, driver, cache=None, **ttls):
+        self.driver = driver
+        self.cache = cache or ttlcache()
+        self.overrides = ttls
+        self.ttls = self._ttls()
+
+    # return the driver's ttls with overrides applied
+    def _ttls(self):
+        ttls = self.driver.ttls() if hasattr(self.driver, "ttls") else {}
+        ttls.update(self.overrides)
+        return ttls
+
+    # Recalculate the driver's ttls, e.g. after changing its resolution, and
+    # discard its cached values. ttls are further overrides.
+    def refresh(self, **ttls):
+        self.overrides.update(ttls)
+        self.ttls = self._ttls()
+        self.cache.clear(prefix=(id(self.driver),))
+
+    def __getattr__(self, name):
+        attr = getattr(self.driver, name)
+        if name.startswith("set_") and callable(attr):
+            def setter(*args, **kwargs):
+                try: return attr(*args, **kwargs)
+                finally: self.refresh()
+            return setter
+        if name not in self.ttls: return attr
+        def method(*args, **kwargs):
+            key = (id(self.driver), name) + args + tuple(sorted(kwargs.items()))
+            return self.cache.get(key, self.ttls[name], lambda: attr(*args, **kwargs))
+        return method
+
+if __name__ == "__main__":
+
+    try: from i2c_tmp101 import tmp101
+    except: from .i2c_tmp101 import tmp101
+
+    t = cached(tmp101(1, 0x49))
+    for n in range(10):
+        print("Temperature = %gC" % t.get_temperature())
+        time.sleep(0.1)
+    print(t.cache.stats())